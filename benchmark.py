@@ -0,0 +1,481 @@
+import argparse
+import http.server
+import io
+import json
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+from downloader.metadata_backend import create_backend
+from downloader.gallery_record import GalleryRecord, read_record
+from downloader import imaging
+
+
+def summarize(latencies):
+    """Returns a dict of simple latency statistics (seconds)."""
+    ordered = sorted(latencies)
+    p95_index = max(0, int(round(len(ordered) * 0.95)) - 1)
+    return {
+        "count": len(ordered),
+        "mean": statistics.mean(ordered),
+        "median": statistics.median(ordered),
+        "p95": ordered[p95_index],
+        "max": ordered[-1],
+    }
+
+
+def bench_metadata(args):
+    """Compares per-ID metadata latency of the in-process and subprocess backends"""
+    ids = list(range(args.start_id, args.end_id + 1))
+    modes = ["inprocess", "subprocess"] if args.backend == "both" else [args.backend]
+
+    results = {}
+    for mode in modes:
+        t0 = time.perf_counter()
+        try:
+            backend = create_backend(mode, config_path=args.config)
+        except ImportError as e:
+            print(f"[{mode}] unavailable: {e}")
+            continue
+        setup = time.perf_counter() - t0
+
+        latencies = []
+        failures = 0
+        for _ in range(args.repeat):
+            for gid in ids:
+                t0 = time.perf_counter()
+                data = backend.fetch(gid)
+                latencies.append(time.perf_counter() - t0)
+                if not data:
+                    failures += 1
+
+        stats = summarize(latencies)
+        results[mode] = stats
+        print(f"[{mode}] setup {setup * 1000:.1f} ms, {stats['count']} fetches, {failures} failed")
+        print(f"    per ID: mean {stats['mean'] * 1000:.1f} ms, median {stats['median'] * 1000:.1f} ms, "
+              f"p95 {stats['p95'] * 1000:.1f} ms, max {stats['max'] * 1000:.1f} ms")
+
+    if "inprocess" in results and "subprocess" in results:
+        speedup = results["subprocess"]["mean"] / results["inprocess"]["mean"]
+        print(f"In-process backend is {speedup:.2f}x faster per ID (mean).")
+
+
+def make_synthetic_page(width, height, seed=0):
+    """Builds a scan-like page: paper gradient, noise, and dark line art/text blocks."""
+    paper = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 24)
+    img = Image.merge("RGB", [
+        ImageChops.add(paper, noise, scale=2.0, offset=90),
+        ImageChops.add(paper, noise, scale=2.0, offset=80),
+        ImageChops.add(paper, noise, scale=2.0, offset=70),
+    ])
+
+    draw = ImageDraw.Draw(img)
+    step = max(8, height // 200)
+    for i in range(0, height, step):
+        x = (i * 7919 + seed * 104729) % width
+        draw.line([(x, i), ((x * 3 + i) % width, min(height - 1, i + step * 4))], fill=(20, 20, 20), width=3)
+    for y in range(height // 10, height, height // 6):
+        for x in range(width // 12, width - width // 12, max(4, width // 300)):
+            draw.rectangle([x, y, x + 2, y + step], fill=(10, 10, 10))
+    return img
+
+
+def psnr(a, b):
+    """Peak signal-to-noise ratio between two RGB images of the same size (dB)."""
+    diff = ImageChops.difference(a.convert("RGB"), b.convert("RGB"))
+    mse = sum(rms * rms for rms in ImageStat.Stat(diff).rms) / 3
+    if mse == 0:
+        return float("inf")
+    return 10 * math.log10(255 * 255 / mse)
+
+
+def downscale_bytes(data, oversample):
+    """Decodes a JPEG from memory and shrinks it like process_page does; returns (image, decoded pixels)."""
+    with Image.open(io.BytesIO(data)) as img:
+        size = imaging.target_size(img.size)
+        imaging.draft_for_downscale(img, size, oversample)
+        img.load()
+        decoded = img.size[0] * img.size[1]
+        return imaging.downscale(img, size, oversample), decoded
+
+
+def bench_imaging(args):
+    """Compares full-resolution LANCZOS against the draft/reduce() fast downscale path"""
+    sizes = [tuple(int(v) for v in s.lower().split("x")) for s in args.sizes]
+    oversamples = [float(v) for v in args.oversample]
+    failed = False
+
+    for width, height in sizes:
+        page = make_synthetic_page(width, height)
+        buffer = io.BytesIO()
+        page.save(buffer, "JPEG", quality=92)
+        data = buffer.getvalue()
+        print(f"Synthetic page {width}x{height} ({len(data) / 1e6:.1f} MB JPEG)")
+
+        reference = None
+        for oversample in [0.0] + oversamples:
+            cpu = []
+            for _ in range(args.repeat):
+                t0 = time.process_time()
+                result, decoded = downscale_bytes(data, oversample)
+                cpu.append(time.process_time() - t0)
+
+            if reference is None:
+                reference = result
+                quality = "reference"
+            else:
+                value = psnr(reference, result)
+                quality = f"PSNR {value:.1f} dB"
+                if value < args.min_psnr:
+                    quality += f" (below {args.min_psnr} dB)"
+                    failed = True
+
+            label = "full LANCZOS" if not oversample else f"oversample {oversample:g}"
+            print(f"    {label:16} cpu {statistics.median(cpu) * 1000:7.1f} ms/page, "
+                  f"decoded {decoded * 3 / 1e6:6.1f} MB, {quality}")
+
+    if failed:
+        print("Visual quality tolerance exceeded.")
+        sys.exit(1)
+
+
+class GalleryHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Stand-in for the gallery-dl metadata and image endpoints:
+    /galleries/<id>.json returns gallery-dl -j output, /galleryblock/<id>.html the
+    gallery header of the header phase, /pages/<id>/<num>.jpg a synthetic page.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        try:
+            if len(parts) == 2 and parts[0] == "galleries" and parts[1].endswith(".json"):
+                gid = int(parts[1][:-5])
+                body, content_type = json.dumps(self.server.gallery(gid)).encode(), "application/json"
+            elif len(parts) == 2 and parts[0] == "galleryblock" and parts[1].endswith(".html"):
+                gid = int(parts[1][:-5])
+                body, content_type = self.server.galleryblock(gid).encode(), "text/html; charset=utf-8"
+            elif len(parts) == 3 and parts[0] == "pages":
+                num = int(parts[2].split(".")[0])
+                body, content_type = self.server.pages[num % len(self.server.pages)], "image/jpeg"
+            else:
+                raise ValueError(self.path)
+        except ValueError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class GalleryServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, pages, page_count):
+        super().__init__(("127.0.0.1", 0), GalleryHandler)
+        self.pages = pages
+        self.page_count = page_count
+        self.base_url = f"http://127.0.0.1:{self.server_address[1]}"
+
+    def info(self, gid):
+        return {
+            "category": "hitomi", "gallery_id": gid, "title": f"Benchmark Gallery {gid}",
+            "artist": ["benchmark"], "group": [], "parody": ["original"], "language": "japanese",
+            "tags": ["benchmark"], "type": "doujinshi", "count": self.page_count,
+        }
+
+    def gallery(self, gid):
+        info = self.info(gid)
+        items = [[2, info]]
+        for num in range(1, self.page_count + 1):
+            url = f"{self.base_url}/pages/{gid}/{num}.jpg"
+            items.append([3, url, dict(info, num=num, extension="jpg")])
+        return items
+
+    def galleryblock(self, gid):
+        """The gallery's header in the markup of the site's galleryblock pages"""
+        info = self.info(gid)
+        links = [f'<a href="/index-{info["language"]}.html">{info["language"]}</a>',
+                 f'<a href="/type/{info["type"]}-all.html">{info["type"]}</a>']
+        for area, field in (("artist", "artist"), ("series", "parody"), ("tag", "tags")):
+            links.extend(f'<a href="/{area}/{value}-all.html">{value}</a>' for value in info[field])
+        return f'<h1><a href="/reader/{gid}.html">{info["title"]}</a></h1>' + "".join(links)
+
+
+class StandInBackend:
+    """Metadata backend reading -j output from the GalleryServer instead of running gallery-dl"""
+    name = "stand-in"
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def fetch(self, gallery_id, header_only=False):
+        try:
+            with urllib.request.urlopen(f"{self.base_url}/galleries/{gallery_id}.json", timeout=30) as response:
+                return read_record(response, header_only=header_only)
+        except urllib.error.HTTPError as e:
+            return GalleryRecord.from_error(f"{e.code} {e.reason}")
+
+
+def run_pipeline_worker(args):
+    """Child process of bench_pipeline: runs hitomi_dl.main() against the stand-in server"""
+    import hitomi_dl
+
+    load_config = hitomi_dl.load_config
+
+    def bench_config():
+        config = load_config()
+        # Keep state of earlier runs (completed IDs, cache) and politeness delays out of the numbers
+        config["organizer_db"] = os.path.join(args.workdir, "organizer.db")
+        config.setdefault("jobs", {})["path"] = os.path.join(args.workdir, "jobs.db")
+        config["downloader"] = {"retries": 1, "timeout": 30.0, "sleep": 0}
+        config.setdefault("metrics", {})["textfile_path"] = ""
+        # The header phase asks the stand-in server too (--no_header_phase still turns it off)
+        config.setdefault("metadata_header", {})["url"] = f"{args.server}/galleryblock/{{}}.html"
+        return config
+
+    hitomi_dl.load_config = bench_config
+    hitomi_dl.create_backend = lambda mode, config_path=None: StandInBackend(args.server)
+    sys.argv = ["hitomi_dl.py", str(args.start_id), str(args.end_id),
+                "--output_dir", os.path.join(args.workdir, "out"),
+                "--temp_dir", os.path.join(args.workdir, "temp"),
+                "--metrics_json", os.path.join(args.workdir, "metrics.json"),
+                "--no_cache"] + args.hitomi_args
+    try:
+        hitomi_dl.main()
+    finally:
+        # For run_child where os.wait4 is missing (Windows)
+        cpu, rss = process_usage()
+        with open(os.path.join(args.workdir, "usage.json"), "w", encoding="utf-8") as f:
+            json.dump({"cpu_seconds": cpu, "peak_rss_mb": rss}, f)
+
+
+def process_usage():
+    """(CPU seconds, peak RSS in MB) of this process; RSS is None where it cannot be read"""
+    cpu = time.process_time()
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        return cpu, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    if sys.platform != "win32":
+        return cpu, None
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in (
+                "PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+
+    kernel32 = ctypes.WinDLL("kernel32")
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    if not kernel32.K32GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return cpu, None
+    return cpu, counters.PeakWorkingSetSize / (1024 * 1024)
+
+
+def run_child(cmd, cwd):
+    """
+    Runs cmd and returns (wall seconds, CPU seconds, peak RSS in MB). Without
+    os.wait4 (Windows) CPU and RSS are what the worker wrote to usage.json:
+    its own process only, not the workers of a process image pool.
+    """
+    t0 = time.perf_counter()
+    with open(os.path.join(cwd, "hitomi_dl.log"), "w") as log:
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+        else:
+            proc.wait()
+            usage = None
+    wall = time.perf_counter() - t0
+    if proc.returncode != 0:
+        raise RuntimeError(f"hitomi_dl exited with {proc.returncode}, see {os.path.join(cwd, 'hitomi_dl.log')}")
+    if usage is None:
+        try:
+            with open(os.path.join(cwd, "usage.json"), encoding="utf-8") as f:
+                reported = json.load(f)
+        except (OSError, ValueError):
+            return wall, None, None
+        return wall, reported.get("cpu_seconds"), reported.get("peak_rss_mb")
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return wall, usage.ru_utime + usage.ru_stime, rss
+
+
+def compare_to_baseline(result, baseline, tolerance):
+    """Returns a list of regressions (text) of result against a saved baseline"""
+    regressions = []
+
+    def check(label, value, base, higher_is_better=False, floor=0.0):
+        if value is None or base is None:
+            return
+        if higher_is_better:
+            if value < base * (1 - tolerance):
+                regressions.append(f"{label}: {value:.3f} < baseline {base:.3f}")
+        elif value > base * (1 + tolerance) + floor:
+            regressions.append(f"{label}: {value:.3f} > baseline {base:.3f}")
+
+    check("galleries/min", result["galleries_per_minute"], baseline.get("galleries_per_minute"), higher_is_better=True)
+    check("CPU ms/page", result["cpu_ms_per_page"], baseline.get("cpu_ms_per_page"))
+    check("peak RSS MB", result["peak_rss_mb"], baseline.get("peak_rss_mb"))
+    for name, mean in result["stages"].items():
+        # Small absolute allowance so near-zero stages do not fail on scheduling noise
+        check(f"stage {name} mean s", mean, baseline.get("stages", {}).get(name), floor=0.005)
+    return regressions
+
+
+def bench_pipeline(args):
+    """Runs hitomi_dl over an ID range against a local stand-in server and reports throughput"""
+    width, height = (int(v) for v in args.resolution.lower().split("x"))
+    print(f"Generating {args.variants} synthetic {width}x{height} pages...")
+    pages = []
+    for seed in range(args.variants):
+        buffer = io.BytesIO()
+        make_synthetic_page(width, height, seed).save(buffer, "JPEG", quality=92)
+        pages.append(buffer.getvalue())
+
+    server = GalleryServer(pages, args.pages)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    script = os.path.abspath(__file__)
+    end_id = args.start_id + args.galleries - 1
+
+    runs = []
+    try:
+        for run in range(args.repeat):
+            workdir = tempfile.mkdtemp(prefix="hitomi_bench_")
+            try:
+                cmd = [sys.executable, script, "pipeline-worker", server.base_url, str(args.start_id), str(end_id),
+                       workdir, "--"] + args.hitomi_args
+                wall, cpu, rss = run_child(cmd, workdir)
+                with open(os.path.join(workdir, "metrics.json"), encoding="utf-8") as f:
+                    metrics = json.load(f)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+            galleries = metrics.get("galleries", {}).get("result=packed", 0)
+            page_count = sum(metrics.get("pages", {}).values()) if isinstance(metrics.get("pages"), dict) else 0
+            result = {
+                "galleries_per_minute": galleries / wall * 60,
+                "cpu_ms_per_page": cpu / page_count * 1000 if cpu is not None and page_count else None,
+                "peak_rss_mb": rss,
+                "stages": {name: stage["time"]["mean"] for name, stage in metrics["stages"].items()},
+            }
+            runs.append(result)
+            print(f"Run {run + 1}: {galleries} galleries, {page_count} pages in {wall:.1f}s")
+    finally:
+        server.shutdown()
+
+    def median(key, source=None):
+        values = [(source(r) if source else r[key]) for r in runs]
+        values = [v for v in values if v is not None]
+        return statistics.median(values) if values else None
+
+    result = {
+        "galleries_per_minute": median("galleries_per_minute"),
+        "cpu_ms_per_page": median("cpu_ms_per_page"),
+        "peak_rss_mb": median("peak_rss_mb"),
+        "stages": {name: median(None, lambda r, name=name: r["stages"].get(name)) for name in runs[0]["stages"]},
+    }
+    params = {"galleries": args.galleries, "pages": args.pages, "resolution": args.resolution,
+              "hitomi_args": args.hitomi_args}
+
+    cpu = "n/a" if result["cpu_ms_per_page"] is None else f"{result['cpu_ms_per_page']:.1f} ms"
+    rss = "n/a" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.0f} MB"
+    print(f"{args.galleries} galleries x {args.pages} pages at {args.resolution}:")
+    print(f"    {result['galleries_per_minute']:.1f} galleries/min, CPU {cpu}/page, peak RSS {rss}")
+    for name, mean in result["stages"].items():
+        print(f"    stage {name:10} mean {mean:.3f}s")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(dict(result, params=params), f, indent=4)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("params") != params:
+            print(f"Warning: baseline was recorded with different parameters: {baseline.get('params')}")
+        regressions = compare_to_baseline(result, baseline, args.tolerance)
+        if regressions:
+            print(f"Regressions against {args.baseline} (tolerance {args.tolerance:.0%}):")
+            for line in regressions:
+                print(f"    {line}")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the hitomi_dl downloader.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("metadata", help="Per-ID latency of the metadata backends")
+    p.add_argument("start_id", type=int, help="Start Gallery ID")
+    p.add_argument("end_id", type=int, help="End Gallery ID")
+    p.add_argument("--backend", choices=["both", "inprocess", "subprocess"], default="both")
+    p.add_argument("--repeat", type=int, default=1, help="Number of passes over the ID range")
+    p.add_argument("--config", type=str, help="gallery-dl config file passed to both backends")
+    p.set_defaults(func=bench_metadata)
+
+    p = sub.add_parser("imaging", help="CPU time, decode size and quality of the fast downscale path")
+    p.add_argument("--sizes", nargs="+", default=["2480x3508", "4000x6000", "6000x9000"], help="Synthetic page sizes (WxH)")
+    p.add_argument("--oversample", nargs="+", default=["1.5", "2.0", "3.0"],
+                   help="downscale_oversample values to compare")
+    p.add_argument("--min_psnr", type=float, default=35.0, help="Fail if a fast path falls below this PSNR against full LANCZOS")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_imaging)
+
+    p = sub.add_parser("pipeline", help="End-to-end hitomi_dl throughput against a local stand-in server")
+    p.add_argument("--galleries", type=int, default=20, help="Number of galleries (IDs) to run")
+    p.add_argument("--pages", type=int, default=20, help="Pages per gallery")
+    p.add_argument("--resolution", default="2480x3508", help="Page size (WxH)")
+    p.add_argument("--variants", type=int, default=4, help="Distinct synthetic pages served in rotation")
+    p.add_argument("--start_id", type=int, default=1000000)
+    p.add_argument("--repeat", type=int, default=1, help="Runs to take the median of")
+    p.add_argument("--save_baseline", type=str, help="Write the results to this JSON file")
+    p.add_argument("--baseline", type=str, help="Compare against a saved baseline; exit 1 on a regression")
+    p.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative slowdown before failing")
+    p.add_argument("hitomi_args", nargs=argparse.REMAINDER, help="Extra hitomi_dl arguments after --")
+    p.set_defaults(func=bench_pipeline)
+
+    p = sub.add_parser("pipeline-worker", help=argparse.SUPPRESS)
+    p.add_argument("server")
+    p.add_argument("start_id", type=int)
+    p.add_argument("end_id", type=int)
+    p.add_argument("workdir")
+    p.add_argument("hitomi_args", nargs=argparse.REMAINDER)
+    p.set_defaults(func=run_pipeline_worker)
+
+    args = parser.parse_args()
+    if getattr(args, "hitomi_args", None) and args.hitomi_args[0] == "--":
+        args.hitomi_args = args.hitomi_args[1:]
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
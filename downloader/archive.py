@@ -0,0 +1,105 @@
+import os
+import threading
+import zipfile
+
+# Archive entries counted as pages (manifests, the organizer's page counts)
+PAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".avif", ".gif", ".jxl", ".bmp"}
+# Formats that are already compressed; deflating them only costs CPU
+STORED_EXTENSIONS = PAGE_EXTENSIONS - {".bmp"}
+
+
+def is_page(name):
+    return os.path.splitext(name)[1].lower() in PAGE_EXTENSIONS
+
+
+def compress_type_for(name):
+    """ZIP_STORED for already-compressed images, ZIP_DEFLATED for everything else."""
+    if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+class CbzWriter:
+    """
+    Writes a CBZ incrementally to `<filepath>.tmp` and renames it into place on close().
+    Pages may be added from any thread and in any order; they are written in
+    index order as soon as all preceding pages are in. extra_entries
+    ([(name, data), ...], e.g. ComicInfo.xml) are written after the last page.
+    """
+    def __init__(self, filepath, extra_entries=()):
+        self.filepath = filepath
+        self.extra_entries = list(extra_entries)
+        self.temp_filepath = filepath + ".tmp"
+        self.count = 0
+        self._zip = zipfile.ZipFile(self.temp_filepath, 'w')
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._next_index = 0
+
+    def add(self, index, name, data=None, path=None):
+        """
+        Queues page `index` (data in memory, or a file at `path`).
+        Use skip(index) for pages that produce no entry.
+        """
+        with self._lock:
+            self._pending[index] = (name, data, path)
+            self._flush()
+
+    def skip(self, index):
+        self.add(index, None)
+
+    def _flush(self):
+        while self._next_index in self._pending:
+            name, data, path = self._pending.pop(self._next_index)
+            self._next_index += 1
+            if name is not None:
+                self._write(name, data, path)
+
+    def _write(self, name, data, path):
+        compress_type = compress_type_for(name)
+        if path is not None:
+            self._zip.write(path, arcname=name, compress_type=compress_type)
+        else:
+            self._zip.writestr(name, data, compress_type=compress_type)
+        self.count += 1
+
+    def entries(self):
+        """[(name, crc, size), ...] of the entries written so far (still valid after close())"""
+        return [(info.filename, info.CRC, info.file_size) for info in self._zip.infolist()]
+
+    def close(self):
+        """Writes any remaining pages, finishes the archive and moves it to its final name."""
+        with self._lock:
+            # Pages after a gap (never added) are still written, in order
+            for index in sorted(self._pending):
+                self._next_index = index
+                self._flush()
+            for name, data in self.extra_entries:
+                self._write(name, data, None)
+            self._zip.close()
+
+        # Rename temp file to final filename
+        if os.path.exists(self.filepath):
+            try:
+                os.remove(self.filepath)
+            except OSError:
+                pass
+
+        try:
+            os.replace(self.temp_filepath, self.filepath)
+        except OSError as e:
+            print(f"Error renaming {self.temp_filepath} to {self.filepath}: {e}")
+
+        return self.filepath
+
+    def abort(self):
+        """Discards the partial archive."""
+        with self._lock:
+            try:
+                self._zip.close()
+            except Exception:
+                pass
+        try:
+            os.remove(self.temp_filepath)
+        except OSError:
+            pass
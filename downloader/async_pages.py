@@ -0,0 +1,234 @@
+import asyncio
+import io
+import queue
+import ssl
+import threading
+import urllib.error
+import urllib.parse
+from email.message import Message
+
+from downloader.pages import USER_AGENT, READER_URL
+
+
+class _HostPool:
+    """Idle keep-alive connections to one host, plus a cap on concurrent connections."""
+    def __init__(self, limit):
+        self.slots = asyncio.Semaphore(limit)
+        self.idle = []
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncPageDownloader:
+    """
+    Fetches gallery pages concurrently on a private asyncio event loop.
+    Connections are HTTP/1.1 keep-alive, pooled per host and shared by all
+    galleries, with at most `connections_per_host` open to the same host.
+    Retries and errors behave like pages.fetch_page: network errors, 5xx and
+    429 are retried with exponential backoff, other 4xx raise HTTPError.
+    """
+    def __init__(self, connections_per_host=6, timeout=30.0, retries=4, sleep=0, observer=None):
+        self.connections_per_host = max(1, connections_per_host)
+        self.timeout = timeout
+        self.retries = retries
+        self.sleep = sleep
+        self.observer = observer
+        self._pools = {}
+        self._ssl = ssl.create_default_context()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="page-downloader", daemon=True)
+        self._thread.start()
+
+    def iter_pages(self, entries, gallery_id):
+        """
+        Downloads [(url, filename), ...] and yields (filename, data) in completion order.
+        The first failed page raises (after its retries) and cancels the rest.
+        """
+        results = queue.Queue()
+        referer = READER_URL.format(gallery_id)
+
+        async def fetch_one(url, filename):
+            try:
+                results.put((filename, await self._fetch(url, referer), None))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                results.put((filename, None, e))
+
+        futures = [asyncio.run_coroutine_threadsafe(fetch_one(url, filename), self._loop)
+                   for url, filename in entries]
+        try:
+            for _ in futures:
+                filename, data, error = results.get()
+                if error is not None:
+                    raise error
+                yield filename, data
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        """Closes the pooled connections and stops the event loop."""
+        async def close_all():
+            for pool in self._pools.values():
+                for conn in pool.idle:
+                    conn.close()
+                pool.idle.clear()
+
+        if self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(close_all(), self._loop).result(timeout=5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(5)
+
+    async def _fetch(self, url, referer):
+        loop = asyncio.get_running_loop()
+        pool, key = self._pool_for(url)
+        attempt = 0
+        while True:
+            if self.sleep:
+                await asyncio.sleep(self.sleep)
+            # Waiting for a connection slot is not part of the request: the timeout
+            # and the latency reported to the observer start once the slot is held
+            async with pool.slots:
+                t0 = loop.time()
+                try:
+                    data = await asyncio.wait_for(self._request(pool, key, url, referer), self.timeout)
+                    if self.observer:
+                        self.observer(loop.time() - t0)
+                    return data
+                except urllib.error.HTTPError as e:
+                    # Client errors other than throttling will not fix themselves
+                    if e.code < 500 and e.code != 429:
+                        if self.observer:
+                            self.observer(loop.time() - t0)
+                        raise
+                    error = e
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                    error = e
+                latency = loop.time() - t0
+
+            if self.observer:
+                self.observer(latency, error=True, throttled=getattr(error, "code", None) == 429)
+
+            attempt += 1
+            if attempt > self.retries:
+                raise error
+            await asyncio.sleep(min(60, 2 ** attempt))
+
+    def _pool_for(self, url):
+        """(pool, (scheme, host, port)) of the URL's host"""
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported URL: {url}")
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = _HostPool(self.connections_per_host)
+        return pool, key
+
+    async def _request(self, pool, key, url, referer):
+        """One GET on a pooled connection; the caller holds one of pool.slots."""
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        host = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+        request = (
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {host}\r\n"
+            f"User-Agent: {USER_AGENT}\r\n"
+            f"Referer: {referer}\r\n"
+            "Accept: image/avif,image/webp,image/*,*/*;q=0.8\r\n"
+            "Accept-Encoding: identity\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode("latin-1")
+
+        while True:
+            conn = await self._connect(pool, key)
+            try:
+                conn.writer.write(request)
+                await conn.writer.drain()
+                status, reason, headers, body, keep_alive = await self._read_response(conn.reader)
+                break
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                conn.close()
+                # The server may have dropped an idle connection; retry once on a fresh one
+                if conn.reused:
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+
+        if keep_alive:
+            conn.reused = True
+            pool.idle.append(conn)
+        else:
+            conn.close()
+
+        if status >= 400:
+            raise urllib.error.HTTPError(url, status, reason, headers, io.BytesIO(body))
+        if status >= 300:
+            raise urllib.error.HTTPError(url, status, f"Unexpected redirect to {headers.get('Location')}",
+                                         headers, io.BytesIO(body))
+        return body
+
+    async def _connect(self, pool, key):
+        while pool.idle:
+            conn = pool.idle.pop()
+            if not conn.reader.at_eof():
+                return conn
+            conn.close()
+        scheme, host, port = key
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=self._ssl if scheme == "https" else None, limit=1024 * 1024)
+        return _Connection(reader, writer)
+
+    async def _read_response(self, reader):
+        """Reads one HTTP/1.1 response; returns (status, reason, headers, body, keep_alive)."""
+        status_line = (await reader.readuntil(b"\r\n")).decode("latin-1")
+        version, status, reason = (status_line.rstrip("\r\n").split(" ", 2) + [""])[:3]
+        if not version.startswith("HTTP/"):
+            raise ValueError(f"Bad status line: {status_line!r}")
+        status = int(status)
+
+        headers = Message()
+        while True:
+            line = (await reader.readuntil(b"\r\n")).decode("latin-1")
+            if line == "\r\n":
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip()] = value.strip()
+
+        connection = (headers.get("Connection") or "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+        if (headers.get("Transfer-Encoding") or "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0:
+                    # Trailers end with an empty line
+                    while await reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b"".join(chunks)
+        elif headers.get("Content-Length") is not None:
+            body = await reader.readexactly(int(headers["Content-Length"]))
+        elif status in (204, 304) or 100 <= status < 200:
+            body = b""
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return status, reason, headers, body, keep_alive
@@ -0,0 +1,135 @@
+import errno
+import os
+import shutil
+import threading
+
+
+class ByteBudget:
+    """Thread-safe byte counter used to cap how much gallery data is held at once."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def try_reserve(self, amount):
+        """Reserves `amount` bytes if they fit; returns False otherwise."""
+        with self._lock:
+            if self.used + amount > self.limit:
+                return False
+            self.used += amount
+            return True
+
+    def adjust(self, old_amount, new_amount):
+        """Replaces an estimate with the real size (may go over the limit)."""
+        with self._lock:
+            self.used += new_amount - old_amount
+
+    def release(self, amount):
+        with self._lock:
+            self.used = max(0, self.used - amount)
+
+
+class DiskSpaceError(OSError):
+    def __init__(self, path, needed, free):
+        super().__init__(errno.ENOSPC, f"Not enough free space on {path}: "
+                                       f"{needed / 1e6:.0f} MB needed, {free / 1e6:.0f} MB free")
+
+
+def free_space(path):
+    """Free bytes on the disk holding `path` (the nearest existing parent if it does not exist yet)."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def check_free_space(path, needed, reserve=0):
+    """Raises DiskSpaceError unless `path` has `needed` bytes free on top of `reserve`."""
+    free = free_space(path)
+    if free - reserve < needed:
+        raise DiskSpaceError(path, needed + reserve, free)
+
+
+class DiskBudget:
+    """
+    Bytes in flight in the temp area, with watermark hysteresis: once the
+    reserved bytes reach `high`, new reservations wait until they drop to
+    `low`. A gallery is always admitted when nothing else is in flight, so
+    one gallery larger than the budget cannot stall the run. Every gallery
+    also needs `min_free` bytes left on the disk after its download.
+    Page sizes are estimated from the metadata, falling back to the mean
+    page size seen so far (or `page_estimate` before the first gallery).
+    Galleries without a page list count as their page count (or
+    NOMINAL_PAGES) pages of that size.
+    """
+    NOMINAL_PAGES = 30
+
+    def __init__(self, path, high, low, page_estimate, min_free=0, name="temp"):
+        self.path = path
+        self.name = name
+        self.high = high
+        self.low = min(low, high)
+        self.page_estimate = page_estimate
+        self.min_free = min_free
+        self.used = 0
+        self.blocked = False
+        self.waits = 0
+        self._pages = 0
+        self._page_bytes = 0
+        self._cond = threading.Condition()
+
+    def estimate(self, page_sizes, page_count=None):
+        """
+        Bytes a gallery will take; page_sizes holds the size of each page, None if unknown.
+        page_count: pages of a gallery whose page list is missing (empty page_sizes).
+        """
+        with self._cond:
+            mean = self._page_bytes / self._pages if self._pages else self.page_estimate
+        if not page_sizes:
+            return int(mean * (page_count or self.NOMINAL_PAGES))
+        return int(sum(size if size else mean for size in page_sizes))
+
+    def observe(self, pages, size):
+        """Feeds the real size of a downloaded gallery into the page size estimate."""
+        if pages:
+            with self._cond:
+                self._pages += pages
+                self._page_bytes += size
+
+    def reserve(self, amount, label=""):
+        """
+        Blocks until `amount` bytes fit under the watermarks and on the disk, then
+        reserves them. Raises DiskSpaceError if they do not fit on an otherwise idle disk.
+        """
+        with self._cond:
+            waited = False
+            while self.used and (self.blocked or self.used + amount > self.high
+                                 or free_space(self.path) - self.min_free < amount):
+                if not waited:
+                    self.waits += 1
+                    print(f"{label}: {self.name} disk budget full ({self.used / 1e6:.0f} MB in flight), waiting...")
+                    waited = True
+                # Wait with a timeout so KeyboardInterrupt is not held up
+                self._cond.wait(0.5)
+            check_free_space(self.path, amount, self.min_free)
+            self.used += amount
+            if self.used >= self.high:
+                self.blocked = True
+
+    def adjust(self, old_amount, new_amount):
+        """Replaces an estimate with the real size."""
+        with self._cond:
+            self.used += new_amount - old_amount
+            self._update()
+
+    def release(self, amount):
+        with self._cond:
+            self.used = max(0, self.used - amount)
+            self._update()
+
+    def _update(self):
+        if self.used >= self.high:
+            self.blocked = True
+        elif self.blocked and self.used <= self.low:
+            self.blocked = False
+        self._cond.notify_all()
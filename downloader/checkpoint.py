@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import threading
+
+CHECKPOINT_NAME = "checkpoint.json"
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class Checkpoint:
+    """
+    Per-gallery manifest in TEMP_DIR/<id>/checkpoint.json.
+    Records every page that was downloaded and processed (size + SHA-1), so an
+    interrupted gallery only fetches / converts what is missing on the next run.
+    """
+    def __init__(self, directory, gallery_id, verify_hashes=False):
+        self.directory = directory
+        self.gallery_id = gallery_id
+        self.verify_hashes = verify_hashes
+        self.path = os.path.join(directory, CHECKPOINT_NAME)
+        self.page_count = None
+        # original filename -> {"size", "sha1", "processed", "processed_size", "processed_sha1"}
+        self.pages = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("gallery_id") == self.gallery_id:
+            self.page_count = data.get("page_count")
+            self.pages = data.get("pages", {})
+
+    def save(self):
+        """Atomically rewrites the manifest (a crash never leaves it half-written)."""
+        with self._lock:
+            data = {"gallery_id": self.gallery_id, "page_count": self.page_count, "pages": self.pages}
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+
+    def _matches(self, name, size, sha1):
+        path = os.path.join(self.directory, name)
+        try:
+            if os.path.getsize(path) != size:
+                return False
+        except OSError:
+            return False
+        return not self.verify_hashes or file_sha1(path) == sha1
+
+    def has_page(self, filename):
+        """True if the page is on disk, intact, either as downloaded or already processed."""
+        entry = self.pages.get(filename)
+        if not entry:
+            return False
+        if entry.get("processed") and self._matches(entry["processed"], entry["processed_size"], entry["processed_sha1"]):
+            return True
+        return self._matches(filename, entry["size"], entry["sha1"])
+
+    def processed_name(self, filename):
+        """Returns the converted page name if `filename` (original or converted) was already processed intact."""
+        for original, entry in self.pages.items():
+            if filename in (original, entry.get("processed")):
+                processed = entry.get("processed")
+                if processed and self._matches(processed, entry["processed_size"], entry["processed_sha1"]):
+                    return processed
+                return None
+        return None
+
+    def mark_downloaded(self, filename, data):
+        with self._lock:
+            self.pages[filename] = {"size": len(data), "sha1": hashlib.sha1(data).hexdigest()}
+        self.save()
+
+    def mark_processed(self, filename, new_filename):
+        path = os.path.join(self.directory, new_filename)
+        with self._lock:
+            entry = self.pages.setdefault(filename, {"size": None, "sha1": None})
+            entry["processed"] = new_filename
+            entry["processed_size"] = os.path.getsize(path)
+            entry["processed_sha1"] = file_sha1(path)
+        self.save()
+
+    def missing(self, filenames):
+        """Pages of the gallery that still have to be downloaded (new, missing or truncated)."""
+        return [name for name in filenames if not self.has_page(name)]
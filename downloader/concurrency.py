@@ -0,0 +1,132 @@
+import re
+import statistics
+import threading
+import time
+
+# HTTP status of gallery-dl ("HttpError: '404 Not Found' for '<url>'") and urllib ("HTTP Error 503: ...") messages
+_STATUS_RE = re.compile(r"HTTP ?Error:? ?'?(\d{3})\b|'(\d{3}) [A-Za-z]", re.IGNORECASE)
+# Messages without a status that point at an overloaded server rather than a missing gallery
+_SERVER_ERROR_RE = re.compile(r"\b(timed? ?out|connection|too many requests)\b", re.IGNORECASE)
+# URLs in messages carry gallery IDs ("…/galleries/1429871.js"), which must not be read as a status
+_URL_RE = re.compile(r"\w+://\S+")
+
+
+def classify_error(message):
+    """
+    Returns (error, throttled) for an error message from gallery-dl or urllib:
+    429 and 5xx responses, timeouts and connection errors are transient
+    (error); anything else, e.g. 404, is permanent.
+    """
+    message = _URL_RE.sub("", str(message or ""))
+    match = _STATUS_RE.search(message)
+    if match:
+        status = int(match.group(1) or match.group(2))
+        return status == 429 or 500 <= status <= 599, status == 429
+    if _SERVER_ERROR_RE.search(message):
+        return True, "too many requests" in message.lower()
+    return False, False
+
+
+class AdaptiveLimiter:
+    """
+    Caps how many workers may run a request at once and tunes that cap with
+    additive-increase/multiplicative-decrease:
+    - every `window` samples the limit grows by `increase` if the workers were
+      saturated and latency/error rate look healthy,
+    - it is multiplied by `decrease` when the error rate exceeds `max_error_rate`,
+      the median latency exceeds `latency_factor` x the baseline, or right away
+      on a throttling response (at most once per `cooldown` seconds).
+    The limit always stays within [minimum, maximum].
+    """
+    def __init__(self, name, initial, minimum=1, maximum=8, window=20, increase=1,
+                 decrease=0.5, max_error_rate=0.1, latency_factor=2.0, cooldown=10.0):
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = self._clamp(initial)
+        self.window = max(1, window)
+        self.increase = increase
+        self.decrease = decrease
+        self.max_error_rate = max_error_rate
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.active = 0
+        self.baseline = None
+        # (old limit, new limit, reason) for every change
+        self.changes = []
+        self._samples = []
+        self._saturated = False
+        self._last_decrease = None
+        self._cond = threading.Condition()
+
+    def _clamp(self, value):
+        return max(self.minimum, min(self.maximum, int(value)))
+
+    def acquire(self):
+        with self._cond:
+            # Wait with a timeout so KeyboardInterrupt is not held up
+            while self.active >= self.limit:
+                self._cond.wait(0.5)
+            self.active += 1
+            if self.active >= self.limit:
+                self._saturated = True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+    def record(self, latency, error=False, throttled=False):
+        """Adds the outcome of one request (latency in seconds)."""
+        with self._cond:
+            if throttled:
+                now = time.monotonic()
+                if self._last_decrease is None or now - self._last_decrease >= self.cooldown:
+                    self._decrease("throttled (HTTP 429)")
+                return
+
+            self._samples.append((latency, bool(error)))
+            if len(self._samples) >= self.window:
+                self._evaluate()
+
+    def _evaluate(self):
+        samples, self._samples = self._samples, []
+        median = statistics.median(latency for latency, _ in samples)
+        error_rate = sum(error for _, error in samples) / len(samples)
+        stats = f"median {median:.2f}s, {error_rate:.0%} errors"
+
+        if error_rate > self.max_error_rate:
+            self._decrease(f"error rate above {self.max_error_rate:.0%}: {stats}")
+        elif self.baseline and median > self.baseline * self.latency_factor:
+            self._decrease(f"latency above {self.latency_factor:g}x baseline {self.baseline:.2f}s: {stats}")
+        elif self._saturated:
+            self._set(self.limit + self.increase, f"healthy: {stats}")
+
+        # Baseline follows the fastest windows, and rises only slowly when the
+        # server is generally slower
+        if error_rate <= self.max_error_rate:
+            self.baseline = median if self.baseline is None else min(median, self.baseline * 1.1)
+        self._saturated = self.active >= self.limit
+
+    def _decrease(self, reason):
+        self._last_decrease = time.monotonic()
+        # Samples taken at the old limit say nothing about the new one
+        self._samples = []
+        self._set(self.limit * self.decrease, reason)
+
+    def _set(self, value, reason):
+        old, new = self.limit, self._clamp(value)
+        if new == old:
+            return
+        self.limit = new
+        self.changes.append((old, new, reason))
+        print(f"[{self.name}] concurrency {old} -> {new} ({reason})")
+        self._cond.notify_all()
@@ -0,0 +1,129 @@
+import array
+import os
+import re
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from downloader.pages import USER_AGENT
+
+# hitomi.la's packed gallery ID lists (big-endian int32, newest first)
+NOZOMI_URL = "https://ltn.gold-usergeneratedcontent.net/n"
+
+# gallery-dl writes tags as "name ♀" / "name ♂"; the index uses "female:name" / "male:name"
+_GENDER_SUFFIX_RE = re.compile(r"^(.*?)\s*([♀♂])$")
+
+
+def parse_nozomi(data):
+    """Gallery IDs of a .nozomi file as array('i')."""
+    ids = array.array("i")
+    ids.frombytes(data[:len(data) - len(data) % 4])
+    if sys.byteorder == "little":
+        ids.byteswap()
+    return ids
+
+
+def nozomi_path(area, name, language="all"):
+    """Path of an index below NOZOMI_URL, e.g. ("tag", "male:yaoi") -> "tag/male:yaoi-all.nozomi"."""
+    name = urllib.parse.quote(name.lower().replace("_", " "), safe=":")
+    return f"{area}/{name}-{language}.nozomi" if area else f"{name}-{language}.nozomi"
+
+
+def tag_path(tag):
+    """Index path of an exclude_tags entry, in either hitomi ("male:yaoi") or gallery-dl ("yaoi ♂") form."""
+    match = _GENDER_SUFFIX_RE.match(tag)
+    if match:
+        tag = ("female:" if match.group(2) == "♀" else "male:") + match.group(1)
+    return nozomi_path("tag", tag)
+
+
+class IndexDiscovery:
+    """
+    Finds the gallery IDs of a range from the site's index files instead of
+    asking gallery-dl about every ID. The range is intersected with the
+    index of all galleries and the language index; galleries in the index
+    of an excluded tag or artist are removed. Only the IDs of the range are
+    ever held in a set; the indexes themselves stay packed in arrays.
+    Downloaded indexes are kept in `cache_dir` for `max_age` seconds.
+    """
+    def __init__(self, base_url=NOZOMI_URL, cache_dir=None, max_age=6 * 3600, timeout=60.0, retries=3):
+        self.base_url = base_url.rstrip("/")
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.timeout = timeout
+        self.retries = retries
+        # (step, IDs left) in the order of discover()
+        self.steps = []
+
+    def fetch(self, path):
+        """The IDs of one index file; None if the index does not exist (HTTP 404)."""
+        cache_path = None
+        if self.cache_dir:
+            cache_path = os.path.join(self.cache_dir, urllib.parse.unquote(path).replace("/", "_").replace(":", "_"))
+            if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < self.max_age:
+                with open(cache_path, "rb") as f:
+                    return parse_nozomi(f.read())
+
+        data = self._download(f"{self.base_url}/{path}")
+        if data is None:
+            return None
+        if cache_path:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(cache_path + ".part", "wb") as f:
+                f.write(data)
+            os.replace(cache_path + ".part", cache_path)
+        return parse_nozomi(data)
+
+    def _download(self, url):
+        request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT, "Referer": "https://hitomi.la/"})
+        attempt = 0
+        while True:
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    return response.read()
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    return None
+                if e.code < 500 and e.code != 429:
+                    raise
+                error = e
+            except (urllib.error.URLError, OSError) as e:
+                error = e
+            attempt += 1
+            if attempt > self.retries:
+                raise error
+            time.sleep(min(60, 2 ** attempt))
+
+    def discover(self, start, end, language=None, exclude_tags=(), exclude_artists=()):
+        """Sorted array('i') of the IDs in [start, end] that pass the language and exclude filters."""
+        self.steps = [("range", end - start + 1)]
+        index = self.fetch(nozomi_path(None, "index"))
+        if index is None:
+            raise ValueError(f"No gallery index at {self.base_url}")
+        candidates = {gid for gid in index if start <= gid <= end}
+        self.steps.append(("indexed", len(candidates)))
+
+        if language:
+            # Set operations iterate the packed index without building a set of it
+            language_ids = self.fetch(nozomi_path(None, "index", language.lower()))
+            if language_ids is None:
+                print(f"Discovery: no index for language '{language}', not filtering by language")
+            else:
+                candidates.intersection_update(language_ids)
+                self.steps.append(("language", len(candidates)))
+
+        excluded = [tag_path(tag) for tag in exclude_tags or ()]
+        excluded += [nozomi_path("artist", artist) for artist in exclude_artists or ()]
+        for path in excluded:
+            if not candidates:
+                break
+            ids = self.fetch(path)
+            if ids is None:
+                print(f"Discovery: no index {urllib.parse.unquote(path)}, skipped")
+                continue
+            candidates.difference_update(ids)
+        if excluded:
+            self.steps.append(("excluded", len(candidates)))
+        return array.array("i", sorted(candidates))
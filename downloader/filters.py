@@ -0,0 +1,195 @@
+import collections
+import re
+import threading
+
+from downloader.metadata_cache import filter_key
+
+# gallery-dl writes tags as "name ♀" / "name ♂"; config files and the site use "female:name" / "male:name"
+_GENDER_SUFFIX_RE = re.compile(r"^(.*?)\s*([♀♂])$")
+
+# Reject reasons (the `reason` of a Rejection)
+GALLERY_ERROR = "gallery_error"
+LANGUAGE = "language"
+EXCLUDED_TAG = "excluded_tag"
+EXCLUDED_ARTIST = "excluded_artist"
+NOT_INCLUDED = "not_included"
+
+Rejection = collections.namedtuple("Rejection", ("reason", "value"))
+
+
+def normalize_tag(tag):
+    """'Big_Breasts ♀' and 'female:big breasts' -> 'female:big breasts'"""
+    tag = " ".join(str(tag).replace("_", " ").lower().split())
+    match = _GENDER_SUFFIX_RE.match(tag)
+    if match:
+        tag = ("female:" if match.group(2) == "♀" else "male:") + match.group(1)
+    return tag
+
+
+def normalize_name(name):
+    """Artist / language names: case and underscores do not matter"""
+    return " ".join(str(name).replace("_", " ").lower().split())
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+
+class PatternSet:
+    """
+    Exact names in a set plus "prefix*" wildcards (e.g. "male:*") in a
+    character trie, so a lookup costs the length of the name, however many
+    rules there are.
+    """
+    _END = ""
+
+    def __init__(self, patterns=(), normalize=normalize_name):
+        self.normalize = normalize
+        self.exact = set()
+        self.trie = {}
+        self.patterns = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        wildcard = pattern.strip().endswith("*")
+        pattern = self.normalize(pattern.strip().rstrip("*")) if wildcard else self.normalize(pattern)
+        if "*" in pattern:
+            raise ValueError(f"Wildcards are only allowed at the end of a rule: {pattern!r}")
+        self.patterns.append(pattern + "*" if wildcard else pattern)
+        if not wildcard:
+            self.exact.add(pattern)
+            return
+        node = self.trie
+        for char in pattern:
+            node = node.setdefault(char, {})
+        node[self._END] = pattern + "*"
+
+    def match(self, name):
+        """The rule matching an already normalized name, or None"""
+        if name in self.exact:
+            return name
+        node = self.trie
+        for char in name:
+            if self._END in node:
+                return node[self._END]
+            node = node.get(char)
+            if node is None:
+                return None
+        return node.get(self._END)
+
+    def first_match(self, names):
+        for name in names:
+            rule = self.match(name)
+            if rule is not None:
+                return name, rule
+        return None
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def __len__(self):
+        return len(self.patterns)
+
+
+class FilterRules:
+    """
+    The gallery filter, compiled once from config.json:
+
+        "exclude_tags": ["male:yaoi", "male:*"],       excluded tags (namespace wildcards allowed)
+        "exclude_artists": ["some artist"],
+        "include_tags": [], "include_artists": [],     if set, a gallery needs one of them
+        "language_exceptions": {                        galleries in another language that are kept anyway
+            "english": {"tags": ["female:*"], "artists": ["some artist"]}
+        }
+
+    Tags are compared in one form ("female:name") whether they come from
+    gallery-dl ("name ♀"), the gallery header or the config. Galleries
+    without a language pass the language rule. check() returns a Rejection
+    instead of printing, and counts them for the end-of-run summary.
+    """
+    def __init__(self, language=None, exclude_tags=(), exclude_artists=(), include_tags=(), include_artists=(),
+                 language_exceptions=None):
+        self.language = normalize_name(language) if language else None
+        self.exclude_tags = PatternSet(exclude_tags, normalize_tag)
+        self.exclude_artists = PatternSet(exclude_artists)
+        self.include_tags = PatternSet(include_tags, normalize_tag)
+        self.include_artists = PatternSet(include_artists)
+        self.language_exceptions = {}
+        for lang, rules in (language_exceptions or {}).items():
+            self.language_exceptions[normalize_name(lang)] = (PatternSet(rules.get("tags", ()), normalize_tag),
+                                                              PatternSet(rules.get("artists", ())))
+        # Fingerprint for the negative cache: cached rejections are only valid under the same rules
+        exceptions = {lang: [tags.patterns, artists.patterns] for lang, (tags, artists) in self.language_exceptions.items()}
+        self.key = filter_key(self.language or "", self.exclude_tags.patterns, self.exclude_artists.patterns,
+                              self.include_tags.patterns, self.include_artists.patterns, exceptions)
+        self.stats = collections.Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, language=None, exclude_tags=None, exclude_artists=None):
+        """Rules of config.json; the arguments (command line) replace the config's values when given."""
+        return cls(
+            language,
+            config.get("exclude_tags", []) if exclude_tags is None else exclude_tags,
+            config.get("exclude_artists", []) if exclude_artists is None else exclude_artists,
+            config.get("include_tags", []),
+            config.get("include_artists", []),
+            config.get("language_exceptions", {}),
+        )
+
+    def index_excludes(self):
+        """(tags, artists) that can be looked up in the site's index files: the rules without wildcards"""
+        return sorted(self.exclude_tags.exact), sorted(self.exclude_artists.exact)
+
+    def check(self, record):
+        """None if the gallery passes, else Rejection(reason, value)"""
+        rejection = self._check(record)
+        if rejection is not None:
+            with self._lock:
+                # Error messages name the gallery; count them as one kind
+                self.stats[rejection._replace(value=None) if rejection.reason == GALLERY_ERROR else rejection] += 1
+        return rejection
+
+    def _check(self, record):
+        if not record:
+            return Rejection(GALLERY_ERROR, "no metadata")
+        if record.error:
+            return Rejection(GALLERY_ERROR, record.error)
+
+        tags = [normalize_tag(tag) for tag in _as_list(record.tags)]
+        artists = [normalize_name(artist) for artist in _as_list(record.artist)]
+
+        language = normalize_name(record.language) if record.language else None
+        if self.language and language and language != self.language:
+            exception = self.language_exceptions.get(language)
+            if exception is None or not (exception[0].first_match(tags) or exception[1].first_match(artists)):
+                return Rejection(LANGUAGE, language)
+
+        match = self.exclude_artists.first_match(artists)
+        if match:
+            return Rejection(EXCLUDED_ARTIST, match[1])
+        match = self.exclude_tags.first_match(tags)
+        if match:
+            return Rejection(EXCLUDED_TAG, match[1])
+
+        if (self.include_tags or self.include_artists) and not (
+                self.include_tags.first_match(tags) or self.include_artists.first_match(artists)):
+            return Rejection(NOT_INCLUDED, None)
+        return None
+
+    def top_rejections(self, count=10):
+        """[(Rejection, galleries), ...], most frequent first"""
+        with self._lock:
+            return self.stats.most_common(count)
+
+    def describe(self):
+        parts = [f"language {self.language or 'any'}"]
+        for name in ("exclude_tags", "exclude_artists", "include_tags", "include_artists"):
+            if getattr(self, name):
+                parts.append(f"{len(getattr(self, name))} {name}")
+        if self.language_exceptions:
+            parts.append(f"exceptions for {', '.join(sorted(self.language_exceptions))}")
+        return ", ".join(parts)
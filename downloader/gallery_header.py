@@ -0,0 +1,95 @@
+import html.parser
+import urllib.parse
+
+from downloader.gallery_record import GalleryRecord
+from downloader.pages import fetch_page
+
+# Small HTML summary of a gallery (title, artists, type, language, tags), without the page list
+GALLERYBLOCK_URL = "https://ltn.gold-usergeneratedcontent.net/galleryblock/{}.html"
+
+# First path segment of a link -> GalleryRecord field
+_LINK_FIELDS = {"artist": "artist", "group": "group", "series": "parody", "character": "characters",
+                "tag": "tags", "type": "type"}
+
+
+class _GalleryBlockParser(html.parser.HTMLParser):
+    """Collects the gallery links of a galleryblock: /artist/<name>-all.html, /tag/<tag>-all.html, ..."""
+    def __init__(self):
+        super().__init__()
+        self.links = []
+        self.title = None
+        self._in_title = False
+        self._title_parts = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "h1":
+            self._in_title = True
+        elif tag == "a" and attrs.get("href"):
+            self.links.append(attrs["href"])
+
+    def handle_endtag(self, tag):
+        if tag == "h1" and self._in_title:
+            self._in_title = False
+            self.title = " ".join("".join(self._title_parts).split()) or None
+
+    def handle_data(self, data):
+        if self._in_title:
+            self._title_parts.append(data)
+
+
+def _gallery_dl_tag(tag):
+    """'female:big breasts' -> 'big breasts ♀', the form gallery-dl uses in -j output"""
+    namespace, _, name = tag.partition(":")
+    if namespace == "female" and name:
+        return f"{name} ♀"
+    if namespace == "male" and name:
+        return f"{name} ♂"
+    return tag
+
+
+def parse_galleryblock(text, gallery_id):
+    """GalleryRecord with the header fields of a galleryblock page, or None if it has none."""
+    parser = _GalleryBlockParser()
+    parser.feed(text)
+    parser.close()
+
+    fields = {"artist": [], "group": [], "parody": [], "characters": [], "tags": []}
+    language = None
+    for href in parser.links:
+        path = urllib.parse.unquote(urllib.parse.urlsplit(href).path).strip("/")
+        area, _, name = path.rpartition("/")
+        name = name[:-len(".html")] if name.endswith(".html") else name
+        if not area and name.startswith("index-"):
+            # /index-japanese.html
+            language = name[len("index-"):]
+            continue
+        field = _LINK_FIELDS.get(area)
+        if field is None or not name.endswith("-all"):
+            continue
+        value = name[:-len("-all")]
+        if field == "tags":
+            value = _gallery_dl_tag(value)
+        if field == "type":
+            fields["type"] = value
+        elif value not in fields[field]:
+            fields[field].append(value)
+
+    if parser.title is None and not language and not any(fields.values()):
+        return None
+    return GalleryRecord(gallery_id=gallery_id, title=parser.title, language=language, **fields)
+
+
+def fetch_header(gallery_id, url_template=GALLERYBLOCK_URL, **fetch_options):
+    """
+    Fetches the header of a gallery (no page list) for filtering.
+    Returns a GalleryRecord, or None if the header could not be read and the
+    full metadata should decide (missing galleries included: gallery-dl's
+    error message is what gets cached).
+    fetch_options: passed to pages.fetch_page (timeout, retries, sleep, observer).
+    """
+    try:
+        data = fetch_page(url_template.format(gallery_id), gallery_id, **fetch_options)
+    except (OSError, ValueError):
+        return None
+    return parse_galleryblock(data.decode("utf-8", "replace"), gallery_id)
@@ -0,0 +1,173 @@
+import codecs
+import json
+
+
+class GalleryRecord:
+    """
+    One gallery from gallery-dl -j output: the gallery-level fields that are
+    used (filtering, CBZ names, the organizer) and the page list as
+    (url, filename, size) tuples. The per-page dicts of the raw output are
+    not kept. `error` holds gallery-dl's message when it returned
+    [-1, {...}] instead of a gallery.
+    Filenames follow gallery-dl's default for galleries
+    ("{category}_{gallery_id}_{num:>03}.{extension}"), so CBZ entries are
+    named the same whether pages were downloaded by gallery-dl or by us.
+    """
+    __slots__ = ("gallery_id", "title", "title_jpn", "artist", "group", "parody", "characters", "tags",
+                 "language", "type", "count", "date", "category", "pages", "error")
+
+    # Fields taken from the gallery-level dict as they are
+    HEADER_FIELDS = ("gallery_id", "title", "title_jpn", "artist", "group", "characters", "tags",
+                     "language", "type", "count", "category")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+        if self.pages is None:
+            self.pages = []
+
+    def __repr__(self):
+        return f"<GalleryRecord {self.gallery_id} {self.title!r}, {len(self.pages)} pages>"
+
+    @property
+    def has_header(self):
+        return self.gallery_id is not None or self.title is not None or self.error is not None
+
+    @property
+    def page_count(self):
+        return len(self.pages) or self.count
+
+    def add_header(self, info):
+        for name in self.HEADER_FIELDS:
+            setattr(self, name, info.get(name))
+        # 'series' is the parody field of other extractors
+        self.parody = info.get("parody") or info.get("series")
+        date = info.get("date")
+        # The in-process backend yields datetimes where -j prints strings
+        self.date = date if date is None or isinstance(date, str) else str(date)
+
+    def add_page(self, url, info):
+        filename = "{}_{}_{:>03}.{}".format(
+            info.get("category", "hitomi"),
+            info.get("gallery_id", self.gallery_id),
+            info.get("num", len(self.pages) + 1),
+            info.get("extension", "webp"))
+        size = info.get("size") or info.get("filesize")
+        self.pages.append((url, filename, size if isinstance(size, int) and size > 0 else None))
+
+    def add_message(self, message):
+        """Adds one -j message: [-1, {...}] error, [2, {...}] directory, [3, url, {...}] page."""
+        if not (isinstance(message, (list, tuple)) and len(message) >= 2 and isinstance(message[-1], dict)):
+            return
+        info = message[-1]
+        if message[0] == -1:
+            self.error = info.get("message") or info.get("error") or "Unknown error"
+            return
+        # The first dict is the gallery-level one (pages repeat its fields)
+        if not self.has_header:
+            self.add_header(info)
+        if message[0] == 3 and len(message) >= 3:
+            self.add_page(message[1], info)
+
+    def entries(self):
+        """[(url, filename), ...] of the pages"""
+        return [(url, filename) for url, filename, _ in self.pages]
+
+    def sizes(self):
+        """Size in bytes of each page, None where the metadata has none"""
+        return [size for _, _, size in self.pages]
+
+    @classmethod
+    def from_error(cls, message):
+        return cls(error=message)
+
+    @classmethod
+    def from_messages(cls, messages):
+        """Record of a list of -j messages, or None if there is none."""
+        record = cls()
+        for message in messages or ():
+            record.add_message(message)
+        return record if record.has_header else None
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+        data["pages"] = [list(page) for page in self.pages]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls(**data)
+        record.pages = [tuple(page) for page in record.pages]
+        return record
+
+    @classmethod
+    def from_data(cls, data):
+        """Record of a to_dict() dict, or of a raw -j message list (older cache entries)."""
+        if isinstance(data, dict):
+            return cls.from_dict(data)
+        return cls.from_messages(data)
+
+
+def iter_messages(stream, chunk_size=65536):
+    """
+    Yields the messages of gallery-dl -j output while it is being read from
+    `stream` (text or binary). Handles the single JSON list printed by current
+    versions and the one message per line of older ones.
+    """
+    read = getattr(stream, "read1", stream.read)
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    outer = None
+    eof = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer):
+            if outer is None and buffer[pos] == "[":
+                # "[[" opens the outer list, "[2" is a message of the line format
+                rest = buffer[pos + 1:].lstrip()
+                if rest or eof:
+                    outer = rest.startswith("[")
+                    if outer:
+                        pos += 1
+                        continue
+            elif outer is None:
+                outer = False
+            if outer is not None:
+                if outer and buffer[pos] == "]":
+                    return
+                try:
+                    message, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # Incomplete message: read on
+                    if eof:
+                        raise
+                else:
+                    yield message
+                    continue
+        elif eof:
+            return
+
+        chunk = read(chunk_size)
+        # From the raw read: part of a multi-byte character decodes to ""
+        eof = not chunk
+        if isinstance(chunk, bytes):
+            chunk = text_decoder.decode(chunk, final=eof)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def read_record(stream, header_only=False):
+    """
+    Builds a GalleryRecord from -j output as it is read from `stream`; returns
+    None if the output has no gallery. header_only: stop after the gallery-level
+    record (no page list).
+    """
+    record = GalleryRecord()
+    for message in iter_messages(stream):
+        record.add_message(message)
+        if header_only and record.has_header:
+            break
+    return record if record.has_header else None
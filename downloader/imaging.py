@@ -0,0 +1,206 @@
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from PIL import Image, features
+
+# Page limits
+MAX_WIDTH = 1920
+MAX_HEIGHT = 1920
+JPEG_QUALITY = 90
+
+# Fast downscale: cheap reduction stops at this multiple of the target size,
+# the rest is done with LANCZOS. Higher is closer to a full LANCZOS resize.
+DOWNSCALE_OVERSAMPLE = 1.5
+
+POOL_KINDS = ("thread", "process")
+
+# codec -> (file extension, Pillow format)
+OUTPUT_CODECS = {
+    "jpeg": (".jpg", "JPEG"),
+    "webp": (".webp", "WEBP"),
+    "avif": (".avif", "AVIF"),
+}
+
+
+class OutputFormat:
+    """
+    Codec and encoder settings for transcoded pages.
+    quality: 0-100 for every codec.
+    threads: AVIF encoder threads (0 = Pillow's default); JPEG and WebP
+    encode on one thread, pages are spread over the image pool instead.
+    speed: WebP method (0-6, higher = smaller/slower) or AVIF speed (0-10,
+    lower = smaller/slower); None keeps Pillow's default.
+    Plain attributes only, so it can be sent to a process pool.
+    """
+    def __init__(self, codec="jpeg", quality=JPEG_QUALITY, threads=0, speed=None):
+        codec = codec.lower()
+        if codec == "jpg":
+            codec = "jpeg"
+        if codec not in OUTPUT_CODECS:
+            raise ValueError(f"Unknown output codec '{codec}' (expected one of {', '.join(OUTPUT_CODECS)})")
+        if codec != "jpeg" and not features.check(codec):
+            raise ValueError(f"This Pillow build has no {codec.upper()} support")
+        self.codec = codec
+        self.quality = quality
+        self.threads = threads
+        self.speed = speed
+        self.extension, self.format = OUTPUT_CODECS[codec]
+
+    def __repr__(self):
+        return f"OutputFormat({self.codec!r}, quality={self.quality})"
+
+    def save(self, img, dest):
+        options = {"quality": self.quality}
+        if self.codec == "webp" and self.speed is not None:
+            options["method"] = self.speed
+        elif self.codec == "avif":
+            if self.speed is not None:
+                options["speed"] = self.speed
+            if self.threads:
+                options["max_threads"] = self.threads
+        img.save(dest, self.format, **options)
+
+
+JPEG_OUTPUT = OutputFormat()
+
+
+def timed(func, *args, **kwargs):
+    """Runs func and returns (result, seconds); module level so pool workers can run it."""
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+def create_image_pool(workers=None, kind="thread"):
+    """
+    Creates the pool pages are processed in.
+    "thread" is enough for most pages because Pillow releases the GIL while
+    decoding, resizing and encoding; "process" avoids the GIL completely.
+    """
+    workers = workers or os.cpu_count() or 2
+    if kind == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    if kind == "thread":
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+    raise ValueError(f"Unknown image pool '{kind}' (expected one of {', '.join(POOL_KINDS)})")
+
+
+def is_compliant(img, output=JPEG_OUTPUT):
+    """
+    True if the page can be stored as-is: already in the output format, RGB/grayscale,
+    within the size limit. Only uses header fields (format, size, mode), so nothing is decoded.
+    """
+    width, height = img.size
+    return (img.format == output.format
+            and img.mode in ("RGB", "L")
+            and width <= MAX_WIDTH
+            and height <= MAX_HEIGHT)
+
+
+def target_size(size):
+    """Returns the size after applying the 1920x1920 limit, or None if no resize is needed."""
+    original_w, original_h = size
+    ratio = min(MAX_WIDTH / original_w, MAX_HEIGHT / original_h)
+    if ratio >= 1.0:
+        return None
+    return int(original_w * ratio), int(original_h * ratio)
+
+
+def draft_for_downscale(img, size, oversample=DOWNSCALE_OVERSAMPLE):
+    """
+    Lets the JPEG decoder scale by 1/2, 1/4 or 1/8 in the DCT domain,
+    so an oversized scan is never decoded at full resolution.
+    Must be called before the image is loaded; no-op for other formats.
+    """
+    if not oversample or img.format != "JPEG":
+        return
+    img.draft(img.mode, (int(size[0] * oversample), int(size[1] * oversample)))
+
+
+def downscale(img, size, oversample=DOWNSCALE_OVERSAMPLE):
+    """
+    Resizes to `size`. With oversample set, Pillow first shrinks with integer
+    reduce() down to `oversample` times the target and only runs LANCZOS on
+    what is left; without it every source pixel goes through LANCZOS.
+    """
+    if not oversample:
+        return img.resize(size, Image.Resampling.LANCZOS)
+    return img.resize(size, Image.Resampling.LANCZOS, reducing_gap=oversample)
+
+
+def convert_page(img, dest, passthrough=True, oversample=DOWNSCALE_OVERSAMPLE, output=JPEG_OUTPUT):
+    """
+    Writes `img` to `dest` (path or file object) in the output format within the size limit.
+    Returns "passthrough" without writing anything if the page is already compliant,
+    "transcoded" otherwise.
+    """
+    if passthrough and is_compliant(img, output):
+        return "passthrough"
+
+    # Resize logic: max 1920x1920 (target computed from the full size)
+    new_size = target_size(img.size)
+    if new_size:
+        draft_for_downscale(img, new_size, oversample)
+
+    # Convert to RGB if necessary (e.g. for PNG with transparency being saved as JPG).
+    # WebP/AVIF take RGB or grayscale only (no CMYK etc.)
+    if img.mode in ("RGBA", "P") or (output.codec != "jpeg" and img.mode not in ("RGB", "L")):
+        img = img.convert("RGB")
+
+    # Only resize if larger
+    if new_size:
+        img = downscale(img, new_size, oversample)
+
+    output.save(img, dest)
+    return "transcoded"
+
+
+def process_page(filepath, passthrough=True, oversample=DOWNSCALE_OVERSAMPLE, output=JPEG_OUTPUT):
+    """
+    Resizes and converts a single page file to the output format (JPEG by default).
+    oversample: see downscale(); 0/None disables the fast downscale path.
+    Returns (new_filename, action) where action is "passthrough" or "transcoded",
+    or None if the file is not an image.
+    Module level (and side effect free apart from the file itself) so it
+    can run in a process pool.
+    """
+    root, filename = os.path.split(filepath)
+    new_filename = os.path.splitext(filename)[0] + output.extension
+    new_filepath = os.path.join(root, new_filename)
+
+    try:
+        with Image.open(filepath) as img:
+            action = convert_page(img, new_filepath, passthrough, oversample, output)
+
+        if filename != new_filename:
+            if action == "passthrough":
+                # Keep the bytes, only normalize the extension (.jpeg -> .jpg)
+                os.replace(filepath, new_filepath)
+            else:
+                # Remove the original to avoid duplicates in zip
+                os.remove(filepath)
+        return new_filename, action
+
+    except Exception:
+        # Not an image or error, skip
+        return None
+
+
+def process_page_data(filename, data, passthrough=True, oversample=DOWNSCALE_OVERSAMPLE, output=JPEG_OUTPUT):
+    """
+    In-memory variant of process_page().
+    Returns (new_filename, new_data, action), or None if `data` is not an image.
+    """
+    new_filename = os.path.splitext(filename)[0] + output.extension
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            buffer = io.BytesIO()
+            action = convert_page(img, buffer, passthrough, oversample, output)
+
+        if action == "passthrough":
+            return new_filename, data, action
+        return new_filename, buffer.getvalue(), action
+
+    except Exception:
+        return None
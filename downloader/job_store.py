@@ -0,0 +1,170 @@
+import sqlite3
+import json
+import time
+
+JOBS_DB_NAME = "hitomi_dl_jobs.db"
+
+# pending -> fetched -> downloading -> packed, or filtered / skipped / failed on the way
+STATES = ("pending", "fetched", "filtered", "skipped", "downloading", "packed", "failed")
+# States a resumed run does not process again (failed IDs are retried with --retry_failed)
+SETTLED_STATES = ("filtered", "skipped", "packed", "failed")
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF = 600
+DEFAULT_MAX_BACKOFF = 86400
+
+
+class JobStore:
+    """
+    SQLite table with the state of every gallery ID a run has started, so a
+    run that dies can be resumed and its failures retried or reported.
+    Failed IDs become due for a retry after an exponential backoff
+    (`backoff` seconds, doubled per attempt up to `max_backoff`) and are
+    given up after `max_attempts` attempts.
+    """
+    def __init__(self, db_path=None, max_attempts=DEFAULT_MAX_ATTEMPTS, backoff=DEFAULT_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF):
+        self.db_path = db_path or JOBS_DB_NAME
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.init_db()
+
+    def get_connection(self):
+        # One connection per call keeps the store safe to use from worker threads
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        # A state change per stage: durable against process crashes, no fsync per commit
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def init_db(self):
+        """Initialize the database schema."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # reason: skip reason or error class; retry_at: earliest retry of a failed ID
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            stage TEXT,
+            reason TEXT,
+            message TEXT,
+            updated_at REAL,
+            retry_at REAL
+        )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state, id)")
+        conn.commit()
+        conn.close()
+
+    def start(self, gallery_id):
+        """Records a new attempt; the ID is pending until it reaches another state."""
+        conn = self.get_connection()
+        conn.execute('''
+        INSERT INTO jobs (id, state, attempts, updated_at) VALUES (?, 'pending', 1, ?)
+        ON CONFLICT(id) DO UPDATE SET state = 'pending', attempts = attempts + 1,
+            stage = NULL, reason = NULL, message = NULL, updated_at = excluded.updated_at, retry_at = NULL
+        ''', (gallery_id, time.time()))
+        conn.commit()
+        conn.close()
+
+    def set_state(self, gallery_id, state, reason=None, message=None):
+        if state not in STATES:
+            raise ValueError(f"Unknown job state: {state}")
+        conn = self.get_connection()
+        conn.execute("UPDATE jobs SET state = ?, reason = ?, message = ?, updated_at = ? WHERE id = ?",
+                     (state, reason, message, time.time(), gallery_id))
+        conn.commit()
+        conn.close()
+
+    def fail(self, gallery_id, stage, error, message=None):
+        """Marks the ID as failed in `stage` with error class `error`, due for a retry after the backoff."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT attempts FROM jobs WHERE id = ?", (gallery_id,))
+        row = cursor.fetchone()
+        attempts = row[0] if row else 1
+        now = time.time()
+        delay = min(self.max_backoff, self.backoff * 2 ** max(0, attempts - 1))
+        cursor.execute('''
+        INSERT INTO jobs (id, state, attempts, stage, reason, message, updated_at, retry_at)
+        VALUES (?, 'failed', ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET state = 'failed', stage = excluded.stage, reason = excluded.reason,
+            message = excluded.message, updated_at = excluded.updated_at, retry_at = excluded.retry_at
+        ''', (gallery_id, attempts, stage, error, message, now, now + delay))
+        conn.commit()
+        conn.close()
+
+    def get_settled_ids(self, start_id, end_id):
+        """IDs of [start_id, end_id] a resumed run skips (PendingIds lookup)."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT id FROM jobs WHERE id BETWEEN ? AND ? AND state IN ({','.join('?' * len(SETTLED_STATES))})",
+                       (start_id, end_id) + SETTLED_STATES)
+        ids = {row[0] for row in cursor.fetchall()}
+        conn.close()
+        return ids
+
+    def get_retry_ids(self, start_id, end_id, now=None):
+        """Failed IDs of [start_id, end_id] whose backoff has expired and that have attempts left."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT id FROM jobs WHERE state = 'failed' AND id BETWEEN ? AND ?
+            AND attempts < ? AND (retry_at IS NULL OR retry_at <= ?)
+        ORDER BY id
+        ''', (start_id, end_id, self.max_attempts, time.time() if now is None else now))
+        ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return ids
+
+    def count_states(self, start_id, end_id):
+        """{state: count} for the IDs of [start_id, end_id]; 'gave_up' counts failed IDs without attempts left."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT state, COUNT(*) FROM jobs WHERE id BETWEEN ? AND ? GROUP BY state",
+                       (start_id, end_id))
+        counts = dict(cursor.fetchall())
+        cursor.execute("SELECT COUNT(*) FROM jobs WHERE state = 'failed' AND id BETWEEN ? AND ? AND attempts >= ?",
+                       (start_id, end_id, self.max_attempts))
+        gave_up = cursor.fetchone()[0]
+        conn.close()
+        if gave_up:
+            counts["gave_up"] = gave_up
+        return counts
+
+    def iter_jobs(self, start_id, end_id, states=None):
+        """Yields one dict per recorded ID of [start_id, end_id], in ID order."""
+        query = "SELECT id, state, attempts, stage, reason, message, updated_at, retry_at FROM jobs WHERE id BETWEEN ? AND ?"
+        params = [start_id, end_id]
+        if states:
+            query += f" AND state IN ({','.join('?' * len(states))})"
+            params.extend(states)
+        conn = self.get_connection()
+        try:
+            for gid, state, attempts, stage, reason, message, updated_at, retry_at in conn.execute(query + " ORDER BY id", params):
+                yield {
+                    "id": gid,
+                    "state": state,
+                    "attempts": attempts,
+                    "stage": stage,
+                    "reason": reason,
+                    "message": message,
+                    "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(updated_at)) if updated_at else None,
+                    "retry_at": (time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(retry_at))
+                                 if state == "failed" and retry_at and attempts < self.max_attempts else None),
+                }
+        finally:
+            conn.close()
+
+    def write_report(self, path, start_id, end_id, states=None):
+        """Writes iter_jobs() as JSON Lines; returns the number of lines."""
+        count = 0
+        with open(path, "w", encoding="utf-8") as f:
+            for job in self.iter_jobs(start_id, end_id, states):
+                f.write(json.dumps(job, ensure_ascii=False) + "\n")
+                count += 1
+        return count
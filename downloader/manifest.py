@@ -0,0 +1,116 @@
+import hashlib
+import os
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from downloader.archive import is_page
+
+# Results of verify_archive
+OK = "ok"
+UNCHANGED = "unchanged"
+MISSING = "missing"
+CHANGED = "changed"
+CORRUPT = "corrupt"
+
+HASH_CHUNK = 1024 * 1024
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def archive_entries(path):
+    """[[name, crc, size], ...] from the ZIP central directory (no data is read)"""
+    with zipfile.ZipFile(path) as zf:
+        return [[info.filename, info.CRC, info.file_size] for info in zf.infolist()]
+
+
+def build_manifest(path, entries=None):
+    """
+    Manifest of a finished CBZ: page count, size, mtime, per-entry CRCs and
+    the SHA-256 of the whole file. entries: the writer's [(name, crc, size)],
+    read from the archive when None.
+    """
+    st = os.stat(path)
+    entries = [list(entry) for entry in entries] if entries is not None else archive_entries(path)
+    return {
+        "path": os.path.abspath(path),
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        # Image entries only (not ComicInfo.xml and the like)
+        "pages": sum(1 for name, _, _ in entries if is_page(name)),
+        "sha256": file_sha256(path),
+        "entries": entries,
+    }
+
+
+def _check_entries(path, manifest):
+    """
+    Reads every entry of the manifest back from the archive. Returns
+    (problem, extra): why the archive is damaged (None if the entries are
+    intact) and the number of entries added since it was written.
+    """
+    try:
+        with zipfile.ZipFile(path) as zf:
+            entries = {info.filename: info for info in zf.infolist()}
+            for name, crc, size in manifest["entries"]:
+                info = entries.get(name)
+                if info is None:
+                    return f"entry {name} is missing", 0
+                if info.CRC != crc or info.file_size != size:
+                    return f"entry {name} differs from the manifest", 0
+                # Reading to the end checks the data against the stored CRC
+                with zf.open(info) as f:
+                    while f.read(HASH_CHUNK):
+                        pass
+            return None, len(entries) - len(manifest["entries"])
+    except (zipfile.BadZipFile, zlib.error, EOFError, OSError) as e:
+        return f"unreadable: {e}", 0
+
+
+def verify_archive(manifest, path=None, previous=None):
+    """
+    Checks one CBZ against its manifest. Returns (result, detail, (size, mtime)).
+    previous: (size, mtime) of the last good pass; the file is skipped
+    (UNCHANGED) when it still matches them.
+    """
+    path = path or manifest["path"]
+    try:
+        st = os.stat(path)
+    except OSError:
+        return MISSING, path, None
+    stamp = (st.st_size, st.st_mtime)
+    if previous is not None and tuple(previous) == stamp:
+        return UNCHANGED, None, stamp
+
+    try:
+        if st.st_size == manifest["size"] and file_sha256(path) == manifest["sha256"]:
+            return OK, None, stamp
+    except OSError as e:
+        return CORRUPT, f"unreadable: {e}", stamp
+    # Tell a damaged archive from one that was rewritten (e.g. entries added) with its pages intact
+    problem, extra = _check_entries(path, manifest)
+    if problem:
+        return CORRUPT, problem, stamp
+    return CHANGED, f"size {manifest['size']} -> {st.st_size}, {extra} entries added, pages intact", stamp
+
+
+def verify_library(rows, workers=4, full=False):
+    """
+    Verifies the manifests in parallel (reading is I/O bound: hashlib and zlib
+    release the GIL). rows: [(gallery_id, manifest, path, previous_stamp)].
+    full: re-hash every file, even if size and mtime are unchanged.
+    Yields (gallery_id, path, result, detail, stamp) in the order of rows.
+    """
+    def check(row):
+        gallery_id, manifest, path, previous = row
+        result, detail, stamp = verify_archive(manifest, path, None if full else previous)
+        return gallery_id, path or manifest["path"], result, detail, stamp
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="verify") as pool:
+        yield from pool.map(check, rows)
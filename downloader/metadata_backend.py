@@ -0,0 +1,150 @@
+import sys
+import os
+import subprocess
+import threading
+
+from downloader.gallery_record import GalleryRecord, read_record
+
+# Command used by the subprocess backend (one interpreter per gallery)
+GALLERY_DL_CMD = [sys.executable, "-m", "gallery_dl"]
+GALLERY_URL = "https://hitomi.la/galleries/{}.html"
+
+BACKEND_MODES = ("auto", "inprocess", "subprocess")
+
+
+class SubprocessBackend:
+    """
+    Runs `gallery_dl -j` in a new interpreter for every gallery.
+    Slow (interpreter startup + extractor import per ID), but isolated.
+    """
+    name = "subprocess"
+
+    def __init__(self, config_path=None, cmd=None):
+        self.config_path = config_path
+        self.cmd = cmd or GALLERY_DL_CMD
+
+    def fetch(self, gallery_id, header_only=False):
+        """
+        Returns a GalleryRecord or None on failure. The output is parsed while
+        gallery-dl prints it; header_only stops (and ends gallery-dl) after the
+        gallery-level record.
+        """
+        url = GALLERY_URL.format(gallery_id)
+        cmd = self.cmd + ["-j", url]
+        if self.config_path and os.path.exists(self.config_path):
+            cmd += ["--config", self.config_path]
+
+        try:
+            with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+                try:
+                    record = read_record(proc.stdout, header_only=header_only)
+                finally:
+                    if header_only and proc.poll() is None:
+                        proc.kill()
+                returncode = proc.wait()
+
+            if returncode and not (header_only and record is not None):
+                print(f"Error fetching metadata for ID {gallery_id}: gallery-dl exited with status {returncode}")
+                return None
+            return record
+
+        except Exception as e:
+            print(f"Unexpected error for ID {gallery_id}: {e}")
+            return None
+
+
+class InProcessBackend:
+    """
+    Imports gallery-dl once and runs its DataJob inside this interpreter.
+    Produces the same records as the subprocess backend.
+    """
+    name = "inprocess"
+
+    _config_lock = threading.Lock()
+    _loaded_configs = set()
+
+    def __init__(self, config_path=None):
+        # Raises ImportError if gallery-dl is not installed;
+        # create_backend() uses that to fall back to the subprocess backend.
+        from gallery_dl import config as gdl_config
+        from gallery_dl import exception as gdl_exception
+        from gallery_dl import job as gdl_job
+
+        class HeaderJob(gdl_job.DataJob):
+            """DataJob that stops the extractor at the gallery-level (Directory) message"""
+            def handle_directory(self, kwdict):
+                super().handle_directory(kwdict)
+                raise gdl_exception.StopExtraction()
+
+        self._config = gdl_config
+        self._job = gdl_job
+        self._header_job = HeaderJob
+        self.config_path = config_path
+        self._load_config()
+
+    def _load_config(self):
+        # gallery-dl's config is process global, so load every file only once
+        with self._config_lock:
+            if None not in self._loaded_configs:
+                # Same default config files the CLI would read
+                self._config.load()
+                self._loaded_configs.add(None)
+
+            path = self.config_path
+            if path and path not in self._loaded_configs and os.path.exists(path):
+                self._config.load([path])
+                self._loaded_configs.add(path)
+
+    def fetch(self, gallery_id, header_only=False):
+        """Returns a GalleryRecord or None on failure (header_only: no page list)."""
+        url = GALLERY_URL.format(gallery_id)
+        try:
+            # header_only: no per-page messages are built (DataJob.run() ends on StopExtraction)
+            job = (self._header_job if header_only else self._job.DataJob)(url, file=None)
+            job.run()
+            return GalleryRecord.from_messages(job.data)
+
+        except Exception as e:
+            print(f"Error fetching metadata for ID {gallery_id}: {e}")
+            return None
+
+
+def create_backend(mode="auto", config_path=None):
+    """
+    Creates a metadata backend.
+    mode: "inprocess", "subprocess" or "auto" (in-process if gallery-dl
+          can be imported, subprocess otherwise).
+    """
+    if mode not in BACKEND_MODES:
+        raise ValueError(f"Unknown metadata backend '{mode}' (expected one of {', '.join(BACKEND_MODES)})")
+
+    if mode == "subprocess":
+        return SubprocessBackend(config_path)
+
+    try:
+        return InProcessBackend(config_path)
+    except ImportError as e:
+        if mode == "inprocess":
+            raise
+        print(f"gallery-dl could not be imported in-process ({e}), falling back to subprocess backend.")
+        return SubprocessBackend(config_path)
+
+
+# Shared backend for hitomi_dl and the organizer
+_default_backend = None
+_default_lock = threading.Lock()
+
+
+def set_default_backend(backend):
+    global _default_backend
+    with _default_lock:
+        _default_backend = backend
+
+
+def get_default_backend():
+    """Returns the shared backend, creating an "auto" one on first use."""
+    global _default_backend
+    with _default_lock:
+        if _default_backend is None:
+            _default_backend = create_backend("auto")
+        return _default_backend
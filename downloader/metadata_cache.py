@@ -0,0 +1,179 @@
+import sqlite3
+import json
+import time
+import zlib
+import hashlib
+
+from downloader.gallery_record import GalleryRecord
+
+CACHE_DB_NAME = "metadata_cache.db"
+
+# Default time-to-live values (seconds)
+DEFAULT_TTL = 30 * 86400
+DEFAULT_ERROR_TTL = 24 * 3600
+DEFAULT_FILTERED_TTL = 30 * 86400
+
+
+def filter_key(*rules):
+    """
+    Builds a short fingerprint of the filter settings.
+    Cached rejections are only trusted while the fingerprint matches.
+    """
+    normalized = [sorted(r) if isinstance(r, (list, tuple, set)) else r for r in rules]
+    raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class MetadataCache:
+    """
+    SQLite cache of GalleryRecords (gallery-dl -j output) keyed by gallery ID.
+    Errors and filter rejections are kept in separate tables with their own TTL.
+    """
+    def __init__(self, db_path=None, ttl=DEFAULT_TTL, error_ttl=DEFAULT_ERROR_TTL, filtered_ttl=DEFAULT_FILTERED_TTL):
+        self.db_path = db_path or CACHE_DB_NAME
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.filtered_ttl = filtered_ttl
+
+        self.init_db()
+
+    def get_connection(self):
+        # One connection per call keeps the cache safe to use from worker threads
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def init_db(self):
+        """Initialize the database schema."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        # WAL lets readers proceed while a worker writes
+        cursor.execute("PRAGMA journal_mode=WAL")
+
+        # Raw gallery-dl output (zlib compressed JSON)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metadata (
+            id INTEGER PRIMARY KEY,
+            data BLOB,
+            fetched_at REAL
+        )
+        ''')
+
+        # Gallery headers (no page list) the header phase rejected, re-checked when the filter rules change
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS headers (
+            id INTEGER PRIMARY KEY,
+            data BLOB,
+            fetched_at REAL
+        )
+        ''')
+
+        # Negative cache: gallery-dl returned [-1, {...}]
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS errors (
+            id INTEGER PRIMARY KEY,
+            message TEXT,
+            cached_at REAL
+        )
+        ''')
+
+        # Negative cache: rejected by the filter rules with the fingerprint filter_key
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rejections (
+            id INTEGER PRIMARY KEY,
+            filter_key TEXT,
+            cached_at REAL
+        )
+        ''')
+
+        conn.commit()
+        conn.close()
+
+    # --- Metadata ---
+
+    def get_metadata(self, gallery_id):
+        """Returns the cached GalleryRecord, or None if missing/expired."""
+        return self._get_record("metadata", gallery_id)
+
+    def put_metadata(self, gallery_id, record):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO metadata (id, data, fetched_at) VALUES (?, ?, ?)",
+                       (gallery_id, self._pack(record), time.time()))
+        # A successful fetch supersedes an older error (and the header)
+        cursor.execute("DELETE FROM errors WHERE id = ?", (gallery_id,))
+        cursor.execute("DELETE FROM headers WHERE id = ?", (gallery_id,))
+        conn.commit()
+        conn.close()
+
+    # --- Headers ---
+
+    def get_header(self, gallery_id):
+        """Returns the cached header GalleryRecord (no pages), or None if missing/expired."""
+        return self._get_record("headers", gallery_id)
+
+    def put_header(self, gallery_id, record):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO headers (id, data, fetched_at) VALUES (?, ?, ?)",
+                       (gallery_id, self._pack(record), time.time()))
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def _pack(record):
+        return zlib.compress(json.dumps(record.to_dict(), ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    def _get_record(self, table, gallery_id):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT data FROM {table} WHERE id = ? AND fetched_at >= ?",
+                       (gallery_id, time.time() - self.ttl))
+        row = cursor.fetchone()
+        conn.close()
+
+        if not row:
+            return None
+        try:
+            return GalleryRecord.from_data(json.loads(zlib.decompress(row[0]).decode('utf-8')))
+        except (zlib.error, ValueError, TypeError):
+            return None
+
+    # --- Errors ---
+
+    def get_error(self, gallery_id):
+        """Returns the cached error message, or None if missing/expired."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT message FROM errors WHERE id = ? AND cached_at >= ?",
+                       (gallery_id, time.time() - self.error_ttl))
+        row = cursor.fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def put_error(self, gallery_id, message):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO errors (id, message, cached_at) VALUES (?, ?, ?)",
+                       (gallery_id, message, time.time()))
+        conn.commit()
+        conn.close()
+
+    # --- Filter rejections ---
+
+    def is_rejected(self, gallery_id, key):
+        """True if the gallery was rejected by the same filter settings within the TTL."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM rejections WHERE id = ? AND filter_key = ? AND cached_at >= ?",
+                       (gallery_id, key, time.time() - self.filtered_ttl))
+        row = cursor.fetchone()
+        conn.close()
+        return row is not None
+
+    def put_rejection(self, gallery_id, key):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO rejections (id, filter_key, cached_at) VALUES (?, ?, ?)",
+                       (gallery_id, key, time.time()))
+        conn.commit()
+        conn.close()
@@ -0,0 +1,201 @@
+import collections
+import json
+import os
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets; +Inf is implied
+TIME_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Counter name -> help text (Prometheus names get a hitomi_dl_ prefix and _total suffix)
+COUNTERS = {
+    "galleries": "Galleries that left the pipeline, by result",
+    "pages": "Pages processed, by action",
+    "bytes_in": "Bytes downloaded (pages)",
+    "bytes_out": "Bytes written (CBZ archives)",
+    "page_bytes_before": "Bytes of pages before conversion",
+    "page_bytes_after": "Bytes of pages after conversion",
+    "encode_seconds": "Time spent converting pages",
+    "skipped": "Galleries skipped, by reason",
+    "header_fetches": "Gallery header fetches of the filter's first phase, by result",
+    "filter_rejections": "Galleries rejected by the filter, by the metadata that decided (header, full, cached) and reason",
+    "failed": "Gallery failures, by stage and error class",
+    "duplicates_flagged": "Galleries downloaded although they match an indexed work",
+}
+
+
+class Histogram:
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        """[(upper bound, observations <= bound), ...] ending with +Inf"""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "max": round(self.max, 6),
+            "buckets": {("+Inf" if bound == float("inf") else f"{bound:g}"): count
+                        for bound, count in self.cumulative()},
+        }
+
+
+def _labels(labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{name}="{escape(value)}"' for name, value in labels)
+
+
+class Metrics:
+    """
+    Thread-safe run metrics: per-stage time and queue wait histograms, and
+    labelled counters (see COUNTERS). Exported as a JSON summary and as a
+    Prometheus textfile (node_exporter textfile collector format).
+    """
+    def __init__(self):
+        self.started = time.time()
+        self._t0 = time.monotonic()
+        self._lock = threading.Lock()
+        self.stage_time = collections.defaultdict(Histogram)
+        self.queue_wait = collections.defaultdict(Histogram)
+        # name -> Counter({(("label", "value"), ...): amount})
+        self.counters = collections.defaultdict(collections.Counter)
+        # name -> (help, callable returning {label tuple: value})
+        self.gauges = {}
+        self._exporter = None
+        self._stop = threading.Event()
+
+    def observe_stage(self, stage, queue_wait, elapsed):
+        """Pipeline on_timing hook."""
+        with self._lock:
+            self.queue_wait[stage].observe(queue_wait)
+            self.stage_time[stage].observe(elapsed)
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self.counters[name][tuple(sorted(labels.items()))] += amount
+
+    def total(self, name, **labels):
+        """Sum of a counter over the label sets that include `labels`"""
+        wanted = set(labels.items())
+        with self._lock:
+            return sum(amount for key, amount in self.counters[name].items() if wanted.issubset(key))
+
+    def add_gauge(self, name, help_text, func):
+        """func() returns {((label, value), ...): number}; sampled on every export."""
+        self.gauges[name] = (help_text, func)
+
+    def elapsed(self):
+        return time.monotonic() - self._t0
+
+    def summary(self):
+        elapsed = self.elapsed()
+        with self._lock:
+            pages = sum(self.counters["pages"].values())
+            summary = {
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "elapsed_seconds": round(elapsed, 3),
+                "pages_per_second": round(pages / elapsed, 3) if elapsed else 0.0,
+                "stages": {name: {"time": hist.to_dict(), "queue_wait": self.queue_wait[name].to_dict()}
+                           for name, hist in self.stage_time.items()},
+            }
+            for name in COUNTERS:
+                counter = self.counters.get(name, {})
+                if all(not key for key in counter):
+                    summary[name] = sum(counter.values())
+                else:
+                    summary[name] = {",".join(f"{label}={value}" for label, value in key) or "total": amount
+                                     for key, amount in sorted(counter.items())}
+        return summary
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            for metric, histograms, help_text in (
+                    ("hitomi_dl_stage_seconds", self.stage_time, "Time spent on one gallery in each pipeline stage"),
+                    ("hitomi_dl_queue_wait_seconds", self.queue_wait, "Time a gallery waited in each stage's input queue")):
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} histogram")
+                for stage, hist in sorted(histograms.items()):
+                    for bound, count in hist.cumulative():
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f'{metric}_bucket{{stage="{stage}",le="{le}"}} {count}')
+                    lines.append(f'{metric}_sum{{stage="{stage}"}} {hist.sum:.6f}')
+                    lines.append(f'{metric}_count{{stage="{stage}"}} {hist.count}')
+
+            for name, help_text in COUNTERS.items():
+                metric = f"hitomi_dl_{name}_total"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} counter")
+                counter = self.counters.get(name) or {(): 0}
+                for key, amount in sorted(counter.items()):
+                    labels = _labels(key)
+                    lines.append(f"{metric}{{{labels}}} {amount}" if labels else f"{metric} {amount}")
+            pages = sum(self.counters["pages"].values())
+
+        elapsed = self.elapsed()
+        lines.append("# HELP hitomi_dl_pages_per_second Pages processed per second since the start of the run")
+        lines.append("# TYPE hitomi_dl_pages_per_second gauge")
+        lines.append(f"hitomi_dl_pages_per_second {pages / elapsed if elapsed else 0.0:.3f}")
+
+        for name, (help_text, func) in sorted(self.gauges.items()):
+            metric = f"hitomi_dl_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for key, value in sorted(func().items()):
+                labels = _labels(key)
+                lines.append(f"{metric}{{{labels}}} {value}" if labels else f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.summary(), indent=4))
+
+    def write_prometheus(self, path):
+        _write_atomic(path, self.prometheus_text())
+
+    def start_export(self, textfile_path, interval=15):
+        """Rewrites the Prometheus textfile every `interval` seconds until stop_export()."""
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.write_prometheus(textfile_path)
+                except OSError as e:
+                    print(f"Error writing metrics to {textfile_path}: {e}")
+
+        self.write_prometheus(textfile_path)
+        self._exporter = threading.Thread(target=run, name="metrics-exporter", daemon=True)
+        self._exporter.start()
+
+    def stop_export(self):
+        self._stop.set()
+        if self._exporter is not None:
+            self._exporter.join(5)
+
+
+def _write_atomic(path, text):
+    # Readers (node_exporter) never see a half-written file
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_path, path)
@@ -0,0 +1,47 @@
+import time
+import urllib.request
+import urllib.error
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:128.0) Gecko/20100101 Firefox/128.0"
+READER_URL = "https://hitomi.la/reader/{}.html"
+
+
+def fetch_page(url, gallery_id, timeout=30.0, retries=4, sleep=0, observer=None):
+    """
+    Downloads a single page into memory; retries on network/5xx/429 errors.
+    observer(latency, error=False, throttled=False) is called after every
+    attempt, e.g. AdaptiveLimiter.record.
+    """
+    request = urllib.request.Request(url, headers={
+        "User-Agent": USER_AGENT,
+        "Referer": READER_URL.format(gallery_id),
+    })
+
+    attempt = 0
+    while True:
+        if sleep:
+            time.sleep(sleep)
+        t0 = time.monotonic()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                data = response.read()
+            if observer:
+                observer(time.monotonic() - t0)
+            return data
+        except urllib.error.HTTPError as e:
+            # Client errors other than throttling will not fix themselves
+            if e.code < 500 and e.code != 429:
+                if observer:
+                    observer(time.monotonic() - t0)
+                raise
+            error = e
+        except (urllib.error.URLError, OSError) as e:
+            error = e
+
+        if observer:
+            observer(time.monotonic() - t0, error=True, throttled=getattr(error, "code", None) == 429)
+
+        attempt += 1
+        if attempt > retries:
+            raise error
+        time.sleep(min(60, 2 ** attempt))
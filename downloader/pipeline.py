@@ -0,0 +1,134 @@
+import queue
+import threading
+import time
+import traceback
+
+# Sentinel telling a stage worker to exit
+_STOP = object()
+
+
+class Stage:
+    """
+    One step of the pipeline: a pool of worker threads reading from a bounded queue.
+    func(item) returns the item for the next stage, or None to drop it.
+    on_done(item) is called once an item leaves the pipeline (dropped, failed or
+    through the last stage); on_timing(stage_name, queue_wait, elapsed) after every item.
+    """
+    def __init__(self, name, func, workers=1, queue_size=0):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next_stage = None
+        self.on_error = None
+        self.on_done = None
+        self.on_timing = None
+        # Optional callable wrapping each worker's main loop (e.g. a per-thread profiler)
+        self.run_wrapper = None
+        self.threads = []
+        self.busy = 0
+        self.processed = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.workers):
+            target = self.run_wrapper(self.name, self._run) if self.run_wrapper else self._run
+            t = threading.Thread(target=target, name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def put(self, item, timeout=None):
+        # Enqueue time, for the queue wait reported to on_timing
+        self.queue.put((time.monotonic(), item), timeout=timeout)
+
+    def stop(self):
+        """Lets every worker finish the queued items, then waits for them to exit."""
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for t in self.threads:
+            # Join with a timeout so KeyboardInterrupt still reaches the main thread
+            while t.is_alive():
+                t.join(0.5)
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is _STOP:
+                break
+            queued_at, item = entry
+            started = time.monotonic()
+
+            with self._lock:
+                self.busy += 1
+            finished = True
+            elapsed = None
+            try:
+                result = self.func(item)
+                elapsed = time.monotonic() - started
+                if result is not None and self.next_stage is not None:
+                    # Blocks while the next stage is full (backpressure)
+                    self.next_stage.put(result)
+                    finished = False
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(self, item, e)
+                else:
+                    print(f"[{self.name}] {item}: An error occurred: {e}")
+                    traceback.print_exc()
+            finally:
+                if self.on_timing:
+                    # Time in func only; waiting on a full next stage is that stage's queue wait
+                    if elapsed is None:
+                        elapsed = time.monotonic() - started
+                    self.on_timing(self.name, started - queued_at, elapsed)
+                if finished and self.on_done:
+                    self.on_done(item)
+                with self._lock:
+                    self.busy -= 1
+                    self.processed += 1
+
+
+class Pipeline:
+    """Chains stages with bounded queues; each stage has its own worker pool."""
+    def __init__(self, stages, on_error=None, on_done=None, on_timing=None, run_wrapper=None, status_interval=0):
+        self.stages = stages
+        self.status_interval = status_interval
+        self._monitor = None
+        self._stopped = threading.Event()
+
+        for stage, next_stage in zip(stages, stages[1:] + [None]):
+            stage.next_stage = next_stage
+            stage.on_error = on_error
+            stage.on_done = on_done
+            stage.on_timing = on_timing
+            stage.run_wrapper = run_wrapper
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        if self.status_interval:
+            self._monitor = threading.Thread(target=self._report, name="pipeline-monitor", daemon=True)
+            self._monitor.start()
+
+    def put(self, item, timeout=None):
+        """Feeds an item into the first stage (blocks while it is full)."""
+        self.stages[0].put(item, timeout=timeout)
+
+    def join(self):
+        """Drains the stages in order and stops all workers."""
+        for stage in self.stages:
+            stage.stop()
+        self._stopped.set()
+
+    def queue_depths(self):
+        return {stage.name: stage.queue.qsize() for stage in self.stages}
+
+    def status_line(self):
+        parts = []
+        for stage in self.stages:
+            parts.append(f"{stage.name}: {stage.queue.qsize()} queued/{stage.busy} busy/{stage.processed} done")
+        return " | ".join(parts)
+
+    def _report(self):
+        while not self._stopped.wait(self.status_interval):
+            print(f"[pipeline] {self.status_line()}")
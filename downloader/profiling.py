@@ -0,0 +1,143 @@
+import cProfile
+import collections
+import io
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+
+# Before 3.12 a cProfile only sees the thread that enabled it. From 3.12 on it
+# works through sys.monitoring: one profile sees every thread, and a second
+# enable() anywhere in the process raises ValueError.
+PER_THREAD = sys.version_info < (3, 12)
+
+
+class Profiler:
+    """
+    cProfile per worker thread (merged per stage when saved) plus tracemalloc
+    snapshots. Before Python 3.12 cProfile only sees the thread it was
+    enabled in, so every stage worker and image pool thread gets its own
+    profile. From 3.12 on one process-wide profile is enabled at the first
+    call and saved as profile_all (stages are told apart by their callers).
+    If another profiler is active, calls run unprofiled.
+    Numbered tracemalloc snapshots are taken every `snapshot_every` packed
+    galleries (tick()) while the stages hold their buffers, "final" by save().
+    """
+    def __init__(self, directory, frames=25, snapshot_every=10):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self._ticks = 0
+        self._profiles = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._snapshots = 0
+        # Process-wide profile (3.12+); False once it could not be enabled
+        self._shared = None
+        os.makedirs(directory, exist_ok=True)
+        tracemalloc.start(frames)
+
+    def _thread_profile(self, name):
+        profiles = getattr(self._local, "profiles", None)
+        if profiles is None:
+            profiles = self._local.profiles = {}
+        profile = profiles.get(name)
+        if profile is None:
+            profile = profiles[name] = cProfile.Profile()
+            with self._lock:
+                self._profiles[name].append(profile)
+        return profile
+
+    def wrap(self, name, func):
+        """Returns func running under this thread's profile for `name` (Stage.run_wrapper)."""
+        def run(*args, **kwargs):
+            return self.call(name, func, *args, **kwargs)
+        return run
+
+    def call(self, name, func, *args, **kwargs):
+        if not PER_THREAD:
+            self._enable_shared()
+            return func(*args, **kwargs)
+        profile = self._thread_profile(name)
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (or debugger) owns the hook
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+
+    def _enable_shared(self):
+        with self._lock:
+            if self._shared is not None:
+                return
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                print(f"Profiler: cProfile unavailable ({e}), only tracemalloc snapshots are written")
+                self._shared = False
+                return
+            self._shared = profile
+            self._profiles["all"].append(profile)
+
+    def tick(self):
+        """Counts a packed gallery; every snapshot_every-th takes a numbered snapshot."""
+        with self._lock:
+            self._ticks += 1
+            due = self.snapshot_every > 0 and self._ticks % self.snapshot_every == 0
+        if due:
+            return self.snapshot()
+        return None
+
+    def snapshot(self, label=None):
+        """Writes a tracemalloc snapshot (.snapshot for tracemalloc tools, .txt top allocations)."""
+        with self._lock:
+            self._snapshots += 1
+            label = label or f"{self._snapshots:03}"
+        snapshot = tracemalloc.take_snapshot()
+        base = os.path.join(self.directory, f"tracemalloc_{label}")
+        snapshot.dump(base + ".snapshot")
+        current, peak = tracemalloc.get_traced_memory()
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(f"Traced memory: {current / 1e6:.1f} MB current, {peak / 1e6:.1f} MB peak\n\n")
+            for stat in snapshot.statistics("lineno")[:30]:
+                f.write(f"{stat}\n")
+        return base + ".snapshot"
+
+    def save(self):
+        """Merges the profiles per stage into profile_<stage>.prof/.txt and takes a final snapshot."""
+        with self._lock:
+            profiles = {name: list(items) for name, items in self._profiles.items()}
+            if self._shared:
+                self._shared.disable()
+        written = []
+        for name, items in sorted(profiles.items()):
+            stats = None
+            for profile in items:
+                # Threads still inside a stage (daemon workers) are skipped
+                try:
+                    profile.create_stats()
+                except Exception:
+                    continue
+                if not getattr(profile, "stats", None):
+                    continue
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            if stats is None:
+                continue
+            path = os.path.join(self.directory, f"profile_{name}.prof")
+            stats.dump_stats(path)
+            text = io.StringIO()
+            stats.stream = text
+            stats.sort_stats("cumulative").print_stats(40)
+            with open(os.path.join(self.directory, f"profile_{name}.txt"), "w", encoding="utf-8") as f:
+                f.write(text.getvalue())
+            written.append(path)
+        written.append(self.snapshot("final"))
+        tracemalloc.stop()
+        return written
@@ -0,0 +1,86 @@
+import bisect
+import queue
+import threading
+
+
+class PendingIds:
+    """
+    Lazily yields the IDs of [start, end] that still have to be processed.
+    Completed IDs are looked up one chunk at a time, so neither the range nor
+    the completed set is ever held in memory as a whole.
+    candidates: sorted IDs to restrict the range to (e.g. from IndexDiscovery).
+    """
+    def __init__(self, start, end, completed_lookup=None, chunk_size=10000, candidates=None):
+        self.start = start
+        self.end = end
+        self.completed_lookup = completed_lookup
+        self.chunk_size = chunk_size
+        self.candidates = candidates
+        self.skipped = 0
+
+    def __len__(self):
+        if self.candidates is not None:
+            return len(self.candidates)
+        return self.end - self.start + 1
+
+    def __iter__(self):
+        for low in range(self.start, self.end + 1, self.chunk_size):
+            high = min(self.end, low + self.chunk_size - 1)
+            if self.candidates is None:
+                chunk = range(low, high + 1)
+            else:
+                chunk = self.candidates[bisect.bisect_left(self.candidates, low):bisect.bisect_right(self.candidates, high)]
+                if not chunk:
+                    continue
+            completed = self.completed_lookup(low, high) if self.completed_lookup else ()
+            for gid in chunk:
+                if gid in completed:
+                    self.skipped += 1
+                    continue
+                yield gid
+
+
+class Scheduler:
+    """
+    Feeds jobs into a Pipeline while keeping at most `max_in_flight` of them
+    between submit() and done(). The pipeline calls done() for every job that
+    leaves it (finished, filtered out or failed), in completion order.
+    """
+    def __init__(self, pipeline, max_in_flight, poll_interval=0.5):
+        self.pipeline = pipeline
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.submitted = 0
+        self.completed = 0
+        self._slots = threading.Semaphore(max_in_flight)
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return self.submitted - self.completed
+
+    def submit(self, job):
+        """Blocks until a slot is free and the first stage accepts the job."""
+        # Short timeouts keep the feeding thread responsive to KeyboardInterrupt
+        while not self._slots.acquire(timeout=self.poll_interval):
+            pass
+        with self._lock:
+            self.submitted += 1
+        while True:
+            try:
+                self.pipeline.put(job, timeout=self.poll_interval)
+                return
+            except queue.Full:
+                continue
+
+    def done(self, job):
+        with self._lock:
+            self.completed += 1
+        self._slots.release()
+
+    def run(self, jobs):
+        """Submits every job of the (possibly lazy) iterable, then drains the pipeline."""
+        for job in jobs:
+            self.submit(job)
+        self.pipeline.join()
@@ -3,142 +3,140 @@ import subprocess
 import json
 import os
 import shutil
-import zipfile
 import sys
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
-from PIL import Image
+import functools
+import threading
+import time
+import collections
+import contextlib
+import urllib.error
+import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from downloader.metadata_backend import GALLERY_DL_CMD, BACKEND_MODES, create_backend, set_default_backend, get_default_backend
+from downloader.metadata_cache import CACHE_DB_NAME, MetadataCache
+from downloader.filters import FilterRules
+from downloader.pipeline import Stage, Pipeline
+from downloader.scheduler import PendingIds, Scheduler
+from downloader.job_store import JOBS_DB_NAME, JobStore
+from downloader.discovery import NOZOMI_URL, IndexDiscovery
+from downloader.gallery_header import GALLERYBLOCK_URL, fetch_header
+from downloader.concurrency import AdaptiveLimiter, classify_error
+from downloader.imaging import DOWNSCALE_OVERSAMPLE, JPEG_QUALITY, OUTPUT_CODECS, OutputFormat, create_image_pool, process_page, process_page_data, timed
+from downloader.pages import fetch_page
+from downloader.async_pages import AsyncPageDownloader
+from downloader.budget import ByteBudget, DiskBudget
+from downloader.archive import CbzWriter
+from downloader.manifest import CHANGED, CORRUPT, MISSING, OK, UNCHANGED, build_manifest, verify_library
+from downloader.checkpoint import CHECKPOINT_NAME, Checkpoint
+from downloader.metrics import Metrics
+from downloader.profiling import Profiler
+from organizer.db_manager import DB_NAME, DBManager
+from organizer.metadata_utils import cbz_page_count, gallery_signatures, metadata_entries, metadata_signatures
 
 # Configuration
-GALLERY_DL_CMD = [sys.executable, "-m", "gallery_dl"]
 TEMP_DIR = "temp_download"
 OUTPUT_DIR = "downloads"
+METADATA_CACHE = None
+# Galleryblock URL template of the header phase; None: filter on the full metadata only
+HEADER_URL = None
+IMAGE_POOL = None
+IMAGE_PASSTHROUGH = True
+IMAGE_OVERSAMPLE = DOWNSCALE_OVERSAMPLE
+IMAGE_OUTPUT = OutputFormat()
 
-def get_metadata(gallery_id):
-    """Fetches metadata using gallery-dl -j"""
-    url = f"https://hitomi.la/galleries/{gallery_id}.html"
-    try:
-        # Check if gallery-dl is available
-        cmd = GALLERY_DL_CMD + ["-j", url]
-        
-        # Inject config if available (this might be checking only global config loaded in main? 
-        # But get_metadata is called from main loop, maybe we should pass config or handle it globally?)
-        # Let's assume we handle config file creation in main loop or globally.
-        # But to be clean, let's look for the temp file.
-        if os.path.exists("gd_config_temp.json"):
-            cmd += ["--config", "gd_config_temp.json"]
-            
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            encoding='utf-8',
-            check=True
-        )
-        # gallery-dl returns a list of dictionaries, usually one per image, or a structure containing album info.
-        # For hitomi, it usually outputs a list of JSON objects (one per file) or a single structure.
-        # We need to parse the output carefully.
-        # Often gallery-dl -j outputs multiple JSON objects separated by newlines or in a list.
-        # Let's try to parse the whole output as JSON first, or split lines.
-        
-        try:
-             data = json.loads(result.stdout)
-        except json.JSONDecodeError:
-            # Try line by line
-            data = []
-            for line in result.stdout.strip().split('\n'):
-                if line.strip():
-                     data.append(json.loads(line))
-        
-        # We extract gallery info from the first item usually
-        if isinstance(data, list) and len(data) > 0:
-            return data
-        return None
+# In-memory mode (None = always stage pages in TEMP_DIR)
+MEMORY_BUDGET = None
+PAGE_ESTIMATE = 2 * 1024 * 1024
+# Per-ID job states (resume / retry / report; None = not recorded)
+JOB_STORE = None
+# Bytes in flight in TEMP_DIR / CBZs being written to OUTPUT_DIR (None = unlimited)
+TEMP_BUDGET = None
+OUTPUT_BUDGET = None
+DOWNLOAD_OPTIONS = {}
+# Shared asyncio page downloader (None = one urllib request at a time per gallery)
+PAGE_DOWNLOADER = None
+# Re-hash pages on resume instead of only comparing sizes
+CHECKPOINT_VERIFY = False
+# Store an integrity manifest of every CBZ in organizer.db (checked by --verify)
+WRITE_MANIFESTS = True
+# Write ComicInfo.xml and the gallery's metadata as JSON into every CBZ (read by the organizer)
+EMBED_METADATA = True
 
-    except subprocess.CalledProcessError as e:
-        print(f"Error fetching metadata for ID {gallery_id}: {e}")
-        return None
-    except Exception as e:
-        print(f"Unexpected error for ID {gallery_id}: {e}")
-        return None
+# Persistent index of completed IDs (organizer.db)
+COMPLETED_INDEX = None
+
+# Re-upload detection against the signature index in organizer.db: "skip", "flag" or "off"
+DUPLICATE_MODES = ("skip", "flag", "off")
+DUPLICATE_MODE = "off"
+# Signatures claimed by galleries of this run that are not packed yet
+SIGNATURES_SEEN = {}
+SIGNATURES_LOCK = threading.Lock()
+
+# AIMD concurrency limits for gallery-dl metadata calls and gallery downloads (None = fixed worker counts)
+METADATA_LIMITER = None
+DOWNLOAD_LIMITER = None
+
+# Run summary counters (pages passed through / transcoded)
+PAGE_STATS = collections.Counter()
+PAGE_STATS_LOCK = threading.Lock()
 
-def filter_gallery(metadata, target_lang, exclude_tags, exclude_artists):
+# Per-stage timings, bytes and skip/fail counters (JSON summary / Prometheus textfile)
+METRICS = Metrics()
+# --profile: cProfile per worker thread + tracemalloc (None = off)
+PROFILER = None
+
+def get_header(gallery_id):
     """
-    Checks if gallery matches criteria.
-    metadata: List of image objects from gallery-dl.
-             We assume common fields are shared or available in the first entry.
+    Cheap first phase: the gallery header (no page list) for filtering.
+    None if it is disabled or could not be read; the full metadata decides then.
     """
-    if not metadata:
-        return False
-    
-    # Extract info from first image/entry
-    if not metadata:
-        return False
-        
-    # Extract info from first image/entry
-    if not metadata:
-        return False
-        
-    first_item = metadata[0]
-    info = {}
-    
-    # Handle [index, dict] structure (common in gallery-dl for hitomi)
-    if isinstance(first_item, list) and len(first_item) >= 2 and isinstance(first_item[1], dict):
-        index = first_item[0]
-        data_dict = first_item[1]
-        
-        # Check for error code
-        if index == -1:
-            print(f"Skipping: Gallery error ({data_dict.get('message', 'Unknown error')})")
-            return False
-            
-        info = data_dict
-    elif isinstance(first_item, dict):
-        # unexpected but handle just in case it's a direct dict
-        info = first_item
+    if not HEADER_URL:
+        return None
+    # One retry: a missing header only costs the full fetch
+    options = dict(DOWNLOAD_OPTIONS, retries=1, observer=METADATA_LIMITER.record if METADATA_LIMITER else None)
+    if METADATA_LIMITER is None:
+        header = fetch_header(gallery_id, HEADER_URL, **options)
     else:
-        print(f"Skipping: Unexpected metadata structure (first item is {type(first_item)}: {first_item})")
-        return False
+        with METADATA_LIMITER:
+            header = fetch_header(gallery_id, HEADER_URL, **options)
+    METRICS.inc("header_fetches", result="ok" if header is not None else "unavailable")
+    return header
 
-    # 1. Language Check
-    # hitomi.la/gallery-dl usually provides 'language' field
-    # If target_lang is specified, we skip if it doesn't match.
-    # Note: Sometimes language might be missing or different, or explicitly None.
-    lang_val = info.get('language')
-    current_lang = lang_val.lower() if lang_val else ''
-    
-    # Only skip if current_lang IS set (known) and differs from target
-    # If current_lang is unknown (None/Empty), we treat it as valid (User Request)
-    if target_lang and current_lang and current_lang != target_lang.lower():
-        # Ensure target_lang is not empty string
-        if target_lang:
-             print(f"Skipping: Language '{current_lang}' does not match target '{target_lang}'")
-             return False
-
-    # 2. Exclude Tags
-    # Tags usually come as a list in 'tags' field
-    tags = info.get('tags', [])
-    if exclude_tags:
-        for tag in tags:
-            if tag in exclude_tags:
-                print(f"Skipping: Contains excluded tag '{tag}'")
-                return False
-
-    # 3. Exclude Artists
-    # Artist can be in 'artist' field (single or list?)
-    artist = info.get('artist')
-    artists = []
-    if isinstance(artist, list):
-        artists = artist
-    elif isinstance(artist, str):
-        artists = [artist]
-    
-    if exclude_artists:
-        for a in artists:
-            if a in exclude_artists:
-                print(f"Skipping: Contains excluded artist '{a}'")
-                return False
+def get_metadata(gallery_id, refresh=False):
+    """
+    Fetches the gallery's GalleryRecord, using the local cache when enabled.
+    refresh: ignore the cached copy (e.g. when its page URLs have expired).
+    """
+    if METADATA_CACHE and not refresh:
+        cached = METADATA_CACHE.get_metadata(gallery_id)
+        if cached is not None:
+            return cached
 
-    return True
+    if METADATA_LIMITER is None:
+        data = get_default_backend().fetch(gallery_id)
+    else:
+        with METADATA_LIMITER:
+            t0 = time.monotonic()
+            data = get_default_backend().fetch(gallery_id)
+            latency = time.monotonic() - t0
+        if not data:
+            METADATA_LIMITER.record(latency, error=True)
+        elif data.error:
+            error, throttled = classify_error(data.error)
+            METADATA_LIMITER.record(latency, error=error, throttled=throttled)
+        else:
+            METADATA_LIMITER.record(latency)
+
+    if data and METADATA_CACHE:
+        if data.error:
+            # Only permanent errors (deleted gallery, ...): a cached 5xx / 429 / timeout
+            # would be replayed on every retry of the job instead of a real request
+            if not classify_error(data.error)[0]:
+                METADATA_CACHE.put_error(gallery_id, data.error)
+        else:
+            METADATA_CACHE.put_metadata(gallery_id, data)
+    return data
 
 def download_gallery(gallery_id):
     """Downloads gallery using gallery-dl to a temp folder"""
@@ -159,73 +157,244 @@ def download_gallery(gallery_id):
             cmd,
             check=True
         )
+        METRICS.inc("bytes_in", sum(os.path.getsize(path) for path in list_pages(download_path)))
         return download_path
     except subprocess.CalledProcessError as e:
         print(f"Error downloading ID {gallery_id}: {e}")
         return None
 
-def process_images(directory):
-    """Resizes and converts images in the directory"""
-    print(f"Processing images in {directory}...")
-    
-    processed_files = []
+def record_page_results(label, results, size_in=0, size_out=0, seconds=0.0):
+    """
+    Adds process_page results to the run summary and prints the per-gallery counts.
+    size_in / size_out: bytes of the pages converted in this run before / after,
+    seconds: time spent converting them.
+    """
+    counts = collections.Counter(result[-1] for result in results if result)
+    with PAGE_STATS_LOCK:
+        PAGE_STATS.update(counts)
+        PAGE_STATS["bytes_in"] += size_in
+        PAGE_STATS["bytes_out"] += size_out
+        PAGE_STATS["encode_ms"] += int(seconds * 1000)
+    for action, count in counts.items():
+        METRICS.inc("pages", count, action=action)
+    METRICS.inc("encode_seconds", seconds)
+    METRICS.inc("page_bytes_before", size_in)
+    METRICS.inc("page_bytes_after", size_out)
+    message = f"Processed images in {label}: {counts['passthrough']} passed through, {counts['transcoded']} transcoded"
+    if counts['resumed']:
+        message += f", {counts['resumed']} already done"
+    if size_in:
+        message += f" ({size_change(size_in, size_out)}, encode {seconds:.1f}s)"
+    print(message)
+
+def size_change(size_in, size_out):
+    """Formats a size change, e.g. "12.3 MB -> 4.5 MB (-63%)" """
+    return f"{size_in / 1e6:.1f} MB -> {size_out / 1e6:.1f} MB ({(size_out - size_in) / size_in:+.0%})"
+
+def download_pages(entries, gallery_id):
+    """Yields (filename, data) for [(url, filename), ...], concurrently when the async downloader is enabled"""
+    if PAGE_DOWNLOADER is not None:
+        pages = PAGE_DOWNLOADER.iter_pages(entries, gallery_id)
+    else:
+        pages = ((filename, fetch_page(url, gallery_id, **DOWNLOAD_OPTIONS)) for url, filename in entries)
+    for filename, data in pages:
+        METRICS.inc("bytes_in", len(data))
+        yield filename, data
+
+def download_gallery_pages(job):
+    """
+    Downloads the pages listed in the metadata into TEMP_DIR/<id>.
+    Resumes from the gallery's checkpoint: only new, missing or truncated pages are fetched.
+    Returns the download path, or None if the metadata has no page list.
+    """
+    gid = job.gid
+    entries = job.metadata.entries()
+    if not entries:
+        return None
+
+    download_path = os.path.join(TEMP_DIR, str(gid))
+    os.makedirs(download_path, exist_ok=True)
 
+    checkpoint = Checkpoint(download_path, gid, verify_hashes=CHECKPOINT_VERIFY)
+    checkpoint.page_count = len(entries)
+    job.checkpoint = checkpoint
+
+    missing = set(checkpoint.missing([name for _, name in entries]))
+    if len(missing) < len(entries):
+        print(f"ID {gid}: Resuming, {len(entries) - len(missing)}/{len(entries)} pages already downloaded.")
+    else:
+        print(f"Downloading ID {gid} ({len(entries)} pages)...")
+
+    pending = [(url, name) for url, name in entries if name in missing]
+    refreshed = False
+    while pending:
+        try:
+            for filename, data in download_pages(pending, gid):
+                # .part + rename: a crash never leaves a truncated page under its real name
+                page_path = os.path.join(download_path, filename)
+                with open(page_path + ".part", "wb") as f:
+                    f.write(data)
+                os.replace(page_path + ".part", page_path)
+                checkpoint.mark_downloaded(filename, data)
+                missing.discard(filename)
+            pending = []
+        except urllib.error.HTTPError as e:
+            if e.code not in (403, 404) or refreshed:
+                raise
+            # Page URLs in cached metadata expire; ask gallery-dl for fresh ones (once)
+            refreshed = True
+            fresh = get_metadata(gid, refresh=True)
+            if not fresh:
+                raise
+            job.metadata = fresh
+            pending = [(url, name) for url, name in fresh.entries() if name in missing]
+
+    return download_path
+
+def download_gallery_to_memory(job):
+    """
+    Downloads the pages listed in the metadata into memory.
+    Returns [(filename, data), ...], or None to fall back to download_gallery
+    (no page list, memory budget exhausted, or a download error).
+    """
+    gid = job.gid
+    entries = job.metadata.entries()
+    if not entries:
+        return None
+
+    estimate = len(entries) * PAGE_ESTIMATE
+    if not MEMORY_BUDGET.try_reserve(estimate):
+        print(f"ID {gid}: {len(entries)} pages do not fit in the memory budget, using temp dir.")
+        return None
+    job.reserved = estimate
+
+    print(f"Downloading ID {gid} into memory ({len(entries)} pages)...")
+    try:
+        downloaded = dict(download_pages(entries, gid))
+        pages = [(filename, downloaded[filename]) for _, filename in entries]
+    except Exception as e:
+        # Page URLs from cached metadata may have expired; gallery-dl resolves fresh ones
+        print(f"ID {gid}: In-memory download failed ({e}), falling back to temp dir.")
+        release_memory(job)
+        return None
+
+    size = sum(len(data) for _, data in pages)
+    MEMORY_BUDGET.adjust(job.reserved, size)
+    job.reserved = size
+    return pages
+
+def release_memory(job):
+    """Returns the job's share of the memory budget"""
+    if job.reserved and MEMORY_BUDGET is not None:
+        MEMORY_BUDGET.release(job.reserved)
+    job.reserved = 0
+    job.pages = None
+
+def list_pages(directory):
+    """All files below directory in a deterministic (sorted) order"""
+    paths = []
     for root, dirs, files in os.walk(directory):
+        dirs.sort()
         files.sort()
         for filename in files:
-            filepath = os.path.join(root, filename)
-            # Skip non-image files if any? gallery-dl usually only DLs images/videos.
-            # Check extension or try-except
-            try:
-                with Image.open(filepath) as img:
-                    # Convert to RGB if necessary (e.g. for PNG with transparency being saved as JPG)
-                    if img.mode in ("RGBA", "P"):
-                        img = img.convert("RGB")
-
-                    # Resize logic: max 1920x1920
-                    max_w = 1920
-                    max_h = 1920
-                    
-                    original_w, original_h = img.size
-                    ratio = min(max_w / original_w, max_h / original_h)
-                    
-                    # Only resize if larger
-                    if ratio < 1.0:
-                        new_w = int(original_w * ratio)
-                        new_h = int(original_h * ratio)
-                        img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-                    
-                    # Save as JPG (overwriting or new file? Previous was new file + delete old)
-                    # Let's save as .jpg
-                    new_filename = os.path.splitext(filename)[0] + ".jpg"
-                    new_filepath = os.path.join(root, new_filename)
-                    
-                    img.save(new_filepath, "JPEG", quality=90)
-                    processed_files.append(new_filename)
-                    
-                    # If we created a new file, remove the old one to avoid duplicates in zip
-                    if filename != new_filename:
-                        os.remove(filepath)
-                        
-            except Exception as e:
-                # Not an image or error, skip
-                # print(f"Skipping processing for {filename}: {e}")
-                pass
-    
-    return processed_files
+            # Resume bookkeeping is not part of the gallery
+            if filename.startswith(CHECKPOINT_NAME) or filename.endswith(".part"):
+                continue
+            paths.append(os.path.join(root, filename))
+    return paths
+
+def map_pages(func, *iterables):
+    """
+    Runs func over the pages on IMAGE_POOL.
+    Yields (index, result, seconds) in completion order, so callers can act on each page right away.
+    """
+    if IMAGE_POOL is None:
+        for index, args in enumerate(zip(*iterables)):
+            yield (index,) + timed(func, *args)
+        return
+
+    if PROFILER is not None and isinstance(IMAGE_POOL, ThreadPoolExecutor):
+        func = functools.partial(PROFILER.call, "image", func)
+    futures = {IMAGE_POOL.submit(timed, func, *args): index for index, args in enumerate(zip(*iterables))}
+    for future in as_completed(futures):
+        yield (futures[future],) + future.result()
 
-def create_cbz(source_dir, gallery_info, gallery_id):
-    """Creates CBZ file with specific naming convention"""
+def process_images(directory, writer=None, checkpoint=None):
+    """
+    Resizes and converts images in the directory (pages run in parallel on IMAGE_POOL).
+    With a CbzWriter, every page is appended to the archive as soon as it is done.
+    With a Checkpoint, pages converted by an earlier (interrupted) run are reused.
+    """
+    paths = list_pages(directory)
+    func = functools.partial(process_page, passthrough=IMAGE_PASSTHROUGH, oversample=IMAGE_OVERSAMPLE,
+                             output=IMAGE_OUTPUT)
+
+    results = [None] * len(paths)
+    todo = []
+    for index, path in enumerate(paths):
+        processed = checkpoint.processed_name(os.path.basename(path)) if checkpoint else None
+        if processed:
+            results[index] = (processed, "resumed")
+            if writer is not None:
+                writer.add(index, processed, path=os.path.join(os.path.dirname(path), processed))
+        else:
+            todo.append(index)
+
+    # Original sizes, read before the pages are replaced by their converted versions
+    sizes = {index: os.path.getsize(paths[index]) for index in todo}
+    size_in = size_out = 0
+    seconds = 0.0
+    for position, result, elapsed in map_pages(func, [paths[i] for i in todo]):
+        index = todo[position]
+        results[index] = result
+        original = os.path.basename(paths[index])
+        if result:
+            name = result[0]
+            size_in += sizes[index]
+            size_out += os.path.getsize(os.path.join(os.path.dirname(paths[index]), name))
+            seconds += elapsed
+            if checkpoint is not None:
+                checkpoint.mark_processed(original, name)
+            if writer is not None:
+                writer.add(index, name, path=os.path.join(os.path.dirname(paths[index]), name))
+        elif writer is not None:
+            # Not an image: archived unchanged, like before
+            writer.add(index, original, path=paths[index])
+
+    record_page_results(directory, results, size_in, size_out, seconds)
+    return [result[0] for result in results if result]
+
+def process_images_in_memory(gallery_id, pages, writer=None):
+    """In-memory variant of process_images: returns the converted [(filename, data), ...]"""
+    func = functools.partial(process_page_data, passthrough=IMAGE_PASSTHROUGH, oversample=IMAGE_OVERSAMPLE,
+                             output=IMAGE_OUTPUT)
+    names = [name for name, data in pages]
+    datas = [data for name, data in pages]
+
+    converted = [None] * len(pages)
+    results = [None] * len(pages)
+    size_in = size_out = 0
+    seconds = 0.0
+    for index, result, elapsed in map_pages(func, names, datas):
+        results[index] = result
+        if result:
+            size_in += len(datas[index])
+            size_out += len(result[1])
+            seconds += elapsed
+        # Non-image entries are kept unchanged, like files in the temp dir
+        name, data = result[:2] if result else pages[index]
+        if writer is not None:
+            writer.add(index, name, data=data)
+        else:
+            converted[index] = (name, data)
+
+    record_page_results(f"memory (ID {gallery_id})", results, size_in, size_out, seconds)
+    return converted if writer is None else None
+
+def cbz_filename(gallery_info, gallery_id):
+    """Builds the CBZ filename: [artist][group] title(Series) (id).cbz"""
     # Naming: [artist][group] title(Series) (id).cbz
     # Fields: artist, group, title, series, id
-    
-    info = {}
-    first_item = gallery_info[0]
-    
-    if isinstance(first_item, list) and len(first_item) >= 2 and isinstance(first_item[1], dict):
-        info = first_item[1]
-    elif isinstance(first_item, dict):
-        info = first_item
 
     def format_field(value):
         if isinstance(value, list):
@@ -234,25 +403,21 @@ def create_cbz(source_dir, gallery_info, gallery_id):
             return ",".join(value)
         return value
         
-    artist = format_field(info.get('artist'))
+    artist = format_field(gallery_info.artist)
     if not artist:
         artist = "N_A"
 
-    group = format_field(info.get('group'))
+    group = format_field(gallery_info.group)
     if not group:
         group = "" # Empty if missing as per typical conventions, or "N_A"
     
     # Prefer Japanese title, fall back to default title
-    title = info.get('title_jpn')
+    title = gallery_info.title_jpn
     if not title:
-        title = info.get('title', 'No Title')
-    
-    # 'series' is often 'parody' in gallery-dl output for hitomi
-    series_raw = info.get('parody')
-    if not series_raw:
-        series_raw = info.get('series')
+        title = gallery_info.title or 'No Title'
 
-    series = format_field(series_raw)
+    # 'series' is 'parody' in gallery-dl output for hitomi (the record merges both)
+    series = format_field(gallery_info.parody)
     
     # Construct filename parts
     # [artist]
@@ -280,40 +445,148 @@ def create_cbz(source_dir, gallery_info, gallery_id):
     for char in forbidden:
         name_str = name_str.replace(char, '_')
     
-    filename = name_str + ".cbz"
+    return name_str + ".cbz"
+
+def open_cbz(gallery_info, gallery_id):
+    """Starts an incremental CBZ in OUTPUT_DIR; pages are appended as they are processed"""
+    filename = cbz_filename(gallery_info, gallery_id)
     filepath = os.path.join(OUTPUT_DIR, filename)
-    temp_filepath = filepath + ".tmp"
 
     if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
 
     print(f"Creating CBZ: {filename}")
-    
-    # Write to temp file first to ensure atomicity
-    with zipfile.ZipFile(temp_filepath, 'w') as cbz:
-        for root, dirs, files in os.walk(source_dir):
-            files.sort()
-            for f in files:
-                full_path = os.path.join(root, f)
-                # Add to zip, flattening the structure (placing files at root of zip)
-                # This assumes unique filenames, which is typical for hitomi
-                cbz.write(full_path, arcname=f)
-
-    # Rename temp file to final filename
-    if os.path.exists(filepath):
-        try:
-            os.remove(filepath)
-        except:
-            pass
-            
+    # Written to <name>.tmp and renamed on close() to ensure atomicity
+    return CbzWriter(filepath, metadata_entries(gallery_info) if EMBED_METADATA else ())
+
+def reserve_output(size, label):
+    """Reserves room for a CBZ of about `size` bytes in OUTPUT_DIR; raises DiskSpaceError if the disk is full"""
+    if OUTPUT_BUDGET is None:
+        return 0
+    OUTPUT_BUDGET.reserve(size, label)
+    return size
+
+def release_output(job):
+    if job.output_reserved and OUTPUT_BUDGET is not None:
+        OUTPUT_BUDGET.release(job.output_reserved)
+    job.output_reserved = 0
+
+def directory_size(directory):
+    return sum(os.path.getsize(path) for path in list_pages(directory))
+
+def record_manifest(gallery_id, filepath, entries=None):
+    """Stores the integrity manifest of a finished CBZ; a failure here does not fail the gallery"""
+    if not WRITE_MANIFESTS or COMPLETED_INDEX is None:
+        return
     try:
-        os.replace(temp_filepath, filepath)
+        COMPLETED_INDEX.put_manifest(gallery_id, build_manifest(filepath, entries))
+    except (OSError, zipfile.BadZipFile) as e:
+        print(f"ID {gallery_id}: Could not record the manifest of {filepath}: {e}")
+
+def verify_archives(start, end, workers, full=False):
+    """
+    Re-checks the CBZs of the range against their manifests. Files whose size
+    and mtime match the last good pass are skipped unless `full`.
+    Returns the number of missing, changed or corrupt archives.
+    """
+    rows = COMPLETED_INDEX.get_manifests(start, end)
+    print(f"Verifying {len(rows)} archives ({'full' if full else 'changed files only'}, {workers} workers)...")
+    counts = collections.Counter()
+    results = []
+    for gid, path, result, detail, stamp in verify_library(rows, workers, full):
+        counts[result] += 1
+        if result in (OK, UNCHANGED):
+            results.append((OK, stamp[0], stamp[1], gid))
+        else:
+            print(f"ID {gid}: {result.upper()} {path}" + (f" ({detail})" if detail and result != MISSING else ""))
+            results.append((result, None, None, gid))
+    COMPLETED_INDEX.set_verify_results(results)
+    print("Verify: " + ", ".join(f"{counts[result]} {result}" for result in (OK, UNCHANGED, CHANGED, CORRUPT, MISSING)))
+    return counts[CHANGED] + counts[CORRUPT] + counts[MISSING]
+
+def scan_output_dir(directory):
+    """Returns (id, filename) for every '... (ID).cbz' in directory"""
+    rows = []
+    if os.path.exists(directory):
+        for f in os.listdir(directory):
+            # Pattern: ... (ID).cbz
+            match = re.search(r'\((\d+)\)\.cbz$', f)
+            if match:
+                rows.append((int(match.group(1)), f))
+    return rows
+
+def print_stage_summary():
+    """One line per pipeline stage: mean time and queue wait, to spot the bottleneck"""
+    summary = METRICS.summary()
+    for name, stage in summary["stages"].items():
+        print(f"Stage {name}: {stage['time']['count']} galleries, mean {stage['time']['mean']:.2f}s "
+              f"(max {stage['time']['max']:.2f}s), queue wait mean {stage['queue_wait']['mean']:.2f}s")
+    print(f"Throughput: {summary['pages_per_second']:.2f} pages/s, "
+          f"{summary['bytes_in'] / 1e6:.1f} MB in, {summary['bytes_out'] / 1e6:.1f} MB out")
+
+def print_filter_summary(rules):
+    """Rejections by the phase that decided them (header rejections saved a full metadata fetch) and by rule"""
+    total = METRICS.total("filter_rejections")
+    if not total:
+        return
+    header, full = METRICS.total("filter_rejections", phase="header"), METRICS.total("filter_rejections", phase="full")
+    line = f"Filter: {total} rejected ({METRICS.total('filter_rejections', phase='cached')} cached"
+    if header + full:
+        line += f", {header / (header + full):.0%} of the others decided from the header alone"
+    print(line + ")")
+    top = rules.top_rejections(5)
+    if top:
+        print("Top reject reasons: " + ", ".join(
+            f"{rejection.reason} '{rejection.value}' {count}" if rejection.value else f"{rejection.reason} {count}"
+            for rejection, count in top))
+
+def write_metrics(summary_path, textfile_path):
+    """Writes the JSON summary / final Prometheus textfile and the profiler output"""
+    try:
+        if summary_path:
+            METRICS.write_json(summary_path)
+            print(f"Metrics summary: {summary_path}")
+        if textfile_path:
+            METRICS.write_prometheus(textfile_path)
     except OSError as e:
-        print(f"Error renaming {temp_filepath} to {filepath}: {e}")
-        # If rename fails, we might want to keep the temp file or not. 
-        # But usually this works.
+        print(f"Error writing metrics: {e}")
+    if PROFILER is not None:
+        for path in PROFILER.save():
+            print(f"Profile: {path}")
 
-    return filepath
+def discover_ids(discovery_config, start, end, rules):
+    """
+    IDs of the range from the site's index files, or None (probe every ID) if they cannot be read.
+    Only the rules the indexes can answer are applied: the language (unless it has
+    exceptions) and the excluded tags / artists without wildcards.
+    """
+    cache_dir = discovery_config.get("cache_dir", "nozomi_cache")
+    if cache_dir:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), cache_dir)
+    discovery = IndexDiscovery(discovery_config.get("base_url") or NOZOMI_URL, cache_dir=cache_dir,
+                               max_age=discovery_config.get("cache_hours", 6) * 3600)
+    t0 = time.monotonic()
+    try:
+        exclude_tags, exclude_artists = rules.index_excludes()
+        language = None if rules.language_exceptions else rules.language
+        candidates = discovery.discover(start, end, language, exclude_tags, exclude_artists)
+    except (OSError, ValueError) as e:
+        print(f"Discovery failed ({e}), requesting every ID of the range.")
+        return None
+
+    # Every ID dropped here is a metadata request saved
+    reasons = {"indexed": "not_indexed", "language": "filtered_language_index", "excluded": "filtered_excluded_index"}
+    for (_, before), (step, after) in zip(discovery.steps, discovery.steps[1:]):
+        if before > after:
+            METRICS.inc("skipped", before - after, reason=reasons[step])
+    print("Discovery ({:.1f}s): {}".format(time.monotonic() - t0,
+                                          " -> ".join(f"{count} {step}" for step, count in discovery.steps)))
+    return candidates
+
+def write_report(path, start, end):
+    if path and JOB_STORE is not None:
+        count = JOB_STORE.write_report(path, start, end)
+        print(f"Job report: {count} IDs written to {path}")
 
 def load_config():
     """Loads configuration from config.json in the script's directory"""
@@ -337,40 +610,345 @@ def load_config():
                  pass
     return {}
 
-def process_gallery(gid, lang, exclude_tags, exclude_artists):
-    """Processes a single gallery ID: metadata -> filtering -> download -> processing -> CBZ -> cleanup"""
+class GalleryJob:
+    """A gallery moving through the pipeline stages"""
+    def __init__(self, gid):
+        self.gid = gid
+        self.metadata = None
+        self.path = None
+        # In-memory mode: [(filename, data), ...] and bytes reserved in MEMORY_BUDGET
+        self.pages = None
+        self.reserved = 0
+        # Bytes reserved in TEMP_BUDGET (pages in TEMP_DIR/<id>) and OUTPUT_BUDGET (the CBZ)
+        self.temp_reserved = 0
+        self.output_reserved = 0
+        # Incremental CBZ, opened by the process stage and finished by the pack stage
+        self.writer = None
+        # Page manifest of TEMP_DIR/<id> (resume support)
+        self.checkpoint = None
+        # Signature index keys (normalized author|title|language|pages)
+        self.signatures = []
+
+    def __str__(self):
+        return f"ID {self.gid}"
+
+def record_skip(job, reason, message=None, retry=False):
+    """Counts a gallery that leaves the pipeline early; retry: a transient error, recorded as failed"""
+    METRICS.inc("skipped", reason=reason)
+    METRICS.inc("galleries", result="skipped")
+    if JOB_STORE is not None:
+        if retry:
+            JOB_STORE.fail(job.gid, "fetch", reason, message)
+        else:
+            JOB_STORE.set_state(job.gid, "filtered" if reason.startswith("filtered") else "skipped", reason, message)
+
+def record_failure(job, stage, error, message=None):
+    METRICS.inc("failed", stage=stage, error=error)
+    METRICS.inc("galleries", result="failed")
+    if JOB_STORE is not None:
+        JOB_STORE.fail(job.gid, stage, error, message)
+
+def set_job_state(job, state):
+    if JOB_STORE is not None:
+        JOB_STORE.set_state(job.gid, state)
+
+def record_rejection(job, rules, rejection, phase):
+    """A filter rejection; phase: the metadata that decided ("header", "full" or "cached")"""
+    detail = f"{rejection.reason} '{rejection.value}'" if rejection.value else rejection.reason
+    print(f"ID {job.gid}: Rejected by filter ({phase}: {detail}). Skipping.")
+    record_skip(job, "filtered")
+    METRICS.inc("filter_rejections", phase=phase, reason=rejection.reason)
+    if METADATA_CACHE:
+        METADATA_CACHE.put_rejection(job.gid, rules.key)
+
+def stage_fetch(job, rules):
+    """Stage 1: metadata -> filtering (FilterRules). Returns the job if it should be downloaded."""
+    gid = job.gid
     print(f"Processing ID: {gid}")
-    
-    # 1. Get Metadata
-    metadata = get_metadata(gid)
+
+    # 0. Negative cache (earlier errors / rejections under the same filter settings)
+    if METADATA_CACHE:
+        if METADATA_CACHE.is_rejected(gid, rules.key):
+            print(f"ID {gid}: Rejected by filter (cached). Skipping.")
+            record_skip(job, "filtered_cached")
+            METRICS.inc("filter_rejections", phase="cached")
+            return None
+        error = METADATA_CACHE.get_error(gid)
+        # Transient errors cached by older versions get a real request
+        if error and not classify_error(error)[0]:
+            print(f"ID {gid}: Gallery error (cached: {error}). Skipping.")
+            record_skip(job, "gallery_error_cached", error)
+            return None
+
+    # 1. Header phase: most rejections need no page list. Skipped when the
+    # full metadata is cached anyway.
+    cached = METADATA_CACHE.get_metadata(gid) if METADATA_CACHE else None
+    if cached is None:
+        header = METADATA_CACHE.get_header(gid) if METADATA_CACHE else None
+        fetched = header is None
+        if fetched:
+            header = get_header(gid)
+        rejection = rules.check(header) if header is not None else None
+        if rejection is not None:
+            # Kept next to the rejection: changed filter rules re-check it without a request
+            if fetched and METADATA_CACHE:
+                METADATA_CACHE.put_header(gid, header)
+            record_rejection(job, rules, rejection, "header")
+            return None
+
+    # 2. Full metadata (page list)
+    metadata = cached or get_metadata(gid)
     if not metadata:
         print(f"ID {gid}: No metadata found or error. Skipping.")
-        return
-        
-    # 2. Filter
-    if not filter_gallery(metadata, lang, exclude_tags, exclude_artists):
-        return
+        record_skip(job, "no_metadata", retry=True)
+        return None
         
-    # 3. Download
-    dl_path = download_gallery(gid)
-    if not dl_path:
+    # Errors are already cached by get_metadata
+    if metadata.error:
+        print(f"ID {gid}: Gallery error ({metadata.error}). Skipping.")
+        # Server errors are worth a retry, a deleted gallery is not
+        record_skip(job, "gallery_error", metadata.error, retry=classify_error(metadata.error)[0])
+        return None
+
+    # 3. Filter
+    rejection = rules.check(metadata)
+    if rejection is not None:
+        record_rejection(job, rules, rejection, "full")
+        return None
+
+    job.metadata = metadata
+
+    # 4. Re-uploads of a work that is already in the library (or earlier in this run)
+    if DUPLICATE_MODE != "off" and is_duplicate(job):
+        return None
+    set_job_state(job, "fetched")
+    return job
+
+def find_duplicates(gid, signatures):
+    """(indexed, claimed): IDs with the same signature in the index, and IDs of this run claiming one"""
+    indexed = COMPLETED_INDEX.find_signature_ids(signatures, exclude_id=gid) if COMPLETED_INDEX else []
+    claimed = set()
+    with SIGNATURES_LOCK:
+        for signature in signatures:
+            other = SIGNATURES_SEEN.setdefault(signature, gid)
+            if other != gid:
+                claimed.add(other)
+    return sorted(indexed), sorted(claimed.difference(indexed))
+
+def release_signatures(job):
+    """Drops the run-local claims of a job that did not produce a CBZ"""
+    with SIGNATURES_LOCK:
+        for signature in job.signatures:
+            if SIGNATURES_SEEN.get(signature) == job.gid:
+                del SIGNATURES_SEEN[signature]
+
+def is_duplicate(job):
+    """Checks the job against the signature index; True if it should be skipped"""
+    job.signatures = metadata_signatures(job.metadata)
+    indexed, claimed = find_duplicates(job.gid, job.signatures)
+    if not indexed and not claimed:
+        return False
+
+    others = ", ".join(str(gid) for gid in sorted(indexed + claimed))
+    if DUPLICATE_MODE == "skip":
+        print(f"ID {job.gid}: Same artist, title, language and page count as ID {others}. Skipping.")
+        release_signatures(job)
+        # A gallery of this run may still fail: until one is in the index, the skip is retried
+        # with --retry_failed (and settles once the other copy is packed)
+        record_skip(job, "duplicate" if indexed else "duplicate_pending", f"Same work as ID {others}",
+                    retry=not indexed)
+        return True
+    print(f"ID {job.gid}: Possible re-upload of ID {others}, downloading anyway.")
+    METRICS.inc("duplicates_flagged")
+    return False
+
+def index_signatures():
+    """Adds galleries of organizer.db and earlier downloads that are not in the signature index yet"""
+    rows, unsignable = [], []
+    for gid, title, author, language, path in COMPLETED_INDEX.get_unsigned_galleries():
+        signatures = []
+        if path and os.path.exists(path):
+            signatures = gallery_signatures(author, (title,), language, cbz_page_count(path))
+        rows.extend((signature, gid) for signature in signatures)
+        if not signatures:
+            unsignable.append(gid)
+    if METADATA_CACHE:
+        for gid in COMPLETED_INDEX.get_unsigned_downloads():
+            metadata = METADATA_CACHE.get_metadata(gid)
+            signatures = metadata_signatures(metadata) if metadata else []
+            rows.extend((signature, gid) for signature in signatures)
+            if not signatures:
+                unsignable.append(gid)
+    if rows:
+        COMPLETED_INDEX.add_signatures(rows)
+        print(f"Signature index: added {len(rows)} signatures")
+    if unsignable:
+        # Checked once; --rescan_output checks them again
+        COMPLETED_INDEX.mark_unsignable(unsignable)
+
+def download_slot():
+    return DOWNLOAD_LIMITER if DOWNLOAD_LIMITER is not None else contextlib.nullcontext()
+
+def stage_download(job):
+    """Stage 2: download into memory (memory mode) or into TEMP_DIR/<id>"""
+    if MEMORY_BUDGET is not None:
+        set_job_state(job, "downloading")
+        with download_slot():
+            job.pages = download_gallery_to_memory(job)
+        if job.pages is not None:
+            return job
+
+    set_job_state(job, "downloading")
+    # Waits for room in TEMP_DIR before taking a download slot
+    reserve_temp(job)
+    with download_slot():
+        return download_job(job)
+
+def gallery_page_count(metadata):
+    """Pages of the gallery from its page list or its `count` field, None if unknown"""
+    try:
+        return int(metadata.page_count or 0) or None
+    except (TypeError, ValueError):
+        return None
+
+def reserve_temp(job):
+    """Reserves the gallery's estimated size in TEMP_BUDGET (blocks above the high watermark)"""
+    if TEMP_BUDGET is None:
         return
-        
-    # 4. Process Images
-    process_images(dl_path)
+    # Without a page list gallery-dl downloads the gallery: counted by its page count
+    estimate = TEMP_BUDGET.estimate(job.metadata.sizes(), gallery_page_count(job.metadata))
+    TEMP_BUDGET.reserve(estimate, str(job))
+    job.temp_reserved = estimate
+
+def release_temp(job):
+    """Returns the job's share of the temp budget"""
+    if job.temp_reserved and TEMP_BUDGET is not None:
+        TEMP_BUDGET.release(job.temp_reserved)
+    job.temp_reserved = 0
+
+def download_job(job):
+    """Downloads the gallery's pages into TEMP_DIR/<id>, or with gallery-dl if the metadata has no page list"""
+    # Own downloader with per-page checkpoints
+    job.path = download_gallery_pages(job)
+    if job.path is None:
+        job.path = download_gallery(job.gid)
+    if job.path and TEMP_BUDGET is not None:
+        # The real size replaces the estimate and improves the next ones
+        size = directory_size(job.path)
+        TEMP_BUDGET.adjust(job.temp_reserved, size)
+        job.temp_reserved = size
+        TEMP_BUDGET.observe(len(job.metadata.pages) or len(list_pages(job.path)), size)
+    if not job.path:
+        release_temp(job)
+        release_signatures(job)
+        record_failure(job, "download", "GalleryDLError", "gallery-dl did not download the gallery")
+        return None
+    return job
+
+def stage_process(job):
+    """Stage 3: resize / convert pages (CPU bound), appending each one to the CBZ when done"""
+    # Converted pages are rarely larger than the originals
+    size = job.temp_reserved or (directory_size(job.path) if job.pages is None else sum(len(data) for _, data in job.pages))
+    job.output_reserved = reserve_output(size, str(job))
+    job.writer = open_cbz(job.metadata, job.gid)
+    if job.pages is not None:
+        process_images_in_memory(job.gid, job.pages, job.writer)
+        # Every page is in the archive now, the memory can be reused
+        release_memory(job)
+    else:
+        if job.checkpoint is None:
+            job.checkpoint = Checkpoint(job.path, job.gid, verify_hashes=CHECKPOINT_VERIFY)
+        process_images(job.path, job.writer, job.checkpoint)
+    return job
+
+def stage_pack(job):
+    """Stage 4: finish the CBZ, record the ID as completed and remove the temp folder"""
+    filepath = job.writer.close()
+    entries = job.writer.entries()
+    job.writer = None
+    release_output(job)
+    METRICS.inc("bytes_out", os.path.getsize(filepath))
+    METRICS.inc("galleries", result="packed")
+    set_job_state(job, "packed")
+    if COMPLETED_INDEX is not None:
+        COMPLETED_INDEX.mark_downloaded(job.gid, os.path.basename(filepath))
+        if not job.signatures:
+            job.signatures = metadata_signatures(job.metadata)
+        COMPLETED_INDEX.add_signatures([(signature, job.gid) for signature in job.signatures])
+    record_manifest(job.gid, filepath, entries)
+    if PROFILER is not None:
+        PROFILER.tick()
+
+    if job.path is None:
+        release_memory(job)
+        return None
 
-    # 5. Create CBZ
-    create_cbz(dl_path, metadata, gid)
-    
-    # 6. Cleanup
     try:
-        shutil.rmtree(dl_path)
+        shutil.rmtree(job.path)
     except Exception as e:
-        print(f"Error cleaning up {dl_path}: {e}")
+        print(f"Error cleaning up {job.path}: {e}")
+    release_temp(job)
+    return None
+
+def build_pipeline(config, max_workers, rules, on_done=None):
+    """Creates the staged pipeline; every stage has its own worker pool and bounded input queue"""
+    pipeline_config = config.get("pipeline", {})
+    queue_size = pipeline_config.get("queue_size", 4)
+
+    def fetch(job):
+        return stage_fetch(job, rules)
+
+    def on_error(stage, job, e):
+        if job.writer is not None:
+            job.writer.abort()
+            job.writer = None
+        release_memory(job)
+        # TEMP_DIR/<id> is kept for resume, but its bytes no longer hold back other downloads
+        release_temp(job)
+        release_output(job)
+        release_signatures(job)
+        record_failure(job, stage.name, type(e).__name__, str(e))
+        print(f"{job}: An error occurred during {stage.name}: {e}")
+        import traceback
+        traceback.print_exc()
+
+    stages = [
+        # Metadata runs ahead of the downloads by up to queue_size galleries
+        # With adaptive concurrency the limiters decide how many of these workers are active
+        Stage("fetch", fetch, METADATA_LIMITER.maximum if METADATA_LIMITER else pipeline_config.get("fetch_workers", 4), queue_size),
+        Stage("download", stage_download, DOWNLOAD_LIMITER.maximum if DOWNLOAD_LIMITER else max_workers, queue_size),
+        # Pages of each gallery are spread over IMAGE_POOL, so few gallery workers are needed here
+        Stage("process", stage_process, pipeline_config.get("process_workers", 2), queue_size),
+        Stage("pack", stage_pack, pipeline_config.get("pack_workers", 1), queue_size),
+    ]
+    return Pipeline(stages, on_error=on_error, on_done=on_done, on_timing=METRICS.observe_stage,
+                    run_wrapper=PROFILER.wrap if PROFILER is not None else None,
+                    status_interval=pipeline_config.get("status_interval", 30))
 
 def main():
     global OUTPUT_DIR
     global TEMP_DIR
+    global METADATA_CACHE
+    global HEADER_URL
+    global IMAGE_POOL
+    global IMAGE_PASSTHROUGH
+    global IMAGE_OVERSAMPLE
+    global IMAGE_OUTPUT
+    global MEMORY_BUDGET
+    global PAGE_ESTIMATE
+    global TEMP_BUDGET
+    global JOB_STORE
+    global OUTPUT_BUDGET
+    global DOWNLOAD_OPTIONS
+    global CHECKPOINT_VERIFY
+    global COMPLETED_INDEX
+    global METADATA_LIMITER
+    global DOWNLOAD_LIMITER
+    global PAGE_DOWNLOADER
+    global PROFILER
+    global DUPLICATE_MODE
+    global WRITE_MANIFESTS
+    global EMBED_METADATA
 
     parser = argparse.ArgumentParser(description="Download and process hitomi.la galleries.")
     parser.add_argument("start_id", type=int, help="Start Gallery ID")
@@ -380,7 +958,36 @@ def main():
     parser.add_argument("--exclude_artists", nargs='+', help="Artists to exclude (overrides config)")
     parser.add_argument("--output_dir", type=str, help="Output directory (overrides config)")
     parser.add_argument("--temp_dir", type=str, help="Temporary directory (overrides config)")
-    parser.add_argument("--workers", type=int, help="Number of parallel workers (overrides config)")
+    parser.add_argument("--workers", type=int, help="Number of parallel download workers (overrides config)")
+    parser.add_argument("--fixed_workers", action="store_true", help="Disable adaptive concurrency (use the configured worker counts)")
+    parser.add_argument("--metadata_backend", choices=BACKEND_MODES, help="How to run gallery-dl for metadata (overrides config, default: auto)")
+    parser.add_argument("--no_cache", action="store_true", help="Do not read or write the local metadata cache")
+    parser.add_argument("--no_header_phase", action="store_true",
+                        help="Filter on the full metadata only (no cheap gallery header fetch first)")
+    parser.add_argument("--image_workers", type=int, help="Number of parallel page processing workers (overrides config, default: CPU count)")
+    parser.add_argument("--codec", choices=list(OUTPUT_CODECS), help="Output codec for converted pages (overrides config, default: jpeg)")
+    parser.add_argument("--quality", type=int, help="Output quality 0-100 (overrides config)")
+    parser.add_argument("--no_passthrough", action="store_true", help="Re-encode every page, even compliant JPEGs")
+    parser.add_argument("--in_memory", action="store_true", help="Keep pages in memory instead of TEMP_DIR (overrides config)")
+    parser.add_argument("--duplicates", choices=DUPLICATE_MODES,
+                        help="Galleries matching an indexed work (artist, title, language, pages): skip, flag or off (overrides config)")
+    parser.add_argument("--discover", action="store_true",
+                        help="Only request IDs listed in the site's index files for the language, minus excluded tags/artists "
+                             "(galleries without a language are dropped; overrides config)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip IDs that an earlier run already packed, filtered, skipped or failed")
+    parser.add_argument("--retry_failed", action="store_true",
+                        help="Only retry the failed IDs of the range whose backoff has expired")
+    parser.add_argument("--report", type=str, metavar="PATH", help="Write the job state of every ID in the range to a JSONL file")
+    parser.add_argument("--verify", nargs="?", const="changed", choices=("changed", "full"),
+                        help="Check the CBZs of the range against their manifests and exit "
+                             "(changed: skip files with the size and mtime of the last good check; full: all)")
+    parser.add_argument("--verify_workers", type=int, help="Parallel checks for --verify (overrides config)")
+    parser.add_argument("--rescan_output", action="store_true", help="Add CBZs found in the output directory to the completed ID index")
+    parser.add_argument("--metrics_json", type=str, help="Write the run's metrics summary to this JSON file (overrides config)")
+    parser.add_argument("--prom_textfile", type=str, help="Prometheus textfile refreshed during the run (overrides config)")
+    parser.add_argument("--profile", nargs="?", const="profile", metavar="DIR",
+                        help="Save cProfile stats per stage and tracemalloc snapshots (every profiling.snapshot_every packed galleries) to DIR (default: ./profile)")
 
     args = parser.parse_args()
     config = load_config()
@@ -397,15 +1004,13 @@ def main():
     elif config.get("temp_dir"):
         TEMP_DIR = config.get("temp_dir")
     
-    # Exclude Tags
-    exclude_tags = config.get("exclude_tags", [])
-    if args.exclude_tags is not None:
-        exclude_tags = args.exclude_tags
-
-    # Exclude Artists
-    exclude_artists = config.get("exclude_artists", [])
-    if args.exclude_artists is not None:
-        exclude_artists = args.exclude_artists
+    # Filter rules (language, excluded / included tags and artists), compiled once
+    try:
+        rules = FilterRules.from_config(config, args.lang, args.exclude_tags, args.exclude_artists)
+    except ValueError as e:
+        print(f"Error in filter rules: {e}")
+        return
+    print(f"Filter rules: {rules.describe()}")
 
     # Workers
     max_workers = config.get("max_workers", 3)
@@ -433,70 +1038,263 @@ def main():
         except Exception as e:
             print(f"Warning: Failed to create temp config for gallery-dl: {e}")
 
+    # Metadata backend (in-process gallery-dl, or one subprocess per ID)
+    backend_mode = config.get("metadata_backend", "auto")
+    if args.metadata_backend:
+        backend_mode = args.metadata_backend
+    backend = create_backend(backend_mode, config_path="gd_config_temp.json")
+    set_default_backend(backend)
+    print(f"Metadata backend: {backend.name}")
+
+    # Metadata cache (raw -j output + negative cache for errors and rejections)
+    cache_config = config.get("metadata_cache", {})
+    if not args.no_cache and cache_config.get("enabled", True):
+        cache_path = cache_config.get("path")
+        if not cache_path:
+            cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), CACHE_DB_NAME)
+        METADATA_CACHE = MetadataCache(
+            cache_path,
+            ttl=cache_config.get("ttl_days", 30) * 86400,
+            error_ttl=cache_config.get("error_ttl_hours", 24) * 3600,
+            filtered_ttl=cache_config.get("filtered_ttl_days", 30) * 86400
+        )
+        print(f"Metadata cache: {cache_path}")
+
+    # Two-phase metadata: the gallery header rejects most filtered galleries
+    # before gallery-dl extracts their page list
+    header_config = config.get("metadata_header", {})
+    if not args.no_header_phase and header_config.get("enabled", True):
+        HEADER_URL = header_config.get("url") or GALLERYBLOCK_URL
+        print(f"Header phase: {HEADER_URL}")
+
     # Handle range
     if start > end:
         start, end = end, start
     
-    ids = list(range(start, end + 1))
-    
-    # Check existing files to resume/skip
-    print("Checking for existing files...")
-    existing_ids = set()
-    if os.path.exists(OUTPUT_DIR):
-        for f in os.listdir(OUTPUT_DIR):
-            if f.endswith(".cbz"):
-                # Pattern: ... (ID).cbz
-                # Regex match
-                import re
-                match = re.search(r'\((\d+)\)\.cbz$', f)
-                if match:
-                    existing_ids.add(int(match.group(1)))
-    
-    original_count = len(ids)
-    ids = [gid for gid in ids if gid not in existing_ids]
-    skipped_count = original_count - len(ids)
-    
-    if skipped_count > 0:
-        print(f"Skipping {skipped_count} already processed galleries.")
-    
-    if not ids:
-        print("All galleries in range already processed.")
+    # Completed IDs come from organizer.db (downloads + organized galleries), so
+    # archives moved into Category/Author/ by the organizer are still skipped
+    db_path = config.get("organizer_db") or os.path.join(os.path.dirname(os.path.abspath(__file__)), DB_NAME)
+    COMPLETED_INDEX = DBManager(db_path)
+    print(f"Completed ID index: {db_path}")
+
+    # One-time import of archives that predate the index (or on request)
+    if args.rescan_output or COMPLETED_INDEX.count_downloads() == 0:
+        print("Checking for existing files...")
+        COMPLETED_INDEX.add_downloads(scan_output_dir(OUTPUT_DIR))
+        COMPLETED_INDEX.clear_unsignable()
+
+    # Integrity manifests: written with every CBZ, checked by --verify
+    integrity_config = config.get("integrity", {})
+    WRITE_MANIFESTS = integrity_config.get("manifests", True)
+    EMBED_METADATA = config.get("archive", {}).get("embed_metadata", True)
+    if args.verify:
+        workers = args.verify_workers or integrity_config.get("verify_workers", 4)
+        if verify_archives(start, end, workers, full=args.verify == "full"):
+            sys.exit(1)
         return
 
-    print(f"Starting parallel processing with {max_workers} workers for {len(ids)} galleries...")
-    
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        try:
-            futures = {executor.submit(process_gallery, gid, args.lang, exclude_tags, exclude_artists): gid for gid in ids}
-            for future in futures:
-                gid = futures[future]
-                try:
-                    # Wait for result with a timeout to allow KeyboardInterrupt to be caught immediately
-                    while not future.done():
-                        try:
-                            future.result(timeout=0.5)
-                        except TimeoutError:
-                            continue
-                    # Just in case it finished right after Loop?
-                    future.result()
-                except TimeoutError:
-                    if sys.version_info >= (3, 3):
-                        pass
-                    pass
-                except Exception as e:
-                    print(f"ID {gid}: An error occurred during processing: {e}")
-                    import traceback
-                    traceback.print_exc()
-        except KeyboardInterrupt:
-            print("\nProcessing interrupted by user. Exiting IMMEDIATELY...")
-            os._exit(1)
-
-    # Final cleanup of temp root
+    DUPLICATE_MODE = args.duplicates or config.get("duplicates", {}).get("mode", "flag")
+    if DUPLICATE_MODE != "off":
+        print(f"Re-upload detection: {DUPLICATE_MODE}")
+        index_signatures()
+
+    # Job states survive crashes: --resume continues a range, --retry_failed redoes its failures
+    jobs_config = config.get("jobs", {})
+    if jobs_config.get("enabled", True):
+        jobs_path = jobs_config.get("path") or os.path.join(os.path.dirname(os.path.abspath(__file__)), JOBS_DB_NAME)
+        JOB_STORE = JobStore(
+            jobs_path,
+            max_attempts=jobs_config.get("max_attempts", 5),
+            backoff=jobs_config.get("backoff_minutes", 10) * 60,
+            max_backoff=jobs_config.get("max_backoff_hours", 24) * 3600
+        )
+        print(f"Job table: {jobs_path}")
+        states = JOB_STORE.count_states(start, end)
+        unfinished = sum(states.get(state, 0) for state in ("pending", "fetched", "downloading"))
+        if unfinished:
+            print(f"{unfinished} IDs were left unfinished by an earlier run, they are processed again.")
+    elif args.resume or args.retry_failed or args.report:
+        print("Error: --resume, --retry_failed and --report need the job table (jobs.enabled in config.json)")
+        return
+
+    # IDs are generated lazily and checked against the index chunk by chunk,
+    # so memory use does not grow with the size of the range
+    pipeline_config = config.get("pipeline", {})
+    if args.retry_failed:
+        ids = JOB_STORE.get_retry_ids(start, end)
+        print(f"Retrying {len(ids)} failed IDs (up to {JOB_STORE.max_attempts} attempts each)")
+    else:
+        lookup = COMPLETED_INDEX.get_completed_ids
+        if args.resume:
+            def lookup(low, high):
+                return COMPLETED_INDEX.get_completed_ids(low, high) | JOB_STORE.get_settled_ids(low, high)
+        discovery_config = config.get("discovery", {})
+        candidates = None
+        if args.discover or discovery_config.get("enabled", False):
+            candidates = discover_ids(discovery_config, start, end, rules)
+        ids = PendingIds(start, end, lookup, chunk_size=pipeline_config.get("id_chunk_size", 10000),
+                         candidates=candidates)
+
+    # Page processing pool, shared by all galleries in the process stage
+    image_config = config.get("image", {})
+    image_workers = image_config.get("workers") or os.cpu_count() or 2
+    if args.image_workers is not None:
+        image_workers = args.image_workers
+    IMAGE_POOL = create_image_pool(image_workers, image_config.get("pool", "thread"))
+    IMAGE_PASSTHROUGH = image_config.get("passthrough", True) and not args.no_passthrough
+    # 0 disables the JPEG draft / reduce() fast path (full resolution decode + LANCZOS)
+    IMAGE_OVERSAMPLE = image_config.get("downscale_oversample", DOWNSCALE_OVERSAMPLE)
     try:
-        if os.path.exists(TEMP_DIR):
-            shutil.rmtree(TEMP_DIR)
-    except:
-        pass
+        IMAGE_OUTPUT = OutputFormat(
+            args.codec or image_config.get("codec", "jpeg"),
+            quality=args.quality if args.quality is not None else image_config.get("quality", JPEG_QUALITY),
+            threads=image_config.get("encoder_threads", 0),
+            speed=image_config.get("encoder_speed"))
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    print(f"Image processing: {image_workers} {image_config.get('pool', 'thread')} workers, "
+          f"{IMAGE_OUTPUT.codec.upper()} quality {IMAGE_OUTPUT.quality}")
+
+    # In-memory mode: download -> process -> CBZ without touching TEMP_DIR
+    memory_config = config.get("memory_mode", {})
+    if args.in_memory or memory_config.get("enabled", False):
+        MEMORY_BUDGET = ByteBudget(int(memory_config.get("budget_mb", 1024) * 1024 * 1024))
+        PAGE_ESTIMATE = int(memory_config.get("page_estimate_mb", 2) * 1024 * 1024)
+        print(f"In-memory mode: {memory_config.get('budget_mb', 1024)} MB budget, larger galleries use the temp dir")
+
+    # Temp disk backpressure: downloads wait while the galleries in TEMP_DIR
+    # exceed the high watermark, until they drop below the low watermark
+    disk_config = config.get("temp_budget", {})
+    if disk_config.get("enabled", False):
+        gb = 1024 ** 3
+        high = disk_config.get("high_gb", 20)
+        TEMP_BUDGET = DiskBudget(TEMP_DIR, int(high * gb), int(disk_config.get("low_gb", high * 0.6) * gb),
+                                 int(disk_config.get("page_estimate_mb", 2) * 1024 * 1024),
+                                 min_free=int(disk_config.get("min_free_gb", 2) * gb))
+        OUTPUT_BUDGET = DiskBudget(OUTPUT_DIR, float("inf"), float("inf"), 0,
+                                   min_free=int(disk_config.get("output_min_free_gb", 5) * gb), name="output")
+        print(f"Temp disk budget: {high} GB high / {TEMP_BUDGET.low / gb:g} GB low watermark, "
+              f"{disk_config.get('min_free_gb', 2)} GB kept free")
+
+    # Same knobs gallery-dl gets through gd_config_temp.json
+    downloader_config = config.get("downloader") or {}
+    DOWNLOAD_OPTIONS = {
+        "timeout": downloader_config.get("timeout", 30.0),
+        "retries": downloader_config.get("retries", 4),
+        "sleep": downloader_config.get("sleep", 0),
+    }
+    CHECKPOINT_VERIFY = config.get("checkpoint", {}).get("verify_hashes", False)
+
+    # AIMD: start at the configured worker counts, then follow latency / errors / 429s
+    adaptive_config = config.get("adaptive_concurrency", {})
+    if adaptive_config.get("enabled", False) and not args.fixed_workers:
+        tuning = {key: adaptive_config[key] for key in
+                  ("window", "increase", "decrease", "max_error_rate", "latency_factor", "cooldown")
+                  if key in adaptive_config}
+        for name, initial in (("metadata", pipeline_config.get("fetch_workers", 4)), ("download", max_workers)):
+            limits = adaptive_config.get(name, {})
+            limiter = AdaptiveLimiter(name, initial, limits.get("min", 1), limits.get("max", max(initial, 8)), **tuning)
+            print(f"Adaptive concurrency ({name}): {limiter.limit} (min {limiter.minimum}, max {limiter.maximum})")
+            if name == "metadata":
+                METADATA_LIMITER = limiter
+            else:
+                DOWNLOAD_LIMITER = limiter
+                DOWNLOAD_OPTIONS["observer"] = limiter.record
+
+    # Pages of the -j page list are fetched over pooled keep-alive connections
+    page_config = config.get("page_downloader", {})
+    if page_config.get("engine", "async") == "async":
+        PAGE_DOWNLOADER = AsyncPageDownloader(page_config.get("connections_per_host", 6), **DOWNLOAD_OPTIONS)
+        print(f"Page downloader: asyncio, {PAGE_DOWNLOADER.connections_per_host} connections per host")
+
+    if args.profile:
+        PROFILER = Profiler(os.path.abspath(args.profile),
+                            snapshot_every=config.get("profiling", {}).get("snapshot_every", 10))
+        print(f"Profiling to {PROFILER.directory}")
+
+    scheduler = None
+
+    def on_done(job):
+        scheduler.done(job)
+
+    pipeline = build_pipeline(config, max_workers, rules, on_done=on_done)
+    scheduler = Scheduler(pipeline, max(1, pipeline_config.get("max_in_flight", 64)))
+    print("Starting pipeline for IDs {}-{} ({} in flight max; {})...".format(
+        start, end, scheduler.max_in_flight,
+        ", ".join(f"{stage.name}: {stage.workers}" for stage in pipeline.stages)))
+
+    # Metrics: JSON summary at the end, Prometheus textfile refreshed while running
+    metrics_config = config.get("metrics", {})
+    summary_path = args.metrics_json or metrics_config.get("summary_path") or None
+    textfile_path = args.prom_textfile or metrics_config.get("textfile_path") or None
+    METRICS.add_gauge("queue_depth", "Galleries waiting in each stage's input queue",
+                      lambda: {(("stage", name),): depth for name, depth in pipeline.queue_depths().items()})
+    METRICS.add_gauge("in_flight", "Galleries between submission and completion",
+                      lambda: {(): scheduler.in_flight})
+    for limiter in (METADATA_LIMITER, DOWNLOAD_LIMITER):
+        if limiter is not None:
+            METRICS.add_gauge(f"{limiter.name}_concurrency", f"Current adaptive {limiter.name} concurrency limit",
+                              lambda limiter=limiter: {(): limiter.limit})
+    for budget in (TEMP_BUDGET, OUTPUT_BUDGET):
+        if budget is not None:
+            METRICS.add_gauge(f"{budget.name}_bytes_reserved", f"Bytes reserved for galleries in the {budget.name} directory",
+                              lambda budget=budget: {(): budget.used})
+    if textfile_path:
+        METRICS.start_export(textfile_path, metrics_config.get("refresh_interval", 15))
+        print(f"Prometheus textfile: {textfile_path}")
+
+    def new_job(gid):
+        if JOB_STORE is not None:
+            JOB_STORE.start(gid)
+        return GalleryJob(gid)
+
+    pipeline.start()
+    try:
+        scheduler.run(new_job(gid) for gid in ids)
+        IMAGE_POOL.shutdown()
+        if PAGE_DOWNLOADER is not None:
+            PAGE_DOWNLOADER.close()
+    except KeyboardInterrupt:
+        print("\nProcessing interrupted by user. Exiting IMMEDIATELY...")
+        # Partial metrics are still useful to see where the run was stuck
+        write_metrics(summary_path, textfile_path)
+        write_report(args.report, start, end)
+        os._exit(1)
+
+    if args.retry_failed:
+        print(f"Galleries: {scheduler.completed} retried")
+    else:
+        print(f"Galleries: {scheduler.completed} handled, {ids.skipped} already processed (of {len(ids)} IDs)")
+    print(f"Pages: {PAGE_STATS['passthrough']} passed through, {PAGE_STATS['transcoded']} transcoded")
+    if PAGE_STATS["bytes_in"]:
+        print(f"Page size: {size_change(PAGE_STATS['bytes_in'], PAGE_STATS['bytes_out'])}, "
+              f"encode {PAGE_STATS['encode_ms'] / 1000:.1f}s")
+    for budget in (TEMP_BUDGET, OUTPUT_BUDGET):
+        if budget is not None and budget.waits:
+            print(f"Disk budget ({budget.name}): {budget.waits} galleries waited for space")
+    print_stage_summary()
+    print_filter_summary(rules)
+    METRICS.stop_export()
+    write_metrics(summary_path, textfile_path)
+    if JOB_STORE is not None:
+        states = JOB_STORE.count_states(start, end)
+        print("Job states: " + ", ".join(f"{state} {count}" for state, count in sorted(states.items())))
+        if states.get("failed"):
+            print("Failed IDs can be retried with --retry_failed (see --report for the errors).")
+    write_report(args.report, start, end)
+
+    # Final cleanup of temp root. Folders of unfinished galleries are kept so the
+    # next run can resume them from their checkpoint.
+    if os.path.exists(TEMP_DIR):
+        leftover = os.listdir(TEMP_DIR)
+        if leftover:
+            print(f"Keeping {len(leftover)} unfinished galleries in {TEMP_DIR} for resume.")
+        else:
+            try:
+                os.rmdir(TEMP_DIR)
+            except OSError:
+                pass
 
     if os.path.exists("gd_config_temp.json"):
         try:
@@ -1,5 +1,6 @@
 import sqlite3
 import os
+import json
 from datetime import datetime
 
 DB_NAME = "organizer.db"
@@ -38,6 +39,46 @@ class DBManager:
         )
         ''')
 
+        # Downloads table (IDs completed by hitomi_dl, before or after organizing)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS downloads (
+            id INTEGER PRIMARY KEY,
+            filename TEXT,
+            downloaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+        # Signature index (normalized author|title|language|pages -> ID) for re-upload detection
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS signatures (
+            signature TEXT,
+            id INTEGER,
+            PRIMARY KEY (signature, id)
+        )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_signatures_id ON signatures(id)")
+        # IDs that could not be signed (no archive / no cached metadata), so startup does not retry them every run
+        cursor.execute("CREATE TABLE IF NOT EXISTS unsignable (id INTEGER PRIMARY KEY)")
+
+        # Integrity manifests of CBZs written by hitomi_dl (entries: JSON [[name, crc, size], ...]).
+        # verified_size / verified_mtime: the file as of the last good check, to skip unchanged files
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS manifests (
+            id INTEGER PRIMARY KEY,
+            path TEXT,
+            size INTEGER,
+            mtime REAL,
+            pages INTEGER,
+            sha256 TEXT,
+            entries TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            verified_size INTEGER,
+            verified_mtime REAL,
+            verified_at TIMESTAMP,
+            status TEXT
+        )
+        ''')
+
         # Author Settings table (for default category preference)
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS author_settings (
@@ -103,15 +144,16 @@ class DBManager:
         Insert or Update gallery metadata.
         data: dict containing keys matching table columns.
         """
+        self.upsert_galleries([data])
+
+    def upsert_galleries(self, rows):
+        """upsert_gallery for many dicts in one transaction (bulk import)"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
         # Prepare fields
         fields = ["id", "title", "original_filename", "current_path", "author", "category", "series", "tags", "language"]
         
-        # Extract values, default to None
-        values = [data.get(f) for f in fields]
-        
         # Construct query
         placeholders = ", ".join(["?"] * len(fields))
         update_assignments = ", ".join([f"{f}=excluded.{f}" for f in fields])
@@ -121,7 +163,164 @@ class DBManager:
         ON CONFLICT(id) DO UPDATE SET {update_assignments}, imported_at=CURRENT_TIMESTAMP
         '''
         
-        cursor.execute(query, values)
+        # Extract values, default to None
+        cursor.executemany(query, [[data.get(f) for f in fields] for data in rows])
+        conn.commit()
+        conn.close()
+
+    # --- Completed ID Index (shared with hitomi_dl) ---
+
+    def mark_downloaded(self, gallery_id, filename):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO downloads (id, filename) VALUES (?, ?)", (gallery_id, filename))
+        conn.commit()
+        conn.close()
+
+    def add_downloads(self, rows):
+        """Bulk insert of (id, filename) pairs; existing IDs are kept."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany("INSERT OR IGNORE INTO downloads (id, filename) VALUES (?, ?)", rows)
+        conn.commit()
+        conn.close()
+
+    def count_downloads(self):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT count(*) FROM downloads")
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
+
+    def get_completed_ids(self, start_id, end_id):
+        """
+        IDs in [start_id, end_id] that were downloaded or are in the organized library.
+        Both lookups are primary key range scans, so this stays fast on large libraries.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT id FROM downloads WHERE id BETWEEN ? AND ?
+        UNION
+        SELECT id FROM galleries WHERE id BETWEEN ? AND ?
+        ''', (start_id, end_id, start_id, end_id))
+        ids = {row[0] for row in cursor.fetchall()}
+        conn.close()
+        return ids
+
+    # --- Signature Index (re-upload detection) ---
+
+    def add_signatures(self, rows):
+        """Bulk insert of (signature, id) pairs."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany("INSERT OR IGNORE INTO signatures (signature, id) VALUES (?, ?)", rows)
+        conn.commit()
+        conn.close()
+
+    def find_signature_ids(self, signatures, exclude_id=None):
+        """IDs (other than exclude_id) indexed under any of the signatures."""
+        if not signatures:
+            return []
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        placeholders = ", ".join(["?"] * len(signatures))
+        cursor.execute(f"SELECT DISTINCT id FROM signatures WHERE signature IN ({placeholders}) AND id != ? ORDER BY id",
+                       list(signatures) + [exclude_id if exclude_id is not None else -1])
+        ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return ids
+
+    def get_unsigned_galleries(self):
+        """(id, title, author, language, current_path) of organized galleries not in the signature index (or marked unsignable)."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT id, title, author, language, current_path FROM galleries
+        WHERE id NOT IN (SELECT id FROM signatures) AND id NOT IN (SELECT id FROM unsignable)
+        ''')
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    def get_unsigned_downloads(self):
+        """IDs of downloads that are not in the signature index (or marked unsignable)."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM downloads WHERE id NOT IN (SELECT id FROM signatures) "
+                       "AND id NOT IN (SELECT id FROM unsignable)")
+        ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return ids
+
+    def mark_unsignable(self, ids):
+        """IDs get_unsigned_* skip from now on."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany("INSERT OR IGNORE INTO unsignable (id) VALUES (?)", [(gid,) for gid in ids])
+        conn.commit()
+        conn.close()
+
+    def clear_unsignable(self):
+        """Makes every unsigned ID a candidate again (e.g. after a rescan)."""
+        conn = self.get_connection()
+        conn.execute("DELETE FROM unsignable")
+        conn.commit()
+        conn.close()
+
+    # --- Integrity Manifests ---
+
+    def put_manifest(self, gallery_id, manifest):
+        """Stores the manifest of a new CBZ (see downloader.manifest.build_manifest); it counts as verified."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        INSERT OR REPLACE INTO manifests
+            (id, path, size, mtime, pages, sha256, entries, verified_size, verified_mtime, verified_at, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, 'ok')
+        ''', (gallery_id, manifest["path"], manifest["size"], manifest["mtime"], manifest["pages"],
+              manifest["sha256"], json.dumps(manifest["entries"], ensure_ascii=False),
+              manifest["size"], manifest["mtime"]))
+        conn.commit()
+        conn.close()
+
+    def get_manifests(self, start_id=None, end_id=None):
+        """
+        (id, manifest, path, (verified_size, verified_mtime) or None) of the stored manifests.
+        path: the organized location if the organizer moved the file, else the manifest's.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        query = '''
+        SELECT m.id, m.path, m.size, m.mtime, m.pages, m.sha256, m.entries, m.verified_size, m.verified_mtime,
+               m.status, g.current_path
+        FROM manifests m LEFT JOIN galleries g ON g.id = m.id
+        '''
+        if start_id is not None:
+            query += " WHERE m.id BETWEEN ? AND ?"
+            cursor.execute(query + " ORDER BY m.id", (start_id, end_id))
+        else:
+            cursor.execute(query + " ORDER BY m.id")
+        rows = []
+        for gid, path, size, mtime, pages, sha256, entries, v_size, v_mtime, status, current_path in cursor.fetchall():
+            manifest = {"path": path, "size": size, "mtime": mtime, "pages": pages, "sha256": sha256,
+                        "entries": json.loads(entries)}
+            # Only a file that passed its last check may be skipped while unchanged
+            previous = (v_size, v_mtime) if status == "ok" and v_size is not None else None
+            rows.append((gid, manifest, current_path or path, previous))
+        conn.close()
+        return rows
+
+    def set_verify_results(self, rows):
+        """Bulk update of (status, size, mtime, id) after a verify pass; size/mtime None keeps the last good ones."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany('''
+        UPDATE manifests SET status = ?, verified_size = COALESCE(?, verified_size),
+            verified_mtime = COALESCE(?, verified_mtime), verified_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+        ''', rows)
         conn.commit()
         conn.close()
 
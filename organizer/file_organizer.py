@@ -2,7 +2,16 @@ import os
 import shutil
 import logging
 from .db_manager import DBManager
-from .metadata_utils import extract_id_from_filename, fetch_metadata
+from .metadata_utils import extract_id_from_filename, fetch_metadata, parse_metadata, read_embedded_metadata
+
+# Gallery type (hitomi / gallery-dl) -> default category
+CATEGORY_BY_TYPE = {
+    "doujinshi": "Doujinshi",
+    "manga": "Manga",
+    "gamecg": "Game CG",
+    "artistcg": "Artist CG",
+    "anime": "Anime",
+}
 
 class FileOrganizer:
     def __init__(self, db_manager: DBManager):
@@ -19,7 +28,11 @@ class FileOrganizer:
 
         filename = os.path.basename(file_path)
         gallery_id = extract_id_from_filename(filename)
+        embedded = None
 
+        if not gallery_id:
+            embedded = read_embedded_metadata(file_path)
+            gallery_id = embedded.gallery_id if embedded else None
         if not gallery_id:
             return False, f"Could not extract ID from filename: {filename}", None
 
@@ -41,11 +54,16 @@ class FileOrganizer:
                 "language": db_data[8]
             }
         else:
-            
+            # Metadata written into the CBZ by hitomi_dl (no network lookup)
+            embedded = embedded or read_embedded_metadata(file_path)
+            if embedded:
+                metadata = parse_metadata(embedded, gallery_id)
+                if metadata["author"] == "N_A":
+                    metadata["author"] = self.extract_author_from_filename(filename) or "N_A"
+
             # Webからの取得処理をコメントアウト
             # self.logger.info(f"Fetching metadata for ID {gallery_id}...")
             # metadata = fetch_metadata(gallery_id)
-            metadata = None
             if not metadata:
                 # Fallback: Attempt to proceed without online metadata
                 # We need at least Author to organize.
@@ -155,7 +173,15 @@ class FileOrganizer:
             if db_data:
                 # Return existing category AND author
                 return db_data[5], db_data[4] 
-        
+
+        # Metadata embedded in the CBZ beats the filename guess
+        embedded = read_embedded_metadata(file_path)
+        if embedded:
+            metadata = parse_metadata(embedded, gallery_id or embedded.gallery_id)
+            if metadata["author"] != "N_A":
+                author_from_file = metadata["author"]
+            potential_cat = CATEGORY_BY_TYPE.get((embedded.type or "").lower())
+
         # 2. Author History
         if author_from_file:
             primary = self.db.get_primary_author(author_from_file)
@@ -164,3 +190,42 @@ class FileOrganizer:
                 potential_cat = saved_cat
         
         return potential_cat, author_from_file
+
+    def import_library(self, directory):
+        """
+        Bulk import of the CBZs below `directory` whose embedded metadata
+        (written by hitomi_dl) makes a complete record; no network lookups.
+        Files keep their place: the category is the first folder below
+        `directory` if it is a known category, else the gallery type's.
+        Galleries already in the DB are left alone.
+        Returns (imported, already known, without metadata).
+        """
+        categories = set(self.db.get_all_categories())
+        rows = []
+        known = missing = 0
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                if not filename.lower().endswith(".cbz"):
+                    continue
+                path = os.path.join(root, filename)
+                gallery_id = extract_id_from_filename(filename)
+                if gallery_id and self.db.get_gallery_by_id(gallery_id):
+                    known += 1
+                    continue
+                embedded = read_embedded_metadata(path)
+                gallery_id = gallery_id or (embedded.gallery_id if embedded else None)
+                if not embedded or not gallery_id:
+                    missing += 1
+                    continue
+                metadata = parse_metadata(embedded, gallery_id)
+                folder = os.path.relpath(path, directory).split(os.sep)[0]
+                if folder in categories:
+                    metadata["category"] = folder
+                else:
+                    metadata["category"] = CATEGORY_BY_TYPE.get((embedded.type or "").lower(), "Unknown")
+                metadata["current_path"] = path
+                metadata["original_filename"] = filename
+                rows.append(metadata)
+        if rows:
+            self.db.upsert_galleries(rows)
+        return len(rows), known, missing
@@ -85,6 +85,7 @@ class OrganizerApp(TkinterDnD.Tk):
         tools_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Tools", menu=tools_menu)
         tools_menu.add_command(label="Manage Author Aliases", command=self.open_alias_manager)
+        tools_menu.add_command(label="Import Library Metadata", command=self.import_library)
 
     def create_widgets(self):
         # 1. Top Bar: Directory & Category
@@ -501,6 +502,22 @@ class OrganizerApp(TkinterDnD.Tk):
         # Alias manager needs update? It uses DB, independent of list.
         AliasManager(self, self.db)
 
+    def import_library(self):
+        """Registers the CBZs of a folder in the DB from the metadata embedded by hitomi_dl."""
+        directory = filedialog.askdirectory(initialdir=self.dir_entry.get())
+        if not directory:
+            return
+        self.log(f"Importing library metadata from {directory}...")
+        threading.Thread(target=self._execute_import_library, args=(directory,), daemon=True).start()
+
+    def _execute_import_library(self, directory):
+        try:
+            imported, known, missing = self.organizer.import_library(directory)
+        except Exception as e:
+            self.queue_log(f"  Error: {e}")
+            return
+        self.queue_log(f"Import completed: {imported} imported, {known} already in DB, {missing} without metadata")
+
     def run_clean_duplicates(self):
         """Run clean_duplicates.py with the Author from selected files or all files."""
         selected_items = self.tree.selection()
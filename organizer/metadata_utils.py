@@ -1,11 +1,25 @@
-import sys
-import subprocess
 import json
 import re
 import os
+import unicodedata
+import zipfile
+import zlib
+import xml.etree.ElementTree as ET
+from downloader.metadata_backend import get_default_backend
+from downloader.gallery_record import GalleryRecord
+from downloader.archive import is_page
 
-# Assuming gallery-dl is installed and available via python -m gallery_dl
-GALLERY_DL_CMD = [sys.executable, "-m", "gallery_dl"]
+# Metadata entries hitomi_dl writes after the pages: ComicInfo.xml for readers
+# (ComicRack schema) and the GalleryRecord as JSON for the organizer
+COMIC_INFO_NAME = "ComicInfo.xml"
+RECORD_JSON_NAME = "hitomi_dl.json"
+
+GALLERY_URL = "https://hitomi.la/galleries/{}.html"
+
+# ComicInfo LanguageISO of the common gallery languages
+LANGUAGE_ISO = {"japanese": "ja", "english": "en", "chinese": "zh", "korean": "ko", "spanish": "es",
+                "french": "fr", "german": "de", "russian": "ru", "portuguese": "pt", "italian": "it",
+                "thai": "th", "vietnamese": "vi", "indonesian": "id", "polish": "pl"}
 
 def extract_id_from_filename(filename):
     """
@@ -32,68 +46,22 @@ def fetch_metadata(gallery_id):
     Fetches metadata for a given gallery ID using gallery-dl.
     Returns a dictionary of cleaned metadata.
     """
-    url = f"https://hitomi.la/galleries/{gallery_id}.html"
-    
-    cmd = GALLERY_DL_CMD + ["-j", url]
-    
-    try:
-        # Run gallery-dl in JSON mode
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            encoding='utf-8',
-            check=True
-        )
-        
-        # Parse output
-        # gallery-dl -j output can be multiple JSON lines or a single JSON list.
-        # We handle both.
-        data = None
-        try:
-            data = json.loads(result.stdout)
-        except json.JSONDecodeError:
-            # Try line by line, take the first one usually
-            lines = result.stdout.strip().split('\n')
-            for line in lines:
-                if line.strip():
-                    data = json.loads(line)
-                    break 
-                    
-        if not data:
-            return None
-
-        # Extract info from first item (gallery-dl structure handling)
-        info = {}
-        if isinstance(data, list):
-            # [index, metadata_dict] or [metadata_dict, ...]
-            # Hitomi usually returns [index, dict] where index can be -1 on error
-            if len(data) >= 2 and isinstance(data[1], dict):
-                 # Check for valid structure
-                 if isinstance(data[0], int):
-                      info = data[1]
-                 else:
-                      # Maybe list of images?
-                      info = data[0] if isinstance(data[0], dict) else {}
-            elif len(data) > 0 and isinstance(data[0], dict):
-                info = data[0]
-        elif isinstance(data, dict):
-            info = data
-            
-        return parse_metadata(info, gallery_id)
-
-    except subprocess.CalledProcessError as e:
-        print(f"Error executing gallery-dl for {gallery_id}: {e}")
+    # Shared with hitomi_dl: gallery-dl runs in-process when importable,
+    # otherwise one `gallery_dl -j` subprocess per call (stopped after the header).
+    record = get_default_backend().fetch(gallery_id, header_only=True)
+    if not record:
         return None
-    except Exception as e:
-        print(f"Unexpected error fetching metadata for {gallery_id}: {e}")
+    if record.error:
+        print(f"Error fetching metadata for {gallery_id}: {record.error}")
         return None
 
-def parse_metadata(info, gallery_id):
+    return parse_metadata(record, gallery_id)
+
+def parse_metadata(record, gallery_id):
     """
-    Cleans up and normalizes the raw metadata dictionary.
+    Cleans up and normalizes a GalleryRecord.
     """
-    if not info:
+    if not record:
         return None
 
     def format_field(value):
@@ -103,8 +71,8 @@ def parse_metadata(info, gallery_id):
 
     # Author (Artist or Group)
     # Prioritize Artist, then Group
-    artist = info.get('artist')
-    group = info.get('group')
+    artist = record.artist
+    group = record.group
     
     author = "N_A"
     if artist:
@@ -117,26 +85,155 @@ def parse_metadata(info, gallery_id):
     # Spec didn't explicitly say for DB, but hitomi_dl logic preferred JPN.
     # Let's save standard title as 'title', maybe save original in separate field if needed.
     # Let's stick to 'title' field from JSON which is usually the main title.
-    title = info.get('title')
-    jpn_title = info.get('title_jpn')
+    title = record.title
+    jpn_title = record.title_jpn
     if jpn_title:
         title = jpn_title # Use JPN title as primary display title if available
 
-    # Series (Parody)
-    series = format_field(info.get('parody'))
-    if not series:
-         series = format_field(info.get('series'))
+    # Series (Parody, or 'series' of other extractors)
+    series = format_field(record.parody)
 
     # Tags
-    tags_list = info.get('tags', [])
+    tags_list = record.tags or []
     tags_str = json.dumps(tags_list, ensure_ascii=False)
 
     return {
         "id": gallery_id,
         "title": title,
         "author": author,
-        "category": info.get('type', 'Unknown'), # Default category from Metadata
+        "category": record.type or 'Unknown', # Default category from Metadata
         "series": series,
         "tags": tags_str,
-        "language": info.get('language')
+        "language": record.language
     }
+
+def _names(value):
+    if not value:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+def comic_info_xml(record):
+    """ComicInfo.xml of a GalleryRecord (bytes)"""
+    root = ET.Element("ComicInfo")
+
+    def add(name, value):
+        if value not in (None, "", []):
+            ET.SubElement(root, name).text = str(value)
+
+    add("Title", record.title_jpn or record.title)
+    add("Series", ", ".join(_names(record.parody)))
+    add("Writer", ", ".join(_names(record.artist)))
+    add("Teams", ", ".join(_names(record.group)))
+    add("Characters", ", ".join(_names(record.characters)))
+    add("Genre", record.type)
+    add("Tags", ", ".join(_names(record.tags)))
+    add("LanguageISO", LANGUAGE_ISO.get((record.language or "").lower()))
+    add("PageCount", record.page_count)
+    if record.gallery_id is not None:
+        add("Web", GALLERY_URL.format(record.gallery_id))
+    date = re.match(r"(\d{4})-(\d{2})-(\d{2})", record.date or "")
+    if date:
+        for name, value in zip(("Year", "Month", "Day"), date.groups()):
+            add(name, int(value))
+    add("Manga", "Yes")
+    return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+
+def metadata_entries(record):
+    """[(name, data), ...] of the metadata entries for the CBZ of a GalleryRecord"""
+    data = record.to_dict()
+    # Page URLs expire; the count is what the organizer needs
+    data.pop("pages", None)
+    data["count"] = record.page_count
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return [(COMIC_INFO_NAME, comic_info_xml(record)), (RECORD_JSON_NAME, raw)]
+
+def _record_from_comic_info(data):
+    """GalleryRecord of a ComicInfo.xml (written by hitomi_dl or another tool)"""
+    root = ET.fromstring(data)
+
+    def text(name):
+        value = root.findtext(name)
+        return value.strip() if value and value.strip() else None
+
+    def names(name):
+        value = text(name)
+        return [part.strip() for part in value.split(",") if part.strip()] if value else []
+
+    languages = {iso: name for name, iso in LANGUAGE_ISO.items()}
+    count = text("PageCount")
+    return GalleryRecord(title=text("Title"), artist=names("Writer"), group=names("Teams"),
+                         parody=names("Series"), characters=names("Characters"), tags=names("Tags"),
+                         type=text("Genre"), language=languages.get(text("LanguageISO") or ""),
+                         count=int(count) if count and count.isdigit() else None)
+
+def read_embedded_metadata(path):
+    """
+    GalleryRecord embedded in a CBZ (hitomi_dl.json, else ComicInfo.xml), or None.
+    Only the zip directory and the metadata entry are read, never the pages.
+    """
+    try:
+        with zipfile.ZipFile(path) as zf:
+            names = set(zf.namelist())
+            if RECORD_JSON_NAME in names:
+                return GalleryRecord.from_dict(json.loads(zf.read(RECORD_JSON_NAME)))
+            if COMIC_INFO_NAME in names:
+                return _record_from_comic_info(zf.read(COMIC_INFO_NAME))
+    except (OSError, zipfile.BadZipFile, zlib.error, ValueError, TypeError, ET.ParseError):
+        pass
+    return None
+
+def normalize_text(value):
+    """
+    Normalization used for signatures: NFKC, case-folded, bracketed tags such as
+    [Digital], (C97) or {Translated} removed, punctuation collapsed to single spaces.
+    """
+    text = unicodedata.normalize("NFKC", str(value or "")).casefold()
+    stripped = re.sub(r"\[[^\]]*\]|\([^)]*\)|\{[^}]*\}|【[^】]*】", " ", text)
+    # A title that is only tags keeps them
+    if re.search(r"\w", stripped):
+        text = stripped
+    return " ".join(re.findall(r"\w+", text))
+
+def normalize_names(value):
+    """Artist list (or "a, b" string) as a sorted, normalized, comma separated string"""
+    if isinstance(value, str):
+        value = value.split(",")
+    names = {normalize_text(name) for name in value or ()}
+    names.discard("")
+    names.discard("n_a")  # "N_A" placeholder
+    return ",".join(sorted(names))
+
+def gallery_signatures(author, titles, language, page_count):
+    """
+    Signatures of a work: normalized author | title | language | page count.
+    One per distinct title variant (e.g. romanized and Japanese), so galleries
+    indexed under either title match. Returns an empty list when the author or
+    page count is unknown (too weak to call two galleries the same work).
+    """
+    author = normalize_names(author)
+    if not author or not page_count:
+        return []
+    language = normalize_text(language)
+    signatures = []
+    for title in titles:
+        title = normalize_text(title)
+        if title:
+            signature = f"{author}|{title}|{language}|{int(page_count)}"
+            if signature not in signatures:
+                signatures.append(signature)
+    return signatures
+
+def metadata_signatures(record):
+    """Signatures of a gallery from its GalleryRecord (see gallery_signatures)"""
+    if not record or record.error:
+        return []
+    return gallery_signatures(record.artist or record.group, (record.title, record.title_jpn),
+                              record.language, record.page_count)
+
+def cbz_page_count(path):
+    """Number of page images in an archive (read from the zip directory only), or None"""
+    try:
+        with zipfile.ZipFile(path) as zf:
+            return sum(1 for name in zf.namelist() if is_page(name))
+    except (OSError, zipfile.BadZipFile):
+        return None
@@ -0,0 +1,1073 @@
+import os
+import io
+import json
+import array
+import functools
+import sys
+import time
+import types
+import datetime
+import tempfile
+import unittest
+import contextlib
+import threading
+import http.server
+import urllib.error
+from unittest.mock import patch
+
+import hitomi_dl
+from downloader import metadata_backend
+from downloader.metadata_backend import create_backend, InProcessBackend, SubprocessBackend
+from downloader.metadata_cache import MetadataCache, filter_key
+from downloader.job_store import JobStore
+from downloader.pipeline import Stage, Pipeline
+from downloader.scheduler import PendingIds, Scheduler
+from downloader.concurrency import AdaptiveLimiter, classify_error
+from downloader.imaging import OutputFormat, create_image_pool, process_page, process_page_data
+from downloader.gallery_record import GalleryRecord, iter_messages, read_record
+from downloader.async_pages import AsyncPageDownloader
+from downloader.discovery import IndexDiscovery, parse_nozomi
+from downloader.gallery_header import fetch_header, parse_galleryblock
+from downloader.filters import FilterRules, Rejection
+from downloader.budget import ByteBudget, DiskBudget, DiskSpaceError
+from downloader.archive import CbzWriter
+from downloader.manifest import build_manifest, verify_library
+from organizer.db_manager import DBManager
+from organizer.metadata_utils import cbz_page_count
+from downloader.checkpoint import Checkpoint
+from downloader.metrics import Metrics
+from downloader import profiling
+from downloader.profiling import Profiler
+import zipfile
+from PIL import Image
+
+
+def make_fake_gallery_dl(messages):
+    """Builds a stand-in `gallery_dl` package whose DataJob yields `messages`."""
+    package = types.ModuleType("gallery_dl")
+    config = types.ModuleType("gallery_dl.config")
+    exception = types.ModuleType("gallery_dl.exception")
+    job = types.ModuleType("gallery_dl.job")
+
+    config.load = lambda files=None: None
+
+    class StopExtraction(Exception):
+        pass
+
+    class DataJob:
+        def __init__(self, url, file=None):
+            self.url = url
+            self.data = []
+            self.dispatched = 0
+
+        def run(self):
+            # Messages are handled one at a time as the extractor yields them
+            try:
+                for message in messages:
+                    self.dispatched += 1
+                    if message[0] == 2:
+                        self.handle_directory(message[1])
+                    else:
+                        self.handle_url(message[1], message[2])
+            except StopExtraction:
+                pass
+            job.last = self
+            return 0
+
+        def handle_directory(self, kwdict):
+            self.data.append((2, kwdict))
+
+        def handle_url(self, url, kwdict):
+            self.data.append((3, url, kwdict))
+
+    exception.StopExtraction = StopExtraction
+    job.DataJob = DataJob
+    package.config = config
+    package.exception = exception
+    package.job = job
+    return {"gallery_dl": package, "gallery_dl.config": config, "gallery_dl.exception": exception,
+            "gallery_dl.job": job}
+
+
+class TestMetadataBackend(unittest.TestCase):
+    def setUp(self):
+        InProcessBackend._loaded_configs = set()
+
+    def test_auto_falls_back_to_subprocess(self):
+        # A None entry in sys.modules makes the import fail
+        with patch.dict(sys.modules, {"gallery_dl": None}):
+            backend = create_backend("auto")
+        self.assertIsInstance(backend, SubprocessBackend)
+
+    def test_inprocess_required(self):
+        with patch.dict(sys.modules, {"gallery_dl": None}):
+            with self.assertRaises(ImportError):
+                create_backend("inprocess")
+
+    def test_inprocess_matches_json_output(self):
+        messages = [
+            (2, {"gallery_id": 1, "title": "T", "date": datetime.datetime(2017, 3, 14, 7, 49)}),
+            (3, "https://example.org/1.webp", {"num": 1}),
+        ]
+        with patch.dict(sys.modules, make_fake_gallery_dl(messages)):
+            backend = create_backend("auto")
+            self.assertIsInstance(backend, InProcessBackend)
+            record = backend.fetch(1)
+
+        # Same record as from `gallery_dl -j`: datetimes as strings
+        self.assertEqual((record.gallery_id, record.title, record.date), (1, "T", "2017-03-14 07:49:00"))
+        self.assertEqual(record.pages, [("https://example.org/1.webp", "hitomi_1_001.webp", None)])
+
+    def test_inprocess_header_only_stops_the_extractor(self):
+        messages = [(2, {"gallery_id": 1, "title": "T"})] + [
+            (3, f"https://example.org/{num}.webp", {"num": num}) for num in range(1, 4)]
+        modules = make_fake_gallery_dl(messages)
+        with patch.dict(sys.modules, modules):
+            record = create_backend("inprocess").fetch(1, header_only=True)
+        self.assertEqual((record.title, record.pages), ("T", []))
+        self.assertEqual(modules["gallery_dl.job"].last.dispatched, 1)
+
+    def test_subprocess_output_is_parsed_while_streaming(self):
+        # Prints the header, then hangs: only a header_only fetch can return
+        script = ("import json, sys, time; sys.stdout.write(json.dumps([[2, {'gallery_id': 5, 'title': 'T'}]], indent=1)[:-1]);"
+                  "sys.stdout.flush(); time.sleep(30)")
+        backend = SubprocessBackend(cmd=[sys.executable, "-c", script])
+        t0 = time.monotonic()
+        record = backend.fetch(5, header_only=True)
+        self.assertLess(time.monotonic() - t0, 10)
+        self.assertEqual((record.gallery_id, record.title, record.pages), (5, "T", []))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            metadata_backend.create_backend("bogus")
+
+
+class _TrickleReader(io.BytesIO):
+    """Returns at most `step` bytes per read, like a slow pipe."""
+    def __init__(self, data, step=7):
+        super().__init__(data)
+        self.step = step
+
+    def read1(self, size=-1):
+        return super().read1(self.step)
+
+
+class TestGalleryRecord(unittest.TestCase):
+    MESSAGES = [
+        [2, {"gallery_id": 9, "title": "タイトル", "artist": ["a"], "series": "s", "tags": ["t"], "language": "japanese"}],
+        [3, "https://a/1.webp", {"gallery_id": 9, "num": 1, "extension": "webp"}],
+        [3, "https://a/2.webp", {"gallery_id": 9, "num": 2, "extension": "webp"}],
+    ]
+
+    def test_streamed_json_list_and_line_formats(self):
+        for text in (json.dumps(self.MESSAGES, indent=4, ensure_ascii=False),
+                     "\n".join(json.dumps(message) for message in self.MESSAGES) + "\n"):
+            stream = _TrickleReader(text.encode("utf-8"))
+            self.assertEqual(list(iter_messages(stream)), self.MESSAGES)
+
+        # Single bytes split multi-byte characters (Japanese titles, ♀/♂ tags)
+        messages = [[2, {"gallery_id": 9, "title": "タイトル", "tags": ["big breasts ♀"]}]]
+        for text in (json.dumps(messages, ensure_ascii=False), json.dumps(messages[0], ensure_ascii=False) + "\n"):
+            self.assertEqual(list(iter_messages(_TrickleReader(text.encode("utf-8"), step=1))), messages)
+
+        record = read_record(_TrickleReader(json.dumps(self.MESSAGES).encode("utf-8")))
+        self.assertEqual((record.title, record.parody, record.page_count), ("タイトル", "s", 2))
+        self.assertEqual(record.entries()[1], ("https://a/2.webp", "hitomi_9_002.webp"))
+
+        # header_only stops reading after the gallery-level record
+        stream = _TrickleReader(json.dumps(self.MESSAGES).encode("utf-8"))
+        self.assertEqual(read_record(stream, header_only=True).pages, [])
+        self.assertLess(stream.tell(), len(stream.getvalue()))
+
+    def test_error_and_empty_output(self):
+        record = read_record(io.StringIO('[[-1, {"error": "HttpError", "message": "404 Not Found"}]]'))
+        self.assertEqual(record.error, "404 Not Found")
+        self.assertIsNone(read_record(io.StringIO("")))
+        self.assertIsNone(read_record(io.StringIO("[]")))
+
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = MetadataCache(os.path.join(self.tmp.name, "cache.db"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_metadata_roundtrip_and_ttl(self):
+        record = GalleryRecord.from_messages([[2, {"title": "タイトル", "tags": ["a"]}], [3, "https://a/1.webp", {}]])
+        self.cache.put_metadata(10, record)
+        self.assertEqual(self.cache.get_metadata(10).to_dict(), record.to_dict())
+        self.assertIsNone(self.cache.get_metadata(11))
+
+        self.cache.ttl = -1
+        self.assertIsNone(self.cache.get_metadata(10))
+
+    def test_errors_have_own_ttl(self):
+        self.cache.put_error(20, "HttpError: 404")
+        self.assertEqual(self.cache.get_error(20), "HttpError: 404")
+        self.cache.error_ttl = -1
+        self.assertIsNone(self.cache.get_error(20))
+
+        # Successful fetch clears the error
+        self.cache.error_ttl = 3600
+        self.cache.put_metadata(20, GalleryRecord(gallery_id=20))
+        self.assertIsNone(self.cache.get_error(20))
+
+    def test_rejection_tied_to_filter_settings(self):
+        key = filter_key("japanese", ["male:yaoi"], [])
+        self.cache.put_rejection(30, key)
+        self.assertTrue(self.cache.is_rejected(30, filter_key("japanese", ["male:yaoi"], [])))
+        # Changed exclude list -> re-filter from cached metadata
+        self.assertFalse(self.cache.is_rejected(30, filter_key("japanese", ["male:yaoi", "x"], [])))
+
+
+class TestStageFetch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = MetadataCache(os.path.join(self.tmp.name, "cache.db"))
+        self.store = JobStore(os.path.join(self.tmp.name, "jobs.db"), max_attempts=5, backoff=0)
+        self.fetches = []
+        self.error = "HttpError: '503 Service Unavailable' for 'https://hitomi.la/galleries/5.html'"
+
+        test = self
+
+        class Backend:
+            def fetch(self, gid, header_only=False):
+                test.fetches.append(gid)
+                if test.error is None:
+                    return GalleryRecord.from_messages([
+                        [2, {"gallery_id": gid, "artist": ["foo"], "title": "Same Work", "language": "english"}],
+                        [3, "https://a/1.webp", {"num": 1}],
+                    ])
+                return GalleryRecord.from_error(test.error)
+
+        metadata_backend.set_default_backend(Backend())
+        self.addCleanup(metadata_backend.set_default_backend, None)
+        patcher = patch.multiple(hitomi_dl, METADATA_CACHE=self.cache, JOB_STORE=self.store, HEADER_URL=None,
+                                 METADATA_LIMITER=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fetch(self, gid, rules=None):
+        job = hitomi_dl.GalleryJob(gid)
+        self.store.start(gid)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return hitomi_dl.stage_fetch(job, rules or FilterRules())
+
+    def test_transient_errors_are_not_replayed_from_the_cache(self):
+        for _ in range(3):
+            self.assertIsNone(self.fetch(5))
+        # Every retry asked the server again
+        self.assertEqual(self.fetches, [5, 5, 5])
+        self.assertIsNone(self.cache.get_error(5))
+        self.assertEqual(self.store.get_retry_ids(1, 10, now=time.time() + 1), [5])
+
+        # A deleted gallery is cached and not requested again
+        self.error = "HttpError: '404 Not Found' for 'https://hitomi.la/galleries/6.html'"
+        self.fetch(6)
+        self.fetch(6)
+        self.assertEqual(self.fetches, [5, 5, 5, 6])
+
+    def test_missing_galleries_are_cached_whatever_their_id(self):
+        # IDs that look like a status inside the URL of a 404
+        for gid in (429, 503, 1429871):
+            self.error = f"HttpError: '404 Not Found' for 'https://ltn.gold-usergeneratedcontent.net/galleries/{gid}.js'"
+            self.fetch(gid)
+            self.fetch(gid)
+            self.assertEqual(self.cache.get_error(gid), self.error)
+        self.assertEqual(self.fetches, [429, 503, 1429871])
+        # Skipped for good, not queued for --retry_failed
+        self.assertEqual(self.store.get_retry_ids(1, 2000000, now=time.time() + 1), [])
+
+    def test_header_rejections_are_refiltered_from_the_cache(self):
+        headers = []
+
+        def get_header(gid):
+            headers.append(gid)
+            return GalleryRecord(gallery_id=gid, title="T", language="japanese", tags=["yaoi ♂"])
+
+        with patch.object(hitomi_dl, "get_header", get_header):
+            self.assertIsNone(self.fetch(10, FilterRules(exclude_tags=["male:yaoi"])))
+            # Other rules: a new rejection decided from the cached header
+            self.assertIsNone(self.fetch(10, FilterRules(language="english")))
+        self.assertEqual(headers, [10])
+        self.assertEqual(self.fetches, [])
+        self.assertTrue(self.cache.is_rejected(10, FilterRules(language="english").key))
+
+    def test_skip_of_a_claimed_duplicate_is_retried(self):
+        self.error = None
+        index = DBManager(os.path.join(self.tmp.name, "organizer.db"))
+        with patch.multiple(hitomi_dl, DUPLICATE_MODE="skip", COMPLETED_INDEX=index, SIGNATURES_SEEN={}):
+            first = self.fetch(7)
+            self.assertIsNotNone(first)
+            # 7 is not packed yet: the skip stays retryable
+            self.assertIsNone(self.fetch(8))
+            self.assertEqual(self.store.get_retry_ids(1, 10, now=time.time() + 1), [8])
+
+            # 7 failed: the retry of 8 downloads it
+            hitomi_dl.release_signatures(first)
+            self.assertIsNotNone(self.fetch(8))
+
+            # Once a copy is in the index, a duplicate is skipped for good
+            index.add_signatures([(signature, 8) for signature in hitomi_dl.metadata_signatures(first.metadata)])
+            self.assertIsNone(self.fetch(9))
+            self.assertEqual(self.store.get_retry_ids(1, 10, now=time.time() + 1), [])
+
+
+class TestJobStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = JobStore(os.path.join(self.tmp.name, "jobs.db"), max_attempts=2, backoff=60)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_states_resume_and_retry(self):
+        for gid in (1, 2, 3, 4):
+            self.store.start(gid)
+        self.store.set_state(1, "packed")
+        self.store.set_state(2, "filtered", "filtered")
+        self.store.set_state(3, "downloading")
+        self.store.fail(4, "download", "HTTPError", "HTTP Error 404")
+
+        # The in-flight ID of a crashed run is processed again, the others are settled
+        self.assertEqual(self.store.get_settled_ids(1, 10), {1, 2, 4})
+        self.assertEqual(self.store.count_states(1, 10),
+                         {"packed": 1, "filtered": 1, "downloading": 1, "failed": 1})
+
+        # Backoff, then attempts run out
+        self.assertEqual(self.store.get_retry_ids(1, 10), [])
+        self.assertEqual(self.store.get_retry_ids(1, 10, now=time.time() + 61), [4])
+        self.store.start(4)
+        self.store.fail(4, "download", "HTTPError")
+        self.assertEqual(self.store.get_retry_ids(1, 10, now=time.time() + 10 ** 6), [])
+        self.assertEqual(self.store.count_states(4, 4), {"failed": 1, "gave_up": 1})
+
+        path = os.path.join(self.tmp.name, "report.jsonl")
+        self.assertEqual(self.store.write_report(path, 1, 10), 4)
+        with open(path, encoding="utf-8") as f:
+            last = json.loads(f.readlines()[-1])
+        self.assertEqual((last["id"], last["state"], last["attempts"], last["reason"], last["retry_at"]),
+                         (4, "failed", 2, "HTTPError", None))
+
+
+class TestPipeline(unittest.TestCase):
+    def test_items_flow_through_all_stages(self):
+        packed = []
+
+        def double(x):
+            return x * 2
+
+        def drop_odd(x):
+            return x if x % 4 == 0 else None
+
+        stages = [
+            Stage("a", double, workers=3, queue_size=2),
+            Stage("b", drop_odd, workers=2, queue_size=2),
+            Stage("c", packed.append, workers=1, queue_size=2),
+        ]
+        pipeline = Pipeline(stages)
+        pipeline.start()
+        for i in range(50):
+            pipeline.put(i)
+        pipeline.join()
+
+        self.assertEqual(sorted(packed), [i * 2 for i in range(50) if (i * 2) % 4 == 0])
+        self.assertEqual(stages[0].processed, 50)
+
+    def test_errors_do_not_stop_workers(self):
+        errors = []
+
+        def fail_on_three(x):
+            if x == 3:
+                raise ValueError("boom")
+            return None
+
+        pipeline = Pipeline([Stage("a", fail_on_three, workers=1)],
+                            on_error=lambda stage, item, e: errors.append(item))
+        pipeline.start()
+        for i in range(5):
+            pipeline.put(i)
+        pipeline.join()
+        self.assertEqual(errors, [3])
+        self.assertEqual(pipeline.stages[0].processed, 5)
+
+    def test_scheduler_bounds_jobs_in_flight(self):
+        peak = []
+        done = []
+        scheduler = None
+
+        def work(x):
+            peak.append(scheduler.in_flight)
+            time.sleep(0.001)
+            return x if x % 3 else None
+
+        def on_done(x):
+            done.append(x)
+            scheduler.done(x)
+
+        pipeline = Pipeline([Stage("a", work, workers=4, queue_size=50),
+                             Stage("b", lambda x: None, workers=2, queue_size=50)], on_done=on_done)
+        scheduler = Scheduler(pipeline, max_in_flight=5)
+        ids = PendingIds(1, 200, lambda low, high: {i for i in range(low, high + 1) if i % 10 == 0}, chunk_size=7)
+        pipeline.start()
+        scheduler.run(ids)
+
+        self.assertEqual(sorted(done), [i for i in range(1, 201) if i % 10])
+        self.assertEqual((ids.skipped, scheduler.completed, scheduler.in_flight), (20, 180, 0))
+        self.assertLessEqual(max(peak), 5)
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    def saturate(self, limiter):
+        for _ in range(limiter.limit):
+            limiter.acquire()
+        for _ in range(limiter.limit):
+            limiter.release()
+
+    def test_increases_while_healthy_and_saturated(self):
+        limiter = AdaptiveLimiter("test", 2, minimum=1, maximum=4, window=5)
+        for _ in range(4):
+            self.saturate(limiter)
+            for _ in range(5):
+                limiter.record(0.1)
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual([(old, new) for old, new, _ in limiter.changes], [(2, 3), (3, 4)])
+
+    def test_decreases_on_errors_latency_and_throttling(self):
+        limiter = AdaptiveLimiter("test", 8, minimum=2, maximum=8, window=4, cooldown=0)
+        for _ in range(4):
+            limiter.record(0.1)
+        for _ in range(4):
+            limiter.record(0.5)
+        self.assertEqual(limiter.limit, 4)
+        self.assertIn("latency", limiter.changes[-1][2])
+
+        for _ in range(4):
+            limiter.record(0.1, error=True)
+        self.assertEqual(limiter.limit, 2)
+        self.assertIn("error rate", limiter.changes[-1][2])
+
+        limiter.record(0.1, throttled=True)
+        self.assertEqual(limiter.limit, 2)  # never below the minimum
+
+        limiter = AdaptiveLimiter("test", 8, window=4, cooldown=60)
+        limiter.record(0.1, throttled=True)
+        limiter.record(0.1, throttled=True)  # within the cooldown
+        self.assertEqual(limiter.limit, 4)
+
+    def test_classify_error(self):
+        self.assertEqual(classify_error("HttpError: '429 Too Many Requests'"), (True, True))
+        self.assertEqual(classify_error("HttpError: '503 Service Unavailable'"), (True, False))
+        self.assertEqual(classify_error("HttpError: '404 Not Found'"), (False, False))
+        self.assertEqual(classify_error("HTTP Error 502: Bad Gateway"), (True, False))
+        self.assertEqual(classify_error("<urlopen error timed out>"), (True, False))
+        # Gallery IDs in the URL are not a status
+        for gid in (1429871, 503, 4291234):
+            self.assertEqual(classify_error(f"HttpError: '404 Not Found' for 'https://ltn.gold-usergeneratedcontent.net"
+                                            f"/galleries/{gid}.js'"), (False, False))
+        self.assertEqual(classify_error("HttpError: '503 Service Unavailable' for 'https://hitomi.la/galleries/404.html'"),
+                         (True, False))
+
+
+class _PageHandler(http.server.BaseHTTPRequestHandler):
+    """Serves synthetic pages over keep-alive connections; /flaky-* fails once with a 503, /slow-* takes 0.3s."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get("Referer")))
+            server.connections.add(self.client_address)
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        try:
+            time.sleep(0.3 if self.path.startswith("/slow") else 0.02)
+            if self.path.startswith("/missing"):
+                status, body = 404, b"not found"
+            elif self.path.startswith("/flaky") and self.path not in server.failed:
+                server.failed.add(self.path)
+                status, body = 503, b"busy"
+            else:
+                status, body = 200, self.path.encode() * 1000
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAsyncPageDownloader(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _PageHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests, self.server.connections, self.server.failed = [], set(), set()
+        self.server.active = self.server.peak = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.downloader = AsyncPageDownloader(connections_per_host=3, timeout=5, retries=2)
+
+    def tearDown(self):
+        self.downloader.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_downloads_pages_concurrently_over_pooled_connections(self):
+        entries = [(f"{self.base}/{i}.webp", f"hitomi_7_{i:03}.webp") for i in range(1, 31)]
+        entries[4] = (f"{self.base}/flaky-5.webp", "hitomi_7_005.webp")
+        pages = dict(self.downloader.iter_pages(entries, 7))
+
+        self.assertEqual(len(pages), 30)
+        self.assertEqual(pages["hitomi_7_002.webp"], b"/2.webp" * 1000)
+        self.assertEqual(pages["hitomi_7_005.webp"], b"/flaky-5.webp" * 1000)
+        self.assertLessEqual(self.server.peak, 3)
+        self.assertLessEqual(len(self.server.connections), 4)  # + one after the 503 retry at most
+        self.assertEqual({referer for _, referer in self.server.requests}, {"https://hitomi.la/reader/7.html"})
+
+    def test_waiting_for_a_connection_is_not_part_of_the_timeout(self):
+        samples = []
+        downloader = AsyncPageDownloader(connections_per_host=1, timeout=1, retries=0,
+                                         observer=lambda latency, error=False, throttled=False: samples.append((latency, error)))
+        try:
+            entries = [(f"{self.base}/slow-{i}.webp", f"{i}.webp") for i in range(8)]
+            self.assertEqual(len(dict(downloader.iter_pages(entries, 7))), 8)
+        finally:
+            downloader.close()
+        # 8 x 0.3s in a queue, but each request alone is well within the timeout
+        self.assertEqual([error for _, error in samples], [False] * 8)
+        self.assertLess(max(latency for latency, _ in samples), 1)
+
+    def test_client_errors_are_raised(self):
+        entries = [(f"{self.base}/missing.webp", "a.webp"), (f"{self.base}/1.webp", "b.webp")]
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            list(self.downloader.iter_pages(entries, 7))
+        self.assertEqual(cm.exception.code, 404)
+
+
+def write_nozomi(path, ids):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"".join(gid.to_bytes(4, "big") for gid in ids))
+
+
+class TestIndexDiscovery(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = os.path.join(self.tmp.name, "n")
+        write_nozomi(os.path.join(root, "index-all.nozomi"), [120, 3, 115, 110, 108, 105, 104, 101, 100, 99])
+        write_nozomi(os.path.join(root, "index-japanese.nozomi"), [300, 115, 110, 108, 104, 101, 100, 7])
+        write_nozomi(os.path.join(root, "tag", "male:yaoi-all.nozomi"), [110, 50])
+        write_nozomi(os.path.join(root, "artist", "some artist-all.nozomi"), [104])
+        handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=self.tmp.name)
+        handler.log_message = lambda *args: None
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}/n"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_parse_nozomi(self):
+        self.assertEqual(list(parse_nozomi(b"\x00\x00\x01\x00\x7f\xff\xff\xff\x00")), [256, 2 ** 31 - 1])
+
+    def test_range_language_and_excludes(self):
+        discovery = IndexDiscovery(self.base, cache_dir=os.path.join(self.tmp.name, "cache"), retries=0)
+        ids = discovery.discover(100, 115, "Japanese", ["yaoi ♂", "female:missing"], ["Some Artist"])
+        self.assertEqual(ids, array.array("i", [100, 101, 108, 115]))
+        self.assertEqual(discovery.steps, [("range", 16), ("indexed", 7), ("language", 6), ("excluded", 4)])
+
+        # Cached indexes are used while the server is gone
+        self.server.shutdown()
+        self.assertEqual(list(discovery.discover(100, 110, "japanese")), [100, 101, 104, 108, 110])
+
+        ids = PendingIds(90, 130, lambda low, high: {101}, chunk_size=8, candidates=ids)
+        self.assertEqual((list(ids), len(ids), ids.skipped), ([100, 108, 115], 4, 1))
+
+
+GALLERYBLOCK = """<div class="dj">
+<h1 class="lillie"><a href="/reader/1234.html">Some  Title</a></h1>
+<div class="artist-list"><ul><li><a href="/artist/some%20artist-all.html">some artist</a></li></ul></div>
+<table class="dj-desc">
+<tr><td>Series</td><td><a href="/series/original-all.html">original</a></td></tr>
+<tr><td>Type</td><td><a href="/type/doujinshi-all.html">doujinshi</a></td></tr>
+<tr><td>Language</td><td><a href="/index-japanese.html">japanese</a></td></tr>
+<tr><td>Tags</td><td><ul class="tags">
+<li><a href="/tag/male%3Ayaoi-all.html">yaoi ♂</a></li>
+<li><a href="/tag/full%20color-all.html">full color</a></li>
+</ul></td></tr></table></div>"""
+
+
+class TestGalleryHeader(unittest.TestCase):
+    def test_parse_galleryblock(self):
+        record = parse_galleryblock(GALLERYBLOCK, 1234)
+        self.assertEqual((record.gallery_id, record.title, record.language, record.type),
+                         (1234, "Some Title", "japanese", "doujinshi"))
+        self.assertEqual((record.artist, record.parody), (["some artist"], ["original"]))
+        # Same tag form as gallery-dl's -j output, so the filter treats both phases alike
+        self.assertEqual(record.tags, ["yaoi ♂", "full color"])
+        self.assertEqual(record.pages, [])
+        self.assertIsNone(parse_galleryblock("<html><body>Not found</body></html>", 1))
+
+    def test_fetch_header_falls_back_to_none(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "galleryblock"))
+            with open(os.path.join(tmp, "galleryblock", "1234.html"), "w", encoding="utf-8") as f:
+                f.write(GALLERYBLOCK)
+            handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=tmp)
+            handler.log_message = lambda *args: None
+            server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                url = f"http://127.0.0.1:{server.server_address[1]}/galleryblock/{{}}.html"
+                self.assertEqual(fetch_header(1234, url, retries=0).artist, ["some artist"])
+                self.assertIsNone(fetch_header(99, url, retries=0))
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+class TestFilterRules(unittest.TestCase):
+    def record(self, language="japanese", tags=(), artist=None, error=None):
+        return GalleryRecord(gallery_id=1, language=language, tags=list(tags), artist=artist, error=error)
+
+    def test_namespaces_wildcards_and_reasons(self):
+        rules = FilterRules("Japanese", ["male:Yaoi", "tentacles", "guro*"], ["Some_Artist"])
+        # gallery-dl's "name ♂" form matches the config's "male:name"
+        self.assertEqual(rules.check(self.record(tags=["full color", "yaoi ♂"])), Rejection("excluded_tag", "male:yaoi"))
+        self.assertEqual(rules.check(self.record(tags=["guro extreme"])), Rejection("excluded_tag", "guro*"))
+        self.assertEqual(rules.check(self.record(artist="some artist")), Rejection("excluded_artist", "some artist"))
+        self.assertEqual(rules.check(self.record(language="english")), Rejection("language", "english"))
+        self.assertEqual(rules.check(self.record(error="404")), Rejection("gallery_error", "404"))
+        self.assertIsNone(rules.check(self.record(tags=["yaoi ♀", "tentacle"])))
+        self.assertIsNone(rules.check(self.record(language=None)))
+        self.assertEqual(rules.top_rejections(1), [(Rejection("excluded_tag", "male:yaoi"), 1)])
+
+        self.assertIsNone(FilterRules(None, ["male:*"]).check(self.record(tags=["yaoi ♀"])))
+        self.assertIsNotNone(FilterRules(None, ["male:*"]).check(self.record(tags=["yaoi ♂"])))
+        with self.assertRaises(ValueError):
+            FilterRules(None, ["*:yaoi"])
+
+    def test_include_rules_and_language_exceptions(self):
+        rules = FilterRules.from_config({
+            "exclude_tags": ["male:*"],
+            "include_tags": ["female:*"],
+            "include_artists": ["fav"],
+            "language_exceptions": {"English": {"artists": ["fav"], "tags": ["full color"]}},
+        }, "japanese")
+        self.assertEqual(rules.check(self.record(tags=["full color"])), Rejection("not_included", None))
+        self.assertIsNone(rules.check(self.record(tags=["glasses ♀"])))
+        self.assertIsNone(rules.check(self.record(language="english", artist=["fav"])))
+        # An exception only lifts the language rule
+        self.assertEqual(rules.check(self.record(language="english", tags=["full color", "yaoi ♂"])),
+                         Rejection("excluded_tag", "male:*"))
+        self.assertEqual(rules.check(self.record(language="korean", artist=["fav"])), Rejection("language", "korean"))
+        self.assertEqual(rules.index_excludes(), ([], []))
+
+        # Cached rejections are tied to the rules
+        self.assertEqual(rules.key, FilterRules.from_config({"exclude_tags": ["male:*"], "include_tags": ["female:*"],
+            "include_artists": ["fav"], "language_exceptions": {"english": {"artists": ["fav"], "tags": ["full color"]}}},
+            "Japanese").key)
+        self.assertNotEqual(rules.key, FilterRules("japanese", ["male:*"]).key)
+
+    def test_thousands_of_rules(self):
+        rules = FilterRules(None, [f"tag {i}" for i in range(20000)] + [f"ns{i}:*" for i in range(2000)],
+                            [f"artist {i}" for i in range(20000)])
+        self.assertEqual(len(rules.exclude_tags), 22000)
+        self.assertEqual(rules.check(self.record(tags=["ns1999:x"])), Rejection("excluded_tag", "ns1999:*"))
+        self.assertIsNone(rules.check(self.record(tags=["ns20000:x", "tag 20000"], artist="artist 20000")))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_pipeline_timings_and_counters_are_exported(self):
+        metrics = Metrics()
+        pipeline = Pipeline([Stage("a", lambda x: x, workers=2), Stage("b", lambda x: None)],
+                            on_timing=metrics.observe_stage)
+        pipeline.start()
+        for i in range(10):
+            pipeline.put(i)
+        pipeline.join()
+        metrics.inc("skipped", reason="filtered")
+        metrics.inc("skipped", 2, reason='odd "reason"')
+        metrics.inc("bytes_in", 1000)
+        metrics.add_gauge("in_flight", "In flight", lambda: {(): 3})
+
+        summary = metrics.summary()
+        self.assertEqual(summary["stages"]["a"]["time"]["count"], 10)
+        self.assertEqual(summary["stages"]["b"]["queue_wait"]["buckets"]["+Inf"], 10)
+        self.assertEqual(summary["skipped"], {"reason=filtered": 1, 'reason=odd "reason"': 2})
+        self.assertEqual(summary["bytes_in"], 1000)
+
+        text = metrics.prometheus_text()
+        self.assertIn('hitomi_dl_stage_seconds_count{stage="a"} 10', text)
+        self.assertIn('hitomi_dl_stage_seconds_bucket{stage="b",le="+Inf"} 10', text)
+        self.assertIn('hitomi_dl_skipped_total{reason="odd \\"reason\\""} 2', text)
+        self.assertIn("hitomi_dl_bytes_in_total 1000", text)
+        self.assertIn("hitomi_dl_failed_total 0", text)
+        self.assertIn("hitomi_dl_in_flight 3", text)
+
+
+class TestProfiler(unittest.TestCase):
+    def _run_two_threads(self, directory):
+        profiler = Profiler(directory)
+        barrier = threading.Barrier(2, timeout=5)
+        results, errors = [], []
+
+        def work(n):
+            barrier.wait()  # Both threads are inside Profiler.call at once
+            return sum(range(n))
+
+        def worker(n):
+            try:
+                results.append(profiler.call("stage", work, n))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in (10, 20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        profiler.save()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(results), [45, 190])
+        return sorted(os.listdir(directory))
+
+    def test_calls_from_two_threads(self):
+        with tempfile.TemporaryDirectory() as directory:
+            files = self._run_two_threads(directory)
+        name = "profile_stage" if profiling.PER_THREAD else "profile_all"
+        self.assertIn(name + ".prof", files)
+
+    def test_snapshots_while_running(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(directory, snapshot_every=2)
+            for _ in range(5):
+                profiler.tick()
+            profiler.save()
+            snapshots = sorted(name for name in os.listdir(directory) if name.endswith(".snapshot"))
+        self.assertEqual(snapshots, ["tracemalloc_001.snapshot", "tracemalloc_002.snapshot",
+                                     "tracemalloc_final.snapshot"])
+
+    def test_process_wide_profile(self):
+        # The 3.12+ path: one profile for all threads, enabled once
+        with tempfile.TemporaryDirectory() as directory, patch.object(profiling, "PER_THREAD", False):
+            files = self._run_two_threads(directory)
+        self.assertIn("profile_all.prof", files)
+        self.assertNotIn("profile_stage.prof", files)
+
+
+class TestImageProcessing(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_page(self, name, size, mode="RGB"):
+        path = os.path.join(self.tmp.name, name)
+        Image.new(mode, size).save(path)
+        return path
+
+    def test_process_page_resizes_and_converts(self):
+        path = self.make_page("001.png", (2400, 3840), "RGBA")
+        self.assertEqual(process_page(path), ("001.jpg", "transcoded"))
+        self.assertFalse(os.path.exists(path))
+        with Image.open(os.path.join(self.tmp.name, "001.jpg")) as img:
+            self.assertEqual((img.format, img.size), ("JPEG", (1200, 1920)))
+
+    def test_non_image_is_skipped(self):
+        path = os.path.join(self.tmp.name, "info.txt")
+        with open(path, "w") as f:
+            f.write("not an image")
+        self.assertIsNone(process_page(path))
+        self.assertTrue(os.path.exists(path))
+
+    def test_process_pool_keeps_page_order(self):
+        paths = [self.make_page(f"{i:03}.png", (100 + i, 100)) for i in range(8)]
+        with create_image_pool(2, "process") as pool:
+            results = list(pool.map(process_page, paths))
+        self.assertEqual([r[0] for r in results], [f"{i:03}.jpg" for i in range(8)])
+
+    def test_compliant_jpeg_is_passed_through(self):
+        path = os.path.join(self.tmp.name, "002.jpeg")
+        Image.new("RGB", (1000, 1500)).save(path, "JPEG", quality=75)
+        with open(path, "rb") as f:
+            original = f.read()
+
+        self.assertEqual(process_page(path), ("002.jpg", "passthrough"))
+        with open(os.path.join(self.tmp.name, "002.jpg"), "rb") as f:
+            self.assertEqual(f.read(), original)
+
+    def test_fast_downscale_keeps_target_size(self):
+        for oversample in (0, 1.5):
+            path = os.path.join(self.tmp.name, f"big_{oversample}.jpg")
+            Image.new("RGB", (4000, 6000), (200, 100, 50)).save(path, "JPEG")
+            name, action = process_page(path, oversample=oversample)
+            with Image.open(os.path.join(self.tmp.name, name)) as img:
+                self.assertEqual(img.size, (1280, 1920))
+
+    def test_webp_output_keeps_names_and_passes_webp_through(self):
+        output = OutputFormat("webp", quality=70)
+        path = self.make_page("006.png", (2400, 3840))
+        self.assertEqual(process_page(path, output=output), ("006.webp", "transcoded"))
+        with Image.open(os.path.join(self.tmp.name, "006.webp")) as img:
+            self.assertEqual((img.format, img.size), ("WEBP", (1200, 1920)))
+        # Already WebP within the limit: stored as-is; JPEGs are re-encoded
+        self.assertEqual(process_page(os.path.join(self.tmp.name, "006.webp"), output=output), ("006.webp", "passthrough"))
+        jpeg = os.path.join(self.tmp.name, "007.jpg")
+        Image.new("RGB", (800, 800)).save(jpeg, "JPEG")
+        self.assertEqual(process_page(jpeg, output=output), ("007.webp", "transcoded"))
+        self.assertFalse(os.path.exists(jpeg))
+
+        with self.assertRaises(ValueError):
+            OutputFormat("bmp")
+
+    def test_in_memory_matches_file_processing(self):
+        path = self.make_page("005.png", (3000, 2000))
+        with open(path, "rb") as f:
+            data = f.read()
+
+        name, converted, action = process_page_data("005.png", data)
+        process_page(path)
+        with open(os.path.join(self.tmp.name, "005.jpg"), "rb") as f:
+            self.assertEqual((name, converted, action), ("005.jpg", f.read(), "transcoded"))
+
+        self.assertIsNone(process_page_data("info.txt", b"not an image"))
+
+    def test_passthrough_disabled_or_oversized(self):
+        small = os.path.join(self.tmp.name, "003.jpg")
+        Image.new("RGB", (800, 800)).save(small, "JPEG")
+        self.assertEqual(process_page(small, passthrough=False), ("003.jpg", "transcoded"))
+
+        large = os.path.join(self.tmp.name, "004.jpg")
+        Image.new("RGB", (2000, 800)).save(large, "JPEG")
+        self.assertEqual(process_page(large), ("004.jpg", "transcoded"))
+
+
+class TestInMemoryMode(unittest.TestCase):
+    def test_page_list_uses_gallery_dl_names(self):
+        record = GalleryRecord.from_messages([
+            [2, {"gallery_id": 7}],
+            [3, "https://a.example/x.webp", {"category": "hitomi", "gallery_id": 7, "num": 1, "extension": "webp"}],
+            [3, "https://a.example/y.webp", {"category": "hitomi", "gallery_id": 7, "num": 12, "extension": "webp",
+                                             "size": 1234}],
+        ])
+        self.assertEqual(record.entries(), [
+            ("https://a.example/x.webp", "hitomi_7_001.webp"),
+            ("https://a.example/y.webp", "hitomi_7_012.webp"),
+        ])
+        self.assertEqual(record.sizes(), [None, 1234])
+        self.assertEqual(GalleryRecord.from_data(json.loads(json.dumps(record.to_dict()))).pages, record.pages)
+
+    def test_budget(self):
+        budget = ByteBudget(100)
+        self.assertTrue(budget.try_reserve(60))
+        self.assertFalse(budget.try_reserve(60))
+        budget.adjust(60, 30)
+        self.assertTrue(budget.try_reserve(60))
+        budget.release(90)
+        self.assertEqual(budget.used, 0)
+
+
+class TestDiskBudget(unittest.TestCase):
+    def test_watermarks_hold_back_reservations(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            budget = DiskBudget(os.path.join(tmp, "temp"), high=100, low=40, page_estimate=10)
+            self.assertEqual(budget.estimate([None, 5, None]), 25)
+            budget.observe(4, 80)
+            self.assertEqual(budget.estimate([None, None]), 40)
+            # No page list: the page count, or a nominal one, at the mean page size
+            self.assertEqual(budget.estimate([], 3), 60)
+            self.assertEqual(budget.estimate([]), 20 * DiskBudget.NOMINAL_PAGES)
+
+            budget.reserve(70)
+            budget.reserve(30)  # high watermark reached: blocks from now on
+            admitted = threading.Event()
+            waiter = threading.Thread(target=lambda: (budget.reserve(10), admitted.set()))
+            waiter.start()
+            self.assertFalse(admitted.wait(0.3))
+            budget.release(30)  # 70: below high but still above low
+            self.assertFalse(admitted.wait(0.3))
+            budget.adjust(70, 30)  # below low
+            self.assertTrue(admitted.wait(2))
+            waiter.join()
+            self.assertEqual(budget.used, 40)
+            self.assertEqual(budget.waits, 1)
+
+    def test_gallery_that_cannot_fit_raises(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            budget = DiskBudget(tmp, high=float("inf"), low=float("inf"), page_estimate=0, min_free=2 ** 62)
+            with self.assertRaises(DiskSpaceError):
+                budget.reserve(1)
+            self.assertEqual(budget.used, 0)
+
+
+class TestCbzWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "[a] t (1).cbz")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pages_written_in_order_with_method_per_type(self):
+        writer = CbzWriter(self.path)
+        writer.add(2, "003.jpg", data=b"c")
+        writer.add(0, "001.jpg", data=b"a")
+        writer.skip(1)
+        writer.add(3, "info.txt", data=b"text" * 100)
+        self.assertFalse(os.path.exists(self.path))
+        writer.close()
+
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+        with zipfile.ZipFile(self.path) as cbz:
+            infos = cbz.infolist()
+        self.assertEqual([i.filename for i in infos], ["001.jpg", "003.jpg", "info.txt"])
+        self.assertEqual([i.compress_type for i in infos],
+                         [zipfile.ZIP_STORED, zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+
+    def test_extra_entries_follow_the_pages(self):
+        writer = CbzWriter(self.path, [("ComicInfo.xml", b"<ComicInfo/>")])
+        writer.add(1, "002.jpg", data=b"b")
+        writer.add(0, "001.jpg", data=b"a")
+        writer.close()
+        self.assertEqual([name for name, _, _ in writer.entries()], ["001.jpg", "002.jpg", "ComicInfo.xml"])
+        self.assertEqual(build_manifest(self.path)["pages"], 2)
+
+    def test_abort_removes_partial_archive(self):
+        writer = CbzWriter(self.path)
+        writer.add(0, "001.jpg", data=b"a")
+        writer.abort()
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "[a] t (7).cbz")
+        self.db = DBManager(os.path.join(self.tmp.name, "organizer.db"))
+        writer = CbzWriter(self.path)
+        for index in range(3):
+            writer.add(index, f"{index + 1:03}.jpg", data=bytes([index]) * 5000)
+        writer.close()
+        self.db.put_manifest(7, build_manifest(self.path, writer.entries()))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def verify(self, full=False):
+        results = list(verify_library(self.db.get_manifests(1, 10), workers=2, full=full))
+        updates = []
+        for gid, _, result, _, stamp in results:
+            good = result in ("ok", "unchanged")
+            updates.append(("ok" if good else result, stamp[0] if good else None, stamp[1] if good else None, gid))
+        self.db.set_verify_results(updates)
+        return [(gid, result, detail) for gid, _, result, detail, _ in results]
+
+    def test_page_count_matches_the_organizer(self):
+        path = os.path.join(self.tmp.name, "bmp.cbz")
+        writer = CbzWriter(path, [("ComicInfo.xml", b"<ComicInfo/>")])
+        writer.add(0, "001.bmp", data=b"BM" * 100)
+        writer.add(1, "002.webp", data=b"page")
+        writer.close()
+        self.assertEqual(build_manifest(path)["pages"], 2)
+        self.assertEqual(cbz_page_count(path), 2)
+
+    def test_manifest(self):
+        gid, manifest, path, previous = self.db.get_manifests()[0]
+        self.assertEqual((gid, manifest["pages"], path), (7, 3, os.path.abspath(self.path)))
+        self.assertEqual(manifest["entries"][0][0], "001.jpg")
+        self.assertEqual(previous, (manifest["size"], manifest["mtime"]))
+
+    def test_unchanged_files_are_skipped_and_damage_is_flagged(self):
+        self.assertEqual(self.verify(), [(7, "unchanged", None)])
+        self.assertEqual(self.verify(full=True), [(7, "ok", None)])
+
+        # Same size, one page damaged
+        with open(self.path, "r+b") as f:
+            f.seek(6000)
+            f.write(b"\xff")
+        (_, result, detail), = self.verify()
+        self.assertEqual(result, "corrupt")
+        self.assertIn("002.jpg", detail)
+        # Flagged files stay flagged until they are fixed
+        self.assertEqual(self.verify()[0][1], "corrupt")
+
+        with open(self.path, "r+b") as f:
+            f.truncate(4000)
+        self.assertEqual(self.verify()[0][1], "corrupt")
+        os.remove(self.path)
+        self.assertEqual(self.verify()[0][1], "missing")
+
+    def test_added_entries_and_organized_path(self):
+        target = os.path.join(self.tmp.name, "Manga", "a", os.path.basename(self.path))
+        os.makedirs(os.path.dirname(target))
+        os.replace(self.path, target)
+        self.db.upsert_gallery({"id": 7, "current_path": target})
+        self.assertEqual(self.verify(), [(7, "unchanged", None)])
+
+        with zipfile.ZipFile(target, "a") as cbz:
+            cbz.writestr("ComicInfo.xml", "<ComicInfo/>")
+        (_, result, detail), = self.verify()
+        self.assertEqual(result, "changed")
+        self.assertIn("1 entries added", detail)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data):
+        with open(os.path.join(self.dir, name), "wb") as f:
+            f.write(data)
+
+    def test_resume_detects_missing_and_truncated_pages(self):
+        checkpoint = Checkpoint(self.dir, 5)
+        for name in ("1.webp", "2.webp", "3.webp"):
+            self.write(name, b"x" * 100)
+            checkpoint.mark_downloaded(name, b"x" * 100)
+
+        # Truncated page, and a page whose file vanished
+        self.write("2.webp", b"x" * 10)
+        os.remove(os.path.join(self.dir, "3.webp"))
+
+        reloaded = Checkpoint(self.dir, 5)
+        self.assertEqual(reloaded.missing(["1.webp", "2.webp", "3.webp", "4.webp"]), ["2.webp", "3.webp", "4.webp"])
+
+    def test_hash_verification(self):
+        checkpoint = Checkpoint(self.dir, 5, verify_hashes=True)
+        self.write("1.webp", b"a" * 10)
+        checkpoint.mark_downloaded("1.webp", b"a" * 10)
+        self.write("1.webp", b"b" * 10)
+        self.assertEqual(checkpoint.missing(["1.webp"]), ["1.webp"])
+
+    def test_processed_pages_are_reused(self):
+        checkpoint = Checkpoint(self.dir, 5)
+        checkpoint.mark_downloaded("1.webp", b"w" * 50)
+        self.write("1.jpg", b"j" * 40)
+        checkpoint.mark_processed("1.webp", "1.jpg")
+
+        reloaded = Checkpoint(self.dir, 5)
+        # Original was removed after conversion, but the page still counts as downloaded
+        self.assertEqual(reloaded.missing(["1.webp"]), [])
+        self.assertEqual(reloaded.processed_name("1.jpg"), "1.jpg")
+        self.assertIsNone(Checkpoint(self.dir, 6).processed_name("1.jpg"))
+
+
+if __name__ == '__main__':
+    unittest.main()
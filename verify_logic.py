@@ -4,6 +4,9 @@ import unittest
 from unittest.mock import MagicMock, patch
 from organizer.db_manager import DBManager
 from organizer.file_organizer import FileOrganizer
+from organizer.metadata_utils import gallery_signatures, metadata_entries, metadata_signatures, read_embedded_metadata
+from downloader.gallery_record import GalleryRecord
+from downloader.archive import CbzWriter
 
 # Test Config
 TEST_DB = "test_organizer.db"
@@ -156,6 +159,84 @@ class TestOrganizerLogic(unittest.TestCase):
         self.db.add_category("Doujinshi")
         self.assertEqual(len(cats_updated), len(self.db.get_all_categories()))
 
+    def test_completed_ids(self):
+        # Downloaded but not organized yet
+        self.db.mark_downloaded(100, "[A] T (100).cbz")
+        self.db.add_downloads([(101, "[A] T (101).cbz"), (100, "dup.cbz")])
+        # Organized (moved out of the download folder)
+        self.db.upsert_gallery({"id": 150, "title": "T", "author": "A"})
+        self.db.upsert_gallery({"id": 500, "title": "T", "author": "A"})
+
+        self.assertEqual(self.db.get_completed_ids(100, 200), {100, 101, 150})
+        self.assertEqual(self.db.count_downloads(), 2)
+
+    def test_signature_index(self):
+        metadata = GalleryRecord.from_messages([
+            [2, {"gallery_id": 300, "artist": ["Foo", "bar"], "title": "(C97) [Circle (Foo)] My Title [English]",
+                 "title_jpn": "マイタイトル", "language": "japanese"}],
+            [3, "https://a/1.webp", {"num": 1}],
+            [3, "https://a/2.webp", {"num": 2}],
+        ])
+        signatures = metadata_signatures(metadata)
+        self.assertEqual(signatures, ["bar,foo|my title|japanese|2", "bar,foo|マイタイトル|japanese|2"])
+        self.db.add_signatures([(signature, 300) for signature in signatures])
+
+        # Organized copy: Japanese title, "a, b" author string, page count from the archive
+        organized = gallery_signatures("bar, FOO", ("マイタイトル",), "Japanese", 2)
+        self.assertEqual(self.db.find_signature_ids(organized, exclude_id=301), [300])
+        self.assertEqual(self.db.find_signature_ids(organized, exclude_id=300), [])
+        self.assertEqual(gallery_signatures("N_A", ("Title",), "japanese", 2), [])
+        self.assertEqual(metadata_signatures(GalleryRecord.from_error("404")), [])
+
+        self.db.upsert_gallery({"id": 301, "title": "T", "author": "A"})
+        self.db.mark_downloaded(302, "x.cbz")
+        self.assertEqual([row[0] for row in self.db.get_unsigned_galleries()], [301])
+        self.assertEqual(self.db.get_unsigned_downloads(), [302])
+        self.db.mark_unsignable([301, 302])
+        self.assertEqual(self.db.get_unsigned_galleries(), [])
+        self.assertEqual(self.db.get_unsigned_downloads(), [])
+        self.db.clear_unsignable()
+        self.assertEqual(self.db.get_unsigned_downloads(), [302])
+
+    def write_cbz(self, path, record):
+        writer = CbzWriter(path, metadata_entries(record))
+        writer.add(0, "hitomi_400_001.webp", data=b"page")
+        writer.close()
+
+    def test_embedded_metadata(self):
+        record = GalleryRecord.from_messages([
+            [2, {"gallery_id": 400, "artist": ["Embedded Author"], "title": "Embedded Title", "type": "manga",
+                 "tags": ["glasses ♀"], "language": "japanese", "date": "2024-05-06 10:00:00"}],
+            [3, "https://a/1.webp", {"num": 1, "extension": "webp"}],
+        ])
+        # The filename has no author: only the embedded metadata knows it
+        file_path = os.path.join(TEST_SOURCE_DIR, "Embedded Title (400).cbz")
+        self.write_cbz(file_path, record)
+
+        embedded = read_embedded_metadata(file_path)
+        self.assertEqual((embedded.gallery_id, embedded.artist, embedded.count), (400, ["Embedded Author"], 1))
+        self.assertEqual(self.organizer.get_default_category_for_file(file_path), ("Manga", "Embedded Author"))
+
+        success, msg, _ = self.organizer.organize_file(file_path, "Manga", TEST_BASE_DIR)
+        self.assertTrue(success, msg)
+        self.assertTrue(os.path.exists(os.path.join(TEST_BASE_DIR, "Manga", "Embedded Author", "Embedded Title (400).cbz")))
+        row = self.db.get_gallery_by_id(400)
+        self.assertEqual((row[4], row[7], row[8]), ("Embedded Author", '["glasses ♀"]', "japanese"))
+
+    def test_import_library(self):
+        record = GalleryRecord(gallery_id=401, title="T", artist=["A"], type="doujinshi", language="english")
+        os.makedirs(os.path.join(TEST_BASE_DIR, "Manga", "A"))
+        self.write_cbz(os.path.join(TEST_BASE_DIR, "Manga", "A", "[A] T (401).cbz"), record)
+        record.gallery_id = 402
+        self.write_cbz(os.path.join(TEST_BASE_DIR, "[A] T (402).cbz"), record)
+        with open(os.path.join(TEST_BASE_DIR, "[B] Old (403).cbz"), "w") as f:
+            f.write("content")
+
+        self.assertEqual(self.organizer.import_library(TEST_BASE_DIR), (2, 0, 1))
+        self.assertEqual(self.db.get_gallery_by_id(401)[5], "Manga")
+        self.assertEqual(self.db.get_gallery_by_id(402)[5], "Doujinshi")
+        self.assertEqual(self.organizer.import_library(TEST_BASE_DIR), (0, 2, 1))
+
     def test_author_na_fallback(self):
         # 1. Normal N_A with Group
         filename = "[N_A][Group Name] Title.cbz"